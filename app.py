@@ -1,15 +1,228 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
 import streamlit as st
-from compare_core import run_core_web
+from compare_core import (
+    ERROR_REPORT_MODES,
+    PREVIEW_MODE_LABELS,
+    PREVIEW_MODES,
+    PREVIEW_ROWS,
+    READER_ENGINE_LABELS,
+    READER_ENGINES,
+    RUN_STAGE_LABELS,
+    RunCancelled,
+    content_hash,
+    installed_error_formats,
+    merge_profiles,
+    prepare_run,
+    preview_run,
+    progress_fraction,
+    render_outputs,
+    run_profiled,
+)
+from jobs import JOB_STATE_LABELS, JOB_TTL_SECONDS, JobQueue
+
+# 已解析 / 校驗過的輸入最多保留幾組（依內容雜湊；超過就淘汰最久沒用的）
+MAX_CACHED_RUNS = 2
+# 已產出的輸出檔最多保留幾組（模式 / 格式 / 完整 LOG 的組合）
+MAX_CACHED_RENDERS = 2
+# 背景工作執行中時，頁面自動更新狀態的間隔（秒）
+JOB_POLL_SECONDS = 2
+
+
+def _lru_get(cache, key):
+    if key not in cache:
+        return None
+    cache.move_to_end(key)
+    return cache[key]
+
+
+def _lru_put(cache, key, value, max_size):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def _file_hash(uf):
+    """上傳檔內容雜湊；同一個上傳物件（file_id）只算一次"""
+    memo = st.session_state.setdefault("file_hashes", {})
+    file_id = getattr(uf, "file_id", None)
+    if file_id is not None and file_id in memo:
+        return memo[file_id]
+    digest = content_hash(uf.getvalue())
+    if file_id is not None:
+        memo[file_id] = digest
+    return digest
+
+
+def inputs_key(source_files, template_file):
+    """來源檔（依順序）+ 模板的內容雜湊"""
+    return "|".join([_file_hash(uf) for uf in source_files] + [_file_hash(template_file)])
+
+
+def _cancel_run():
+    """
+    取消按鈕：按下時 Streamlit 會在下一次更新進度條時中斷目前的執行；
+    這裡再設定取消旗標並收起結果，重跑時不會自動接著產出
+    """
+    cancel = st.session_state.get("cancel_event")
+    if cancel is not None:
+        cancel.set()
+    st.session_state.pop("active_key", None)
+    st.session_state["cancelled"] = True
+
+
+def progress_panel(button_key):
+    """
+    進度條（含預估剩餘時間）+ 取消按鈕；回傳 (progress callback, 取消旗標, 面板 placeholder)
+    """
+    cancel = threading.Event()
+    st.session_state["cancel_event"] = cancel
+    panel = st.empty()
+    with panel.container():
+        bar = st.progress(0.0, text="準備中...")
+        st.button("取消執行", key=button_key, on_click=_cancel_run)
+
+    started = time.time()
+    first = []
+
+    def update(stage, done, total):
+        frac = progress_fraction(stage, done, total)
+        if not first:
+            first.append(frac)
+        elapsed = time.time() - started
+        text = f"{RUN_STAGE_LABELS[stage]}：{done:,} / {total:,}　已耗時 {elapsed:.0f} 秒"
+        if frac > first[0]:
+            text += f"，預估剩餘 {elapsed * (1 - frac) / (frac - first[0]):.0f} 秒"
+        bar.progress(frac, text=text)
+
+    return update, cancel, panel
+
+
+@st.cache_resource
+def get_job_queue():
+    """整個伺服器共用一個背景工作佇列（所有使用者的工作共用同一個固定大小的行程池）"""
+    return JobQueue()
+
+
+def _page_job_ids():
+    """本頁追蹤的背景工作編號（放在網址參數，重新整理 / 之後再開都還在）"""
+    return [j for j in st.query_params.get("jobs", "").split(",") if j]
+
+
+def _set_page_job_ids(job_ids):
+    if job_ids:
+        st.query_params["jobs"] = ",".join(job_ids)
+    else:
+        st.query_params.pop("jobs", None)
+
+
+def show_job(queue, job_id):
+    """單一背景工作：狀態 / 進度、取消、完成後下載；回傳是否仍在排隊或執行中"""
+    try:
+        status = queue.status(job_id)
+    except KeyError:
+        st.warning(f"工作 {job_id} 不存在或已超過保存時間被清除。")
+        return False
+
+    state = status["state"]
+    created = datetime.fromtimestamp(status["created"]).strftime("%Y-%m-%d %H:%M:%S")
+    with st.container(border=True):
+        st.markdown(
+            f"**工作 `{job_id}`**　{JOB_STATE_LABELS[state]}　（送出：{created}，"
+            f"來源 {len(status['source_names'])} 個檔案，模板 {status['template_name']}）"
+        )
+        if state in ("queued", "running"):
+            prog = status.get("progress")
+            if prog:
+                st.progress(prog["fraction"], text=f"{RUN_STAGE_LABELS[prog['stage']]}：{prog['done']:,} / {prog['total']:,}")
+            else:
+                st.progress(0.0, text="排隊中…" if state == "queued" else "準備中…")
+            if st.button("取消這個工作", key=f"cancel_job_{job_id}"):
+                queue.cancel(job_id)
+                st.rerun()
+            return True
+
+        if state == "failed":
+            st.error(f"執行失敗：{status.get('error')}")
+        elif state == "done":
+            result = queue.result(job_id)
+            files = result["files"]
+            downloads = [
+                ("output", "下載主結果檔", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+                ("error", "下載錯誤報表", result["error_mime"]),
+                ("full_log", "下載完整 LOG", "text/plain"),
+            ]
+            cols = st.columns(len(downloads))
+            for col, (kind, label, mime) in zip(cols, downloads):
+                if kind in files:
+                    with open(files[kind], "rb") as f:
+                        col.download_button(
+                            label, data=f.read(), file_name=os.path.basename(files[kind]), mime=mime,
+                            key=f"dl_{kind}_{job_id}", use_container_width=True
+                        )
+            with st.expander("統計 / LOG", expanded=False):
+                st.json({k: v for k, v in result["stats"].items() if k != "階段明細"})
+                st.text(result["log"])
+        if st.button("從清單移除", key=f"forget_job_{job_id}"):
+            _set_page_job_ids([j for j in _page_job_ids() if j != job_id])
+            st.rerun()
+    return False
+
 
 st.set_page_config(page_title="GWC 產規匹配程式", layout="wide")
 
 st.title("GWC 產規明細導入模板校驗產出程式（Web V10.1.0版）")
 st.caption("來源檔案合併 ➜ 產規規則檢查 ➜ 產出錯誤報表 / 匹配結果檔")
 
+prepared_cache = st.session_state.setdefault("prepared_runs", OrderedDict())
+rendered_cache = st.session_state.setdefault("rendered_runs", OrderedDict())
+
 with st.sidebar:
     st.header("操作")
     mode = st.radio("模式", ["完整檢查（主結果 + 錯誤報表）", "只輸出錯誤報表"], index=0)
     only_error = (mode == "只輸出錯誤報表")
+    error_format = st.selectbox(
+        "錯誤報表格式",
+        installed_error_formats(),
+        index=0,
+        help="錯誤量很大時建議 csv / parquet（ErrorLog、SourceCheck 打包成 zip）；xlsx 超過 Excel 列數上限會自動拆成 ErrorLog_2…"
+    )
+    error_report_mode = st.selectbox(
+        "錯誤報表內容",
+        list(ERROR_REPORT_MODES),
+        index=0,
+        format_func=ERROR_REPORT_MODES.get,
+        help="錯誤數十萬格時建議選彙總：同一欄位 / 錯誤類型 / 值只列一行（筆數、首末列號、範例料號），筆數與統計一致"
+    )
+    full_log = st.checkbox("產生完整 LOG 檔（可下載）", value=False, help="畫面上的 LOG 只顯示前後段；錯誤很多時完整 LOG 請用下載")
+    stream = st.checkbox(
+        "大檔省記憶體（串流讀取來源）",
+        value=False,
+        help="來源檔分批讀取，只留下對得到模板料號的列；來源有數百萬列、記憶體不足時使用（結果相同，來源檔改為循序讀取）"
+    )
+    reader = st.selectbox(
+        "讀檔引擎",
+        list(READER_ENGINES),
+        index=0,
+        format_func=READER_ENGINE_LABELS.get,
+        help="各引擎讀出的值相同；calamine 讀大檔快很多（伺服器需安裝 python-calamine）。舊版 .xls 自動改用 xlrd"
+    )
+    preview_rows = st.number_input(
+        "快速預覽：每個來源檔取幾列", min_value=10, max_value=100_000, value=PREVIEW_ROWS, step=100,
+        help="按「快速預覽」時每個來源檔只檢查這麼多列（模板整份讀），幾秒內就能看出欄位 / 料號對不對"
+    )
+    preview_mode = st.selectbox("快速預覽方式", list(PREVIEW_MODES), index=0, format_func=PREVIEW_MODE_LABELS.get)
+    profile = st.checkbox("產生效能分析檔（cProfile）", value=False, help="執行時記錄 cProfile，可下載 .pstats 離線分析；會重新讀檔且來源檔改為循序讀取")
+    background = st.checkbox(
+        "背景執行（可關閉頁面，稍後再下載）",
+        value=False,
+        help=f"送出後排入伺服器的工作佇列；網址會記住工作編號，重新整理或之後再開都能下載（保存 {JOB_TTL_SECONDS // 3600} 小時）"
+    )
     st.divider()
     st.markdown("**注意事項**")
     st.markdown(
@@ -37,22 +250,117 @@ with col2:
     )
 
 st.markdown("### 執行")
-run = st.button("開始執行", type="primary", use_container_width=True, disabled=(not src_files or not tpl_file))
+run_col, preview_col = st.columns([3, 1])
+run = run_col.button("開始執行", type="primary", use_container_width=True, disabled=(not src_files or not tpl_file))
+preview = preview_col.button(
+    "快速預覽", use_container_width=True, disabled=(not src_files or not tpl_file),
+    help="每個來源檔只取側欄設定的列數，檢查欄位 / 料號 / 規則並推估完整執行的錯誤比例與耗時；不產生輸出檔"
+)
+
+# 讀檔引擎 / 串流讀取不同時重新解析：結果相同，但 stats 的讀檔引擎、階段明細不同
+key = (inputs_key(src_files, tpl_file), reader, stream) if (src_files and tpl_file) else None
+
+if preview:
+    update, cancel, panel = progress_panel("cancel_preview")
+    try:
+        preview_result = preview_run(
+            src_files, tpl_file, rows=int(preview_rows), mode=preview_mode, reader=reader, progress=update, cancel=cancel
+        )
+    except RunCancelled:
+        panel.empty()
+        st.warning("已取消預覽。")
+        st.stop()
+    panel.empty()
+    st.session_state["preview"] = (key, preview_result)
+
+# 目前輸入的預覽結果（換了上傳檔就不再顯示）
+preview_state = st.session_state.get("preview")
+if preview_state is not None and preview_state[0] == key:
+    preview_result = preview_state[1]
+    st.subheader("快速預覽")
+    for line in preview_result["log"].splitlines():
+        if line.startswith("[警告]"):
+            st.warning(line)
+    st.json(preview_result["stats"])
+    with st.expander("預覽 LOG", expanded=False):
+        st.text(preview_result["log"])
+
+if run and background:
+    job_id = get_job_queue().submit(
+        src_files, tpl_file, only_error_report=only_error, error_format=error_format, full_log=full_log,
+        stream=stream, reader=reader, error_report_mode=error_report_mode,
+    )
+    _set_page_job_ids(_page_job_ids() + [job_id])
+    st.success(f"已送出背景工作 `{job_id}`，可在下方「背景工作」查看進度與下載。")
+    run = False
+
+if st.session_state.pop("cancelled", False) and not run:
+    st.warning("已取消執行，這次的中間結果已丟棄。")
 
 if run:
-    with st.spinner("處理中..."):
-        result = run_core_web(
-            source_files=src_files,
-            template_file=tpl_file,
-            only_error_report=only_error
+    # 同一組輸入已校驗過就直接重用，只重做輸出階段
+    # 要效能分析時一律重跑，分析檔才包含讀檔～校驗
+    if profile or _lru_get(prepared_cache, key) is None:
+        update, cancel, panel = progress_panel("cancel_prepare")
+        run_kwargs = dict(
+            source_files=src_files, template_file=tpl_file, stream=stream, reader=reader, progress=update, cancel=cancel
         )
+        try:
+            if profile:
+                state, prepare_profile = run_profiled(prepare_run, read_workers=1, **run_kwargs)
+                state["profile_bytes"] = prepare_profile
+            else:
+                state = prepare_run(**run_kwargs)
+        except RunCancelled:
+            # 中途取消：什麼都不放進快取
+            st.session_state.pop("active_key", None)
+            panel.empty()
+            st.warning("已取消執行，這次的中間結果已丟棄。")
+            st.stop()
+        panel.empty()
+        _lru_put(prepared_cache, key, state, MAX_CACHED_RUNS)
+        # 同一組輸入重跑過，舊的輸出結果不再沿用
+        for k in [k for k in rendered_cache if k[0] == key]:
+            del rendered_cache[k]
+    st.session_state["active_key"] = key
+
+# 目前輸入有校驗結果就顯示（切換模式 / 按下載按鈕造成的 rerun 都不必重跑）
+state = _lru_get(prepared_cache, key) if key is not None and st.session_state.get("active_key") == key else None
+
+if state is not None:
+    render_key = (key, only_error, error_format, error_report_mode, full_log, profile)
+    result = _lru_get(rendered_cache, render_key)
+    if result is None:
+        update, cancel, panel = progress_panel("cancel_render")
+        render_kwargs = dict(
+            only_error_report=only_error, error_format=error_format, error_report_mode=error_report_mode,
+            full_log=full_log, progress=update, cancel=cancel,
+        )
+        try:
+            if profile:
+                result, render_profile = run_profiled(render_outputs, state, **render_kwargs)
+                profiles = [p for p in (state.get("profile_bytes"), render_profile) if p is not None]
+                result["profile_bytes"] = merge_profiles(*profiles)
+                result["profile_name"] = f"產規匹配效能分析_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pstats"
+            else:
+                result = render_outputs(state, **render_kwargs)
+        except RunCancelled:
+            st.session_state.pop("active_key", None)
+            panel.empty()
+            st.warning("已取消執行，這次的中間結果已丟棄。")
+            st.stop()
+        panel.empty()
+        _lru_put(rendered_cache, render_key, result, MAX_CACHED_RENDERS)
 
     st.success("完成！")
 
     # ---- 統計 ----
     s = result["stats"]
     st.subheader("統計")
-    st.json(s)
+    st.json({k: v for k, v in s.items() if k != "階段明細"})
+
+    st.subheader("階段明細")
+    st.dataframe(s["階段明細"], hide_index=True, use_container_width=True)
 
     # ---- 下載 ----
     st.subheader("輸出檔案")
@@ -72,7 +380,7 @@ if run:
             "下載錯誤報表",
             data=result["error_bytes"],
             file_name=result["error_name"],
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            mime=result["error_mime"],
             use_container_width=True
         )
     else:
@@ -81,3 +389,39 @@ if run:
     # ---- LOG ----
     with st.expander("查看 LOG（文字）", expanded=False):
         st.text(result["log"])
+
+    if result.get("full_log_bytes") is not None:
+        st.download_button(
+            "下載完整 LOG",
+            data=result["full_log_bytes"],
+            file_name=result["full_log_name"],
+            mime="text/plain",
+            use_container_width=True
+        )
+
+    if result.get("profile_bytes") is not None:
+        st.download_button(
+            "下載效能分析檔（.pstats）",
+            data=result["profile_bytes"],
+            file_name=result["profile_name"],
+            mime="application/octet-stream",
+            use_container_width=True
+        )
+
+# ---- 背景工作 ----
+job_ids = _page_job_ids()
+st.markdown("### 背景工作")
+lookup = st.text_input("以工作編號查詢", value="", placeholder="貼上工作編號後按 Enter").strip()
+if lookup and lookup not in job_ids:
+    _set_page_job_ids(job_ids + [lookup])
+    job_ids = _page_job_ids()
+
+if job_ids:
+    queue = get_job_queue()
+    pending = [show_job(queue, job_id) for job_id in reversed(job_ids)]
+    if any(pending):
+        # 還有工作在排隊 / 執行：定時重新整理狀態
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
+else:
+    st.caption("目前沒有背景工作。勾選側欄「背景執行」後按開始執行即可送出。")
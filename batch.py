@@ -0,0 +1,384 @@
+"""
+產規匹配批次執行（無介面）
+
+單一工作：
+    python batch.py --template 模板.xlsx --sources 來源資料夾/ --out 輸出/
+    python batch.py --template 模板.xlsx --sources "來源/*.xlsx" --only-error-report
+
+多個工作（manifest JSON，工作之間以多行程平行執行）：
+    python batch.py --manifest jobs.json --out 輸出/ --jobs 4
+
+manifest 格式：
+    [
+      {"name": "A廠", "template": "tplA.xlsx", "sources": ["A/"]},
+      {"template": "tplB.xlsx", "sources": ["B/*.xlsx", "B2/x.xlsx"], "only_error_report": true},
+      {"name": "各廠", "template": ["tpl_P1.xlsx", "tpl_P2.xlsx"], "sources": ["C/"]}
+    ]
+    相對路徑以 manifest 檔所在資料夾為準
+
+同一份來源比對多個模板（來源只讀一次，各模板平行比對，--template-workers 控制同時比對數）：
+    python batch.py --template tpl_P1.xlsx tpl_P2.xlsx --sources 來源資料夾/ --out 輸出/
+    各模板輸出到 <out>/<name>/<模板名稱>/，<out>/<name>/stats.json 另有各模板彙總
+
+供應商只重送少數檔案時，加上 --cache-dir 只重讀有變動的來源檔（--rebuild 強制全部重做）：
+    python batch.py --manifest jobs.json --out 輸出/ --cache-dir .cgmatch_cache
+
+來源檔大到記憶體放不下時加上 --stream：分批讀取，只留下對得到模板料號的列
+--reader 選讀檔引擎（auto / openpyxl / calamine），舊版 .xls 自動用 xlrd
+錯誤太多（數十萬格）時加 --error-report summary：錯誤報表只放依欄位 / 錯誤類型 / 值彙總的 ErrorSummary（both = 彙總 + 逐格）
+超大模板（數百萬列）可加 --validate-workers N：校驗分片給 N 個行程平行檢查，結果與單行程相同
+模板編譯結果預設快取在 compare_core.TEMPLATE_CACHE_DIR（--template-cache-dir 指定、--no-template-cache 停用）
+
+每個工作輸出到 <out>/<name>/：主結果、錯誤報表、stats.json
+結束碼：0 = 全部無錯誤；1 = 有校驗錯誤；2 = 有工作執行失敗
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from compare_core import (
+    ERROR_REPORT_MODES,
+    READER_ENGINES,
+    TEMPLATE_CACHE_DIR,
+    LocalFile,
+    installed_error_formats,
+    run_core_web,
+    run_multi_template,
+)
+
+SOURCE_EXTENSIONS = (".xlsx", ".xls")
+
+EXIT_OK = 0
+EXIT_HAS_ERRORS = 1
+EXIT_FAILED = 2
+
+
+def expand_sources(specs, base_dir="."):
+    """
+    來源規格 → 檔案路徑清單（依規格順序；資料夾 / glob 內依檔名排序，重複的只留第一次）
+    規格可為檔案、資料夾（取其中的 xlsx / xls）或 glob
+    """
+    paths = []
+    for spec in specs:
+        spec = os.path.join(base_dir, os.path.expanduser(spec))
+        if os.path.isdir(spec):
+            found = sorted(
+                os.path.join(spec, f) for f in os.listdir(spec)
+                if f.lower().endswith(SOURCE_EXTENSIONS) and not f.startswith("~$")
+            )
+        elif os.path.isfile(spec):
+            found = [spec]
+        else:
+            found = sorted(p for p in glob.glob(spec) if os.path.isfile(p))
+        if not found:
+            raise FileNotFoundError(f"找不到來源檔案：{spec}")
+        paths.extend(found)
+    return list(dict.fromkeys(os.path.normpath(p) for p in paths))
+
+
+def load_manifest(path):
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError("manifest 必須是工作清單（JSON array）")
+    base_dir = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for i, entry in enumerate(entries, start=1):
+        if "template" not in entry or not entry.get("sources"):
+            raise ValueError(f"manifest 第 {i} 個工作缺少 template 或 sources")
+        sources = entry["sources"]
+        if isinstance(sources, str):
+            sources = [sources]
+        template = entry["template"]
+        jobs.append({
+            "name": entry.get("name"),
+            "template": (
+                os.path.join(base_dir, template) if isinstance(template, str)
+                else [os.path.join(base_dir, t) for t in template]
+            ),
+            "sources": expand_sources(sources, base_dir),
+            "only_error_report": entry.get("only_error_report"),
+        })
+    return jobs
+
+
+def _template_paths(job):
+    """工作的模板路徑清單（template 可為單一路徑或路徑清單）"""
+    template = job["template"]
+    return [template] if isinstance(template, str) else list(template)
+
+
+def _unique_names(paths):
+    """以檔名（不含副檔名）命名；名稱重複時加上序號"""
+    used = set()
+    names = []
+    for i, path in enumerate(paths, start=1):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in used:
+            name = f"{name}_{i}"
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def _assign_job_names(jobs):
+    """未命名的工作以（第一個）模板檔名命名；名稱重複時加上序號"""
+    used = set()
+    for i, job in enumerate(jobs, start=1):
+        name = job.get("name") or os.path.splitext(os.path.basename(_template_paths(job)[0]))[0]
+        if name in used:
+            name = f"{name}_{i}"
+        used.add(name)
+        job["name"] = name
+
+
+def _write_bytes(out_dir, name, data):
+    if data is None:
+        return None
+    path = os.path.join(out_dir, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def run_job(
+    job,
+    out_root,
+    only_error_report=False,
+    error_format="xlsx",
+    error_report_mode="full",
+    full_log=False,
+    read_workers=None,
+    cache_dir=None,
+    rebuild=False,
+    stream=False,
+    reader="auto",
+    template_cache_dir=TEMPLATE_CACHE_DIR,
+    validate_workers=None,
+    template_workers=None,
+    profile=False,
+):
+    """
+    執行單一工作並寫出檔案；任何例外都記錄在回傳的 summary，不往外丟
+    工作有多個模板時來源只讀一次（run_multi_template），各模板輸出到 <name>/<模板名稱>/；不產生效能分析檔
+    """
+    start_time = time.time()
+    out_dir = os.path.join(out_root, job["name"])
+    os.makedirs(out_dir, exist_ok=True)
+    if job.get("only_error_report") is not None:
+        only_error_report = job["only_error_report"]
+
+    summary = {
+        "name": job["name"],
+        "template": job["template"],
+        "sources": job["sources"],
+        "only_error_report": only_error_report,
+    }
+    templates = _template_paths(job)
+    if len(templates) > 1:
+        return _run_multi_job(
+            job, templates, out_dir, summary, start_time,
+            only_error_report=only_error_report,
+            error_format=error_format,
+            error_report_mode=error_report_mode,
+            full_log=full_log,
+            read_workers=read_workers,
+            template_workers=template_workers,
+            cache_dir=cache_dir,
+            rebuild=rebuild,
+            stream=stream,
+            reader=reader,
+            template_cache_dir=template_cache_dir,
+            validate_workers=validate_workers,
+        )
+    try:
+        result = run_core_web(
+            source_files=[LocalFile(p) for p in job["sources"]],
+            template_file=LocalFile(templates[0]),
+            only_error_report=only_error_report,
+            read_workers=read_workers,
+            error_format=error_format,
+            error_report_mode=error_report_mode,
+            full_log=full_log,
+            cache_dir=cache_dir,
+            rebuild=rebuild,
+            stream=stream,
+            reader=reader,
+            template_cache_dir=template_cache_dir,
+            validate_workers=validate_workers,
+            profile=profile,
+        )
+    except Exception as e:
+        summary.update(status="failed", error=f"{type(e).__name__}: {e}")
+    else:
+        summary.update(
+            status="errors" if result["error_bytes"] is not None else "ok",
+            output_file=_write_bytes(out_dir, result["output_name"], result["output_bytes"]),
+            error_file=_write_bytes(out_dir, result["error_name"], result["error_bytes"]),
+            log_file=_write_bytes(out_dir, result["full_log_name"], result["full_log_bytes"]),
+            profile_file=_write_bytes(out_dir, result["profile_name"], result["profile_bytes"]),
+            stats=result["stats"],
+        )
+    return _finish_job(out_dir, summary, start_time)
+
+
+def _run_multi_job(job, templates, out_dir, summary, start_time, **kwargs):
+    """多模板工作：各模板的結果寫到 out_dir/<模板名稱>/；有任一模板有錯誤即為 errors"""
+    try:
+        multi = run_multi_template(
+            source_files=[LocalFile(p) for p in job["sources"]],
+            template_files=[LocalFile(p) for p in templates],
+            **kwargs,
+        )
+    except Exception as e:
+        summary.update(status="failed", error=f"{type(e).__name__}: {e}")
+        return _finish_job(out_dir, summary, start_time)
+
+    template_summaries = []
+    for name, path, result in zip(_unique_names(templates), templates, multi["results"]):
+        tpl_dir = os.path.join(out_dir, name)
+        os.makedirs(tpl_dir, exist_ok=True)
+        template_summaries.append({
+            "name": name,
+            "template": path,
+            "status": "errors" if result["error_bytes"] is not None else "ok",
+            "output_file": _write_bytes(tpl_dir, result["output_name"], result["output_bytes"]),
+            "error_file": _write_bytes(tpl_dir, result["error_name"], result["error_bytes"]),
+            "log_file": _write_bytes(tpl_dir, result["full_log_name"], result["full_log_bytes"]),
+            "stats": result["stats"],
+        })
+    summary.update(
+        status="errors" if any(t["status"] == "errors" for t in template_summaries) else "ok",
+        stats=multi["stats"],
+        summary=multi["summary"],
+        templates=template_summaries,
+    )
+    return _finish_job(out_dir, summary, start_time)
+
+
+def _finish_job(out_dir, summary, start_time):
+    summary["elapsed_seconds"] = round(time.time() - start_time, 2)
+
+    with open(os.path.join(out_dir, "stats.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+def run_batch(jobs, out_root, workers=None, **job_kwargs):
+    """
+    以行程池平行執行多個工作，依工作順序回傳 summary
+    多工作平行時每個工作內的來源檔改為循序讀取、多模板改為逐一比對、校驗分片行程數依工作數分攤，避免行程數相乘
+    """
+    _assign_job_names(jobs)
+    if workers is None:
+        workers = min(len(jobs), os.cpu_count() or 1)
+    if workers <= 1 or len(jobs) <= 1:
+        return [run_job(job, out_root, **job_kwargs) for job in jobs]
+    # main() 一律傳入各參數（未指定時為 None），不能用 setdefault
+    for key in ("read_workers", "validate_workers", "template_workers"):
+        if job_kwargs.get(key) is None:
+            job_kwargs[key] = 1
+    # 有指定校驗分片行程數時，各工作合計不超過 CPU 數
+    job_kwargs["validate_workers"] = min(job_kwargs["validate_workers"], max(1, (os.cpu_count() or 1) // workers))
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futures = [ex.submit(run_job, job, out_root, **job_kwargs) for job in jobs]
+        return [f.result() for f in futures]
+
+
+def exit_code(summaries):
+    if any(s["status"] == "failed" for s in summaries):
+        return EXIT_FAILED
+    if any(s["status"] == "errors" for s in summaries):
+        return EXIT_HAS_ERRORS
+    return EXIT_OK
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="產規匹配批次執行（無介面）")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--manifest", help="多工作 manifest（JSON）")
+    src.add_argument("--template", nargs="+", help="目標模板（單一工作；多個模板時來源只讀一次）")
+    parser.add_argument("--sources", nargs="+", default=[], help="來源檔案 / 資料夾 / glob（單一工作，可多個）")
+    parser.add_argument("--name", help="單一工作的輸出子資料夾名稱（預設為模板檔名）")
+    parser.add_argument("--out", default="output", help="輸出根目錄（預設 output）")
+    parser.add_argument("--jobs", type=int, default=None, help="同時執行的工作數（預設 = CPU 數）")
+    parser.add_argument("--read-workers", type=int, default=None, help="單一工作內來源檔平行讀取的行程數")
+    parser.add_argument("--template-workers", type=int, default=None, help="多模板工作同時比對的模板數（行程數）")
+    parser.add_argument("--validate-workers", type=int, default=None, help="單一工作內校驗分片的行程數（超大模板用）")
+    parser.add_argument("--only-error-report", action="store_true", help="只輸出錯誤報表（manifest 可逐一覆寫）")
+    parser.add_argument(
+        "--error-format", choices=installed_error_formats(), default="xlsx", help="錯誤報表格式（parquet 需安裝 pyarrow）"
+    )
+    parser.add_argument(
+        "--error-report", choices=list(ERROR_REPORT_MODES), default="full",
+        help="錯誤報表內容：full = 逐格 ErrorLog、summary = 依欄位 / 錯誤類型 / 值彙總、both = 兩者都輸出",
+    )
+    parser.add_argument("--full-log", action="store_true", help="另外輸出完整 LOG 檔")
+    parser.add_argument("--cache-dir", help="本機快取資料夾：沒變的來源檔不重讀、沒變的列不重新校驗")
+    parser.add_argument("--rebuild", action="store_true", help="忽略既有快取全部重做（搭配 --cache-dir）")
+    parser.add_argument("--stream", action="store_true", help="來源檔分批串流讀取（超大來源檔省記憶體）")
+    parser.add_argument("--reader", choices=list(READER_ENGINES), default="auto", help="讀檔引擎（預設 auto：有裝 calamine 就用）")
+    parser.add_argument("--template-cache-dir", default=TEMPLATE_CACHE_DIR, help="模板編譯快取資料夾（各工作 / 行程共用）")
+    parser.add_argument("--no-template-cache", action="store_true", help="不使用模板編譯快取，每次重讀模板")
+    parser.add_argument("--profile", action="store_true", help="每個工作另外輸出 cProfile 分析檔（.pstats）")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if not args.manifest and not args.sources:
+        build_parser().error("--template 需搭配 --sources")
+    # 找不到檔案 / manifest 格式錯誤屬於執行失敗（結束碼 2），不可與「有校驗錯誤」（1）混淆
+    try:
+        if args.manifest:
+            jobs = load_manifest(args.manifest)
+        else:
+            template = args.template[0] if len(args.template) == 1 else args.template
+            jobs = [{"name": args.name, "template": template, "sources": expand_sources(args.sources)}]
+    except (OSError, ValueError) as e:
+        print(f"[失敗] {type(e).__name__}: {e}", file=sys.stderr)
+        return EXIT_FAILED
+
+    start_time = time.time()
+    summaries = run_batch(
+        jobs,
+        args.out,
+        workers=args.jobs,
+        only_error_report=args.only_error_report,
+        error_format=args.error_format,
+        error_report_mode=args.error_report,
+        full_log=args.full_log,
+        read_workers=args.read_workers,
+        validate_workers=args.validate_workers,
+        template_workers=args.template_workers,
+        cache_dir=args.cache_dir,
+        rebuild=args.rebuild,
+        stream=args.stream,
+        reader=args.reader,
+        template_cache_dir=None if args.no_template_cache else args.template_cache_dir,
+        profile=args.profile,
+    )
+    elapsed = time.time() - start_time
+
+    for s in summaries:
+        if s["status"] == "failed":
+            print(f"[失敗] {s['name']}：{s['error']}")
+        else:
+            stats = s["stats"]
+            print(
+                f"[{'有錯誤' if s['status'] == 'errors' else '通過'}] {s['name']}："
+                f"錯誤格數 {stats['錯誤格數（cell 維度）']}、來源檢查錯誤 {stats['來源資料檢查錯誤（欄位/料號）']}，"
+                f"{s['elapsed_seconds']:.2f} 秒"
+            )
+    per_minute = len(summaries) / elapsed * 60 if elapsed > 0 else float("inf")
+    print(f"=== 共 {len(summaries)} 個工作，{elapsed:.2f} 秒，{per_minute:.1f} 工作/分鐘 ===")
+    return exit_code(summaries)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
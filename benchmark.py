@@ -0,0 +1,462 @@
+"""
+compare_core 效能量測：合成測試資料 + 各階段耗時 / 記憶體峰值
+
+    python benchmark.py                               # 預設案例（small、medium）
+    python benchmark.py --cases small medium large
+    python benchmark.py --rows 50000 --cols 30 --files 8 --dup-rate 0.01 --error-rate 0.05
+    python benchmark.py --save-baseline               # 存成比較基準
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.2
+    python benchmark.py --readers openpyxl calamine       # 同一份測試資料逐一換讀檔引擎，比較讀檔耗時
+    python benchmark.py --cases small --check-stream      # 不量測：檢查串流讀取與一般讀取的結果相同
+
+測試資料（同樣參數 + seed 產出的內容完全相同）：
+    來源檔：Cover + Data 兩個頁籤（讀最後一個），第 1 列欄名、第 2~7 列說明、第 8 列開始資料
+    模板：Sheet1 第 1 列欄名、第 4 列型別、第 5 列長度、第 6 列必填 V、第 7 列開始 B 欄料號；Sheet2 第 5 列開始選項
+    dup-rate：模板 B 欄 / 來源料號重複的比例；error-rate：每格故意填錯（空白、太長、非數字、日期錯、不在選項）的機率
+    Count 欄為整數夾空白、Weight 欄為小數夾整數值（不填錯），檢查串流讀取不會把 1 讀成 1.0
+
+每個案例在獨立行程執行（記憶體峰值 = 該行程的最大 RSS），重複 --repeat 次取各階段最小值
+結果寫成 JSON；有 --baseline 時逐案例 / 階段比較，變慢超過 tolerance 的列出來，結束碼 1
+指定 --readers 時每個案例依引擎各跑一次，案例名稱為「案例@引擎」
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import xlsxwriter
+
+from compare_core import (
+    ERROR_REPORT_FORMATS,
+    READER_ENGINES,
+    RUN_STAGES,
+    LocalFile,
+    peak_rss_mb,
+    reader_engine_installed,
+    run_core_web,
+)
+
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+# 預設案例：rows 為每個來源檔的資料列數
+BENCH_CASES = {
+    "small": dict(rows=2_000, cols=20, files=3),
+    "medium": dict(rows=20_000, cols=30, files=5),
+    "large": dict(rows=100_000, cols=40, files=10),
+}
+CASE_DEFAULTS = dict(dup_rate=0.01, error_rate=0.05, seed=0)
+
+# 欄位型別輪替：(名稱前綴, 型別, 長度, 必填)
+_COLUMN_KINDS = (
+    ("Text", "CHAR", 20, False),
+    ("Qty", "NUM", 8, True),
+    ("Price", "NUM(13,3)", "(13,3)", False),
+    ("StartDate", "DATE", 10, False),
+    ("Unit", "CHAR", 4, True),
+    ("Remark", "CHAR", 40, False),
+    ("Count", "NUM", 8, False),
+    ("Weight", "NUM(13,3)", "(13,3)", False),
+)
+_OPTION_VALUES = ["PC", "KG", "M", "EA", "SET", "BOX"]
+# 固定的文件屬性時間，讓同樣內容產出的檔案 bytes 也相同
+_FIXED_CREATED = datetime(2024, 1, 1)
+
+
+def _columns(cols):
+    """第 1 欄 Plant、第 2 欄 SAP 料號，其餘依 _COLUMN_KINDS 輪替"""
+    columns = [("Plant", "CHAR", 4, True), ("SAP_Material", "CHAR", 18, True)]
+    for i in range(max(cols - 2, 0)):
+        prefix, type_code, length, required = _COLUMN_KINDS[i % len(_COLUMN_KINDS)]
+        columns.append((f"{prefix}{i // len(_COLUMN_KINDS) + 1}", type_code, length, required))
+    return columns
+
+
+def _column_values(rng, type_code, name, n, error_rate):
+    """一欄的合法值，再依 error_rate 換成錯誤值（object ndarray，None = 空白）"""
+    if name.startswith("Count"):
+        # 整數夾空白（非必填，不填錯）
+        values = rng.integers(0, 10_000, n).astype(object)
+        values[rng.random(n) < 0.2] = None
+        return values
+    if name.startswith("Weight"):
+        # 小數夾整數值（3.0 在 Excel 存成 3，應讀成 3 而不是 3.0）
+        values = np.round(rng.uniform(0, 1_000, n), 3)
+        whole = rng.random(n) < 0.3
+        values[whole] = np.floor(values[whole])
+        return values.astype(object)
+    if type_code == "NUM":
+        values = rng.integers(0, 10_000_000, n).astype(object)
+        bad = np.array(["12a", "1234567890", "-", "1.2.3"], dtype=object)
+    elif type_code.startswith("NUM("):
+        values = np.round(rng.uniform(0, 1_000_000, n), 3).astype(object)
+        bad = np.array(["abc", "12345678901234.5", "1.23456"], dtype=object)
+    elif type_code == "DATE":
+        days = rng.integers(0, 3650, n)
+        values = np.array([f"2020/{1 + d % 12}/{1 + d % 28}" for d in days], dtype=object)
+        bad = np.array(["not a date", "2024/13/45", "31-31-2024"], dtype=object)
+    elif name.startswith("Unit"):
+        values = rng.choice(np.array(_OPTION_VALUES, dtype=object), n)
+        bad = np.array(["LB", "pcs", "XX"], dtype=object)
+    else:
+        alphabet = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"), dtype=object)
+        lengths = rng.integers(3, 10, n)
+        chars = rng.choice(alphabet, (n, 10))
+        values = np.array(["".join(row[:k]) for row, k in zip(chars, lengths)], dtype=object)
+        bad = np.array(["X" * 60, "tab\there\n" * 8], dtype=object)
+
+    n_bad = int(round(n * error_rate))
+    if n_bad:
+        pos = rng.choice(n, n_bad, replace=False)
+        picks = rng.integers(0, len(bad) + 1, n_bad)
+        values[pos] = np.where(picks == len(bad), None, bad[np.minimum(picks, len(bad) - 1)])
+    return values
+
+
+def _new_workbook(path):
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    wb.set_properties({"created": _FIXED_CREATED})
+    return wb
+
+
+def generate_case(out_dir, rows=2_000, cols=20, files=3, dup_rate=0.01, error_rate=0.05, seed=0):
+    """
+    產生 files 個來源檔 + 1 個模板到 out_dir，回傳 (來源檔路徑清單, 模板路徑)
+    同樣參數已產生過（out_dir 內有完成標記）就直接沿用
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    sources = [os.path.join(out_dir, f"src{i:02d}.xlsx") for i in range(files)]
+    template = os.path.join(out_dir, "tpl.xlsx")
+    done_marker = os.path.join(out_dir, ".done")
+    if os.path.exists(done_marker):
+        return sources, template
+
+    rng = np.random.default_rng(seed)
+    columns = _columns(cols)
+    n_total = rows * files
+    saps = np.array([f"M{10_000_000 + i}" for i in range(n_total)], dtype=object)
+
+    # 來源：料號依 dup_rate 換成其他列的料號（同料號以第一次出現的為準）
+    src_saps = saps.copy()
+    n_dup = int(round(n_total * dup_rate))
+    if n_dup:
+        src_saps[rng.choice(n_total, n_dup, replace=False)] = saps[rng.integers(0, n_total, n_dup)]
+
+    for f, path in enumerate(sources):
+        lo, hi = f * rows, (f + 1) * rows
+        wb = _new_workbook(path)
+        wb.add_worksheet("Cover").write(0, 0, "benchmark data")
+        ws = wb.add_worksheet("Data")
+        data = [src_saps[lo:hi] if name == "SAP_Material" else
+                _column_values(rng, type_code, name, rows, error_rate)
+                for name, type_code, _, _ in columns]
+        for c, (name, *_rest) in enumerate(columns):
+            ws.write_string(0, c, name)
+        for r in range(1, 7):
+            ws.write_string(r, 0, f"說明 {r + 1}")
+        for i in range(rows):
+            for c, col in enumerate(data):
+                v = col[i]
+                if v is not None:
+                    ws.write(7 + i, c, v)
+        wb.close()
+
+    # 模板：料號打散，依 dup_rate 複製部分料號（SAP 重複），另加少量來源沒有的料號
+    tpl_saps = saps[rng.permutation(n_total)]
+    extra = [f"X{i}" for i in range(max(1, n_total // 1000))]
+    dups = tpl_saps[rng.integers(0, n_total, n_dup)] if n_dup else np.empty(0, dtype=object)
+    tpl_saps = np.concatenate([tpl_saps, dups, np.array(extra, dtype=object)])
+    tpl_saps = tpl_saps[rng.permutation(len(tpl_saps))]
+
+    # constant_memory 只能由上往下逐列寫（寫到下一列後前一列就寫不回去），表頭各列要整列寫
+    wb = _new_workbook(template)
+    ws = wb.add_worksheet("Sheet1")
+    ws.write_row(0, 0, [name for name, *_ in columns])
+    ws.write_string(1, 0, "說明")
+    ws.write_row(3, 0, [type_code for _, type_code, _, _ in columns])
+    ws.write_row(4, 0, [length for _, _, length, _ in columns])
+    ws.write_row(5, 0, ["V" if required else None for *_, required in columns])
+    for i, sap in enumerate(tpl_saps):
+        ws.write_row(6 + i, 0, ["P001", sap])
+    ws2 = wb.add_worksheet("Sheet2")
+    option_cols = [name for name, *_ in columns if name.startswith("Unit")]
+    ws2.write_row(0, 0, option_cols)
+    for i, opt in enumerate(_OPTION_VALUES):
+        ws2.write_row(4 + i, 0, [opt] * len(option_cols))
+    wb.close()
+
+    header = pd.read_excel(template, sheet_name=0, header=None, nrows=1).iloc[0].tolist()
+    assert header == [name for name, *_ in columns], f"模板表頭寫入不完整：{header}"
+
+    with open(done_marker, "w", encoding="utf-8") as f:
+        f.write("ok")
+    return sources, template
+
+
+def _run_peak_mb(stages):
+    """整次執行的記憶體峰值：各階段峰值取最大（階段峰值會重設行程峰值，不能再讀 peak_rss_mb）"""
+    peaks = [r["記憶體峰值(MB)"] for r in stages if r["記憶體峰值(MB)"] is not None]
+    return max(peaks) if peaks else peak_rss_mb()
+
+
+def _run_once(sources, template, only_error_report, error_format, read_workers, reader="auto"):
+    """在獨立行程中執行一次 run_core_web，回傳各階段耗時與記憶體峰值"""
+    t0 = time.perf_counter()
+    result = run_core_web(
+        [LocalFile(p) for p in sources],
+        LocalFile(template),
+        only_error_report=only_error_report,
+        error_format=error_format,
+        read_workers=read_workers,
+        reader=reader,
+        template_cache_dir=None,
+    )
+    return {
+        "reader": result["stats"]["讀檔引擎"],
+        "stages": result["timings"],
+        "total": time.perf_counter() - t0,
+        "peak_rss_mb": _run_peak_mb(result["stats"]["階段明細"]),
+        "error_cells": result["stats"]["錯誤格數（cell 維度）"],
+        "matched_rows": result["stats"]["參與匹配的模板列數"],
+    }
+
+
+_VOLATILE_STATS = ("耗時(秒)", "階段明細", "讀檔引擎", "校驗快取")
+
+
+def _report_cells(result):
+    """主結果 / 錯誤報表（xlsx）各頁籤的儲存格值；檔案 bytes 含產生時間，不能直接比"""
+    cells = {}
+    for kind in ("output", "error"):
+        data = result[f"{kind}_bytes"]
+        if data is None:
+            continue
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+        try:
+            for ws in wb.worksheets:
+                cells[f"{kind}/{ws.title}"] = list(ws.iter_rows(values_only=True))
+        finally:
+            wb.close()
+    return cells
+
+
+def check_stream(sources, template):
+    """同一份資料一般讀取與串流讀取（stream=True）的統計、主結果、錯誤報表必須相同；回傳差異說明（空 = 相同）"""
+    results = [
+        run_core_web([LocalFile(p) for p in sources], LocalFile(template), stream=stream, template_cache_dir=None)
+        for stream in (False, True)
+    ]
+    plain, streamed = results
+    diffs = [
+        f"stats[{key}]：{plain['stats'][key]} ≠ {streamed['stats'].get(key)}"
+        for key in plain["stats"]
+        if key not in _VOLATILE_STATS and plain["stats"][key] != streamed["stats"].get(key)
+    ]
+    plain_cells, stream_cells = _report_cells(plain), _report_cells(streamed)
+    for sheet in dict.fromkeys(list(plain_cells) + list(stream_cells)):
+        a, b = plain_cells.get(sheet), stream_cells.get(sheet)
+        if a is None or b is None:
+            diffs.append(f"{sheet}：只有{'串流' if a is None else '一般'}讀取有這個頁籤")
+            continue
+        if len(a) != len(b):
+            diffs.append(f"{sheet}：列數 {len(a)} ≠ {len(b)}")
+        for r, (row_a, row_b) in enumerate(zip(a, b), start=1):
+            if row_a != row_b:
+                diffs.append(f"{sheet} 第 {r} 列：{row_a} ≠ {row_b}")
+                break
+    return diffs
+
+
+def run_case(params, data_dir, repeat=1, only_error_report=False, error_format="xlsx", read_workers=1, reader="auto"):
+    """產生（或沿用）測試資料後執行 repeat 次，各階段取最小值、記憶體取最大值"""
+    key = "r{rows}_c{cols}_f{files}_d{dup_rate}_e{error_rate}_s{seed}".format(**params)
+    t0 = time.perf_counter()
+    sources, template = generate_case(os.path.join(data_dir, key), **params)
+    generate_seconds = time.perf_counter() - t0
+
+    ctx = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as ex:
+            runs.append(
+                ex.submit(_run_once, sources, template, only_error_report, error_format, read_workers, reader).result()
+            )
+
+    peaks = [r["peak_rss_mb"] for r in runs if r["peak_rss_mb"] is not None]
+    return {
+        "params": params,
+        "reader": runs[0]["reader"],
+        "source_rows": params["rows"] * params["files"],
+        "matched_rows": runs[0]["matched_rows"],
+        "error_cells": runs[0]["error_cells"],
+        "generate_seconds": round(generate_seconds, 3),
+        "stages": {stage: round(min(r["stages"].get(stage, 0.0) for r in runs), 4) for stage in RUN_STAGES},
+        "total": round(min(r["total"] for r in runs), 4),
+        "peak_rss_mb": max(peaks) if peaks else None,
+    }
+
+
+def compare_results(current, baseline, tolerance=0.2, min_seconds=0.05):
+    """
+    逐案例 / 階段與基準比較：變慢超過 tolerance（比例）且差距超過 min_seconds 視為退步
+    記憶體峰值增加超過 tolerance 也算；回傳退步說明清單
+    """
+    regressions = []
+    for name, case in current["cases"].items():
+        base = baseline.get("cases", {}).get(name)
+        if base is None:
+            continue
+        if base.get("params") != case["params"]:
+            print(f"[略過] {name}：參數與基準不同，不比較")
+            continue
+        checks = [(f"{name}.{stage}", case["stages"][stage], base["stages"].get(stage)) for stage in RUN_STAGES]
+        checks.append((f"{name}.total", case["total"], base.get("total")))
+        for label, now, before in checks:
+            if before is not None and now > before * (1 + tolerance) and now - before > min_seconds:
+                regressions.append(f"{label}：{before:.3f} → {now:.3f} 秒")
+        now, before = case.get("peak_rss_mb"), base.get("peak_rss_mb")
+        if now is not None and before and now > before * (1 + tolerance):
+            regressions.append(f"{name}.peak_rss：{before:.1f} → {now:.1f} MB")
+    return regressions
+
+
+def reader_report(cases):
+    """同一份資料換引擎的讀檔耗時比較（以第一個引擎為基準），回傳說明行"""
+    groups = {}
+    for label, case in cases.items():
+        name, _, reader = label.partition("@")
+        if reader:
+            groups.setdefault(name, []).append((reader, case["stages"]["read"]))
+    lines = []
+    for name, timings in groups.items():
+        if len(timings) < 2:
+            continue
+        base = timings[0][1]
+        parts = [
+            f"{reader} {seconds:.2f} 秒" + (f"（{base / seconds:.1f}x）" if i and seconds > 0 else "")
+            for i, (reader, seconds) in enumerate(timings)
+        ]
+        lines.append(f"[{name}] 讀檔：" + "、".join(parts))
+    return lines
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="compare_core 各階段效能量測")
+    parser.add_argument("--cases", nargs="+", choices=list(BENCH_CASES), default=["small", "medium"], help="預設案例")
+    parser.add_argument("--rows", type=int, help="自訂案例：每個來源檔的資料列數（指定後只跑自訂案例）")
+    parser.add_argument("--cols", type=int, default=20, help="自訂案例：欄數")
+    parser.add_argument("--files", type=int, default=3, help="自訂案例：來源檔數")
+    parser.add_argument("--dup-rate", type=float, default=CASE_DEFAULTS["dup_rate"], help="料號重複比例")
+    parser.add_argument("--error-rate", type=float, default=CASE_DEFAULTS["error_rate"], help="每格填錯機率")
+    parser.add_argument("--seed", type=int, default=CASE_DEFAULTS["seed"])
+    parser.add_argument("--repeat", type=int, default=1, help="每個案例重複次數（取最小值）")
+    parser.add_argument("--read-workers", type=int, default=1, help="來源檔平行讀取行程數（預設 1，數字較穩定）")
+    parser.add_argument("--error-format", choices=list(ERROR_REPORT_FORMATS), default="xlsx", help="錯誤報表格式")
+    parser.add_argument("--only-error-report", action="store_true")
+    parser.add_argument("--readers", nargs="+", choices=list(READER_ENGINES), help="逐一比較的讀檔引擎（預設只跑 auto）")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "cgmatch_bench"), help="測試資料存放位置")
+    parser.add_argument("--output", default="benchmark_result.json", help="結果 JSON")
+    parser.add_argument("--baseline", help="比較基準 JSON（預設有 benchmark_baseline.json 就比較）")
+    parser.add_argument("--save-baseline", action="store_true", help="把這次結果存成比較基準")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="容許變慢比例（預設 0.2 = 20%%）")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="差距小於此秒數不算退步")
+    parser.add_argument("--check-stream", action="store_true", help="不量測：檢查串流讀取與一般讀取的結果相同（有差異時結束碼 1）")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.rows is not None:
+        cases = {"custom": dict(rows=args.rows, cols=args.cols, files=args.files)}
+    else:
+        cases = {name: dict(BENCH_CASES[name]) for name in args.cases}
+    for params in cases.values():
+        params.update(dup_rate=args.dup_rate, error_rate=args.error_rate, seed=args.seed)
+    if args.check_stream:
+        failed = 0
+        for name, params in cases.items():
+            key = "r{rows}_c{cols}_f{files}_d{dup_rate}_e{error_rate}_s{seed}".format(**params)
+            diffs = check_stream(*generate_case(os.path.join(args.data_dir, key), **params))
+            print(f"[{name}] 串流讀取與一般讀取：" + ("相同" if not diffs else f"{len(diffs)} 項差異"))
+            for line in diffs:
+                print(f"  {line}")
+            failed += bool(diffs)
+        return 1 if failed else 0
+
+    readers = ["auto"]
+    if args.readers:
+        readers = [r for r in dict.fromkeys(args.readers) if r == "auto" or reader_engine_installed(r)]
+        for r in dict.fromkeys(args.readers):
+            if r not in readers:
+                print(f"[略過] 讀檔引擎 {r} 未安裝")
+
+    result = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "cases": {},
+    }
+    for name, params in cases.items():
+        for reader in readers:
+            label = f"{name}@{reader}" if args.readers else name
+            case = run_case(
+                params,
+                args.data_dir,
+                repeat=args.repeat,
+                only_error_report=args.only_error_report,
+                error_format=args.error_format,
+                read_workers=args.read_workers,
+                reader=reader,
+            )
+            result["cases"][label] = case
+            stages = "、".join(f"{stage} {case['stages'][stage]:.2f}" for stage in RUN_STAGES)
+            peak = f"{case['peak_rss_mb']:.0f} MB" if case["peak_rss_mb"] is not None else "-"
+            print(
+                f"[{label}] {case['source_rows']} 列（{case['reader']}）：共 {case['total']:.2f} 秒（{stages}），"
+                f"記憶體峰值 {peak}"
+            )
+    for line in reader_report(result["cases"]):
+        print(line)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"結果：{args.output}")
+
+    if args.save_baseline:
+        path = args.baseline or DEFAULT_BASELINE
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"已存為比較基準：{path}")
+        return 0
+
+    baseline_path = args.baseline or (DEFAULT_BASELINE if os.path.exists(DEFAULT_BASELINE) else None)
+    if baseline_path is None:
+        return 0
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare_results(result, baseline, args.tolerance, args.min_seconds)
+    if regressions:
+        print(f"=== 與基準 {baseline_path} 比較：{len(regressions)} 項退步 ===")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"=== 與基準 {baseline_path} 比較：無退步 ===")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
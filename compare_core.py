@@ -1,14 +1,47 @@
+import cProfile
+import csv
+import hashlib
+import importlib.util
 import io
+import multiprocessing
+import os
+import pickle
+import pstats
 import re
+import stat
+import sys
+import tempfile
 import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from dataclasses import dataclass
+from itertools import chain, islice
+import numpy as np
+import openpyxl
 import pandas as pd
+from pandas.io.parsers import TextParser
 from datetime import datetime, timedelta
 import xlsxwriter
 
+try:
+    import resource
+except ImportError:  # Windows 沒有 resource，記憶體峰值記為 None
+    resource = None
+
 # 來源資料：實際資料從 Excel 第幾列開始（你的來源是第 8 列）
 SOURCE_FIRST_DATA_EXCEL_ROW = 8
 
+# 來源檔平行讀取的行程數（None = 依檔案數與 CPU 核心數自動決定；1 = 不開子行程）
+SOURCE_READ_WORKERS = None
+
 _X000D_RE = re.compile(r"_x000D_", re.IGNORECASE)
+_CTRL_RE = re.compile(r"[\x00-\x1F\x7F]")
+# clean_text 的刪除規則合成一個 pattern（_x000D_ 與控制字元不會重疊，一次刪除 = 依序刪除）
+_CLEAN_RE = re.compile(r"_x000D_|[\x00-\x1F\x7F]", re.IGNORECASE)
+
+# 已清洗過的 DataFrame / Series 會在 attrs 標記，避免重複清洗
+_CLEANED_ATTR = "cgmatch_cleaned"
 
 def is_empty(val):
     return (
@@ -33,41 +66,102 @@ def clean_text(val):
     s = s.replace("\t", "").replace("\n", "").replace("\r", "")
 
     # 3) 其他控制字元
-    s = re.sub(r"[\x00-\x1F\x7F]", "", s)
+    s = _CTRL_RE.sub("", s)
 
     s = s.strip()
     return s if s else None
 
-def normalize_date(val):
-    if val is None or (isinstance(val, float) and pd.isna(val)):
-        return None
-
-    # Excel serial
-    if isinstance(val, (int, float)):
-        try:
-            iv = int(val)
-            if 30000 <= iv <= 60000:
-                base = datetime(1899, 12, 30)
-                dt = base + timedelta(days=iv)
-                return dt.strftime("%Y%m%d")
-        except Exception:
-            pass
+def _clean_str_values(values):
+    """
+    純字串 object 陣列：去重後用 pandas 字串運算清洗，再展開回原長度
+    """
+    codes, uniques = pd.factorize(values)
+    cleaned = (
+        pd.Series(uniques, dtype=object)
+        .str.replace(_CLEAN_RE, "", regex=True)
+        .str.strip()
+        .to_numpy(dtype=object, copy=True)
+    )
+    cleaned[cleaned == ""] = None
+    return cleaned[codes]
 
-    s = str(val).strip()
+def clean_series(s: pd.Series) -> pd.Series:
+    """
+    欄位版 clean_text：結果與逐格 clean_text 相同（空白 → None），回傳 object 欄位
+    已標記清洗過的欄位直接回傳
+    """
+    if s.attrs.get(_CLEANED_ATTR):
+        return s
 
-    if re.fullmatch(r"\d{8}", s):
+    if not (pd.api.types.is_object_dtype(s.dtype) or pd.api.types.is_string_dtype(s.dtype)):
+        # 數字 / 日期 / 布林欄：不會有控制字元，只需對不重複值轉字串
+        codes, uniques = pd.factorize(s, use_na_sentinel=False)
+        cleaned = np.array([clean_text(u) for u in uniques] + [None], dtype=object)[:-1]
+        out = cleaned[codes]
+    else:
+        values = s.to_numpy(dtype=object)
+        out = np.full(len(values), None, dtype=object)
+        kind = pd.api.types.infer_dtype(values, skipna=True)
+        if kind == "string":
+            is_str = ~pd.isna(values)
+        elif kind == "empty":
+            is_str = np.zeros(len(values), dtype=bool)
+        else:
+            is_str = np.fromiter(map(type, values), dtype=object, count=len(values)) == str
+            # 混型欄位的數字 / 日期：依 (型別, 值) 快取，同值只轉一次
+            memo = {}
+            for i in np.flatnonzero(~is_str & ~pd.isna(values)):
+                v = values[i]
+                key = (type(v), v)
+                if key not in memo:
+                    memo[key] = clean_text(v)
+                out[i] = memo[key]
+        if is_str.any():
+            out[is_str] = _clean_str_values(values[is_str])
+
+    result = pd.Series(out, index=s.index, name=s.name, dtype=object)
+    result.attrs[_CLEANED_ATTR] = True
+    return result
+
+def clean_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    整張表逐欄清洗（等同 df.map(clean_text)），欄名可重複
+    """
+    if df.attrs.get(_CLEANED_ATTR):
+        return df
+    out = pd.DataFrame(
+        {i: clean_series(df.iloc[:, i]) for i in range(df.shape[1])},
+        index=df.index,
+    )
+    out.columns = df.columns
+    out.attrs[_CLEANED_ATTR] = True
+    return out
+
+_DATE_8_RE = re.compile(r"\d{8}")
+_DATE_YMD_RE = re.compile(r"\d{4}[-/\.]\d{1,2}[-/\.]\d{1,2}")
+_DATE_YMD_TIME_RE = re.compile(r"\d{4}[-/]\d{1,2}[-/]\d{1,2} \d{2}:\d{2}:\d{2}")
+_DATE_DMY_RE = re.compile(r"\d{1,2}/\d{1,2}/\d{4}")
+_DATE_YY_RE = re.compile(r"\d{2}/\d{2}/\d{2}")
+_DATE_SEP_RE = re.compile(r"[-/\.]")
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+
+def _normalize_date_text(s):
+    """
+    normalize_date 的字串部分（s 已 strip）
+    """
+    if _DATE_8_RE.fullmatch(s):
         return s
 
-    if re.fullmatch(r"\d{4}[-/\.]\d{1,2}[-/\.]\d{1,2}", s):
-        y, m, d = re.split(r"[-/\.]", s)
+    if _DATE_YMD_RE.fullmatch(s):
+        y, m, d = _DATE_SEP_RE.split(s)
         return f"{y}{m.zfill(2)}{d.zfill(2)}"
 
-    if re.fullmatch(r"\d{4}[-/]\d{1,2}[-/]\d{1,2} \d{2}:\d{2}:\d{2}", s):
+    if _DATE_YMD_TIME_RE.fullmatch(s):
         date_part = s.split()[0]
-        y, m, d = re.split(r"[-/]", date_part)
+        y, m, d = _DATE_SEP_RE.split(date_part)
         return f"{y}{m.zfill(2)}{d.zfill(2)}"
 
-    if re.fullmatch(r"\d{1,2}/\d{1,2}/\d{4}", s):
+    if _DATE_DMY_RE.fullmatch(s):
         a, b, y = s.split("/")
         a_i, b_i = int(a), int(b)
         if a_i > 12:
@@ -78,7 +172,7 @@ def normalize_date(val):
             d, m = a, b
         return f"{y}{m.zfill(2)}{d.zfill(2)}"
 
-    if re.fullmatch(r"\d{2}/\d{2}/\d{2}", s):
+    if _DATE_YY_RE.fullmatch(s):
         y, m, d = s.split("/")
         y_i = int(y)
         year = 2000 + y_i if y_i <= 50 else 1900 + y_i
@@ -86,41 +180,101 @@ def normalize_date(val):
 
     return s
 
-def check_format(value, type_code):
-    if value is None:
-        return True, None
+def normalize_date(val):
+    if val is None or (isinstance(val, float) and pd.isna(val)):
+        return None
 
-    s = str(value).strip()
-    if s == "":
-        return True, None
+    # Excel serial
+    if isinstance(val, (int, float)):
+        try:
+            iv = int(val)
+            if 30000 <= iv <= 60000:
+                dt = _EXCEL_EPOCH + timedelta(days=iv)
+                return dt.strftime("%Y%m%d")
+        except Exception:
+            pass
 
-    t_raw = str(type_code).strip().upper()
+    return _normalize_date_text(str(val).strip())
 
-    base_type = None
-    precision = None
-    scale = None
+def normalize_date_values(values):
+    """
+    整欄版 normalize_date：只對不重複值計算再展開，結果與逐格 normalize_date 相同
+    字串走預編譯 pattern；int / float 的 Excel 序號整批換算
+    """
+    values = np.asarray(values, dtype=object)
+    out = np.full(len(values), None, dtype=object)
+    if not len(values):
+        return out
+
+    kinds = np.fromiter(map(type, values), dtype=object, count=len(values))
+    is_str = kinds == str
+    if is_str.any():
+        codes, uniques = pd.factorize(values[is_str])
+        normalized = [_normalize_date_text(u.strip()) for u in uniques]
+        out[is_str] = np.array(normalized + [None], dtype=object)[:-1][codes]
+
+    is_num = (kinds == int) | (kinds == float)
+    serial = np.zeros(len(values), dtype=bool)
+    if is_num.any():
+        num_pos = np.flatnonzero(is_num)
+        try:
+            nums = values[num_pos].astype(float)
+        except OverflowError:  # 超大整數：交給下面逐值換算
+            nums = np.full(len(num_pos), np.nan)
+        with np.errstate(invalid="ignore"):
+            iv = np.trunc(nums)
+            in_range = (iv >= 30000) & (iv <= 60000)
+        if in_range.any():
+            days = iv[in_range].astype("timedelta64[D]")
+            out[num_pos[in_range]] = pd.DatetimeIndex(np.datetime64(_EXCEL_EPOCH, "D") + days).strftime("%Y%m%d").to_numpy(dtype=object)
+            serial[num_pos[in_range]] = True
+
+    # 其他（序號範圍外的數字、datetime、布林…）：依 (型別, 值) 快取逐值換算
+    memo = {}
+    for i in np.flatnonzero(~is_str & ~serial):
+        v = values[i]
+        key = (type(v), v)
+        if key not in memo:
+            memo[key] = normalize_date(v)
+        out[i] = memo[key]
+    return out
+
+_NUM_TYPE_RE = re.compile(r"(NUM|NUMBER)\s*\(\s*([0-9]+)\s*[,，\.]\s*([0-9]+)\s*\)")
+_NUM_FORMAT_RE = re.compile(r"[+-]?[0-9]+(\.[0-9]+)?")
+_DATE_FORMAT_PATTERNS = [
+    r"\d{8}",
+    r"\d{4}[-/\.]\d{1,2}[-/\.]\d{1,2}",
+    r"\d{4}[-/]\d{1,2}[-/]\d{1,2} \d{2}:\d{2}:\d{2}",
+    r"\d{2}/\d{2}/\d{2}",
+    r"\d{1,2}/\d{1,2}/\d{4}",
+]
+# fullmatch 任一 pattern ⇔ fullmatch 整個 alternation
+_DATE_FORMAT_RE = re.compile("|".join(f"(?:{p})" for p in _DATE_FORMAT_PATTERNS))
+
+def _parse_type_code(type_code):
+    """
+    模板第 4 列型別 → (base_type, precision, scale)；base_type 為 CHAR / NUM / DATE
+    """
+    t_raw = str(type_code).strip().upper()
 
-    m = re.search(r"(NUM|NUMBER)\s*\(\s*([0-9]+)\s*[,，\.]\s*([0-9]+)\s*\)", t_raw)
+    m = _NUM_TYPE_RE.search(t_raw)
     if m:
-        base_type = "NUM"
-        precision = int(m.group(2))
-        scale = int(m.group(3))
-    else:
-        if t_raw.startswith("CHAR"):
-            base_type = "CHAR"
-        elif t_raw.startswith("NUM") or t_raw.startswith("NUMBER"):
-            base_type = "NUM"
-        elif "DATE" in t_raw:
-            base_type = "DATE"
-        else:
-            base_type = "CHAR"
-
-    if base_type == "CHAR":
-        return True, None
-
+        return "NUM", int(m.group(2)), int(m.group(3))
+    if t_raw.startswith("CHAR"):
+        return "CHAR", None, None
+    if t_raw.startswith("NUM") or t_raw.startswith("NUMBER"):
+        return "NUM", None, None
+    if "DATE" in t_raw:
+        return "DATE", None, None
+    return "CHAR", None, None
+
+def _format_error(s, base_type, precision=None, scale=None):
+    """
+    s 為已 strip 的非空字串；符合格式回傳 None，否則回傳錯誤說明
+    """
     if base_type == "NUM":
-        if not re.fullmatch(r"[+-]?[0-9]+(\.[0-9]+)?", s):
-            return False, f"格式應為數字(NUM)，實際：{s}"
+        if not _NUM_FORMAT_RE.fullmatch(s):
+            return f"格式應為數字(NUM)，實際：{s}"
 
         num = s.lstrip("+-")
         if "." in num:
@@ -133,42 +287,48 @@ def check_format(value, type_code):
         total_digits = int_digits + frac_digits
 
         if precision is not None and total_digits > precision:
-            return False, f"數字總位數超過限制：{total_digits}/{precision}（值：{s}）"
+            return f"數字總位數超過限制：{total_digits}/{precision}（值：{s}）"
 
         if scale is not None and frac_digits > scale:
-            return False, f"小數位數超過限制：{frac_digits}/{scale}（值：{s}）"
+            return f"小數位數超過限制：{frac_digits}/{scale}（值：{s}）"
 
-        return True, None
+        return None
 
     if base_type == "DATE":
-        patterns = [
-            r"\d{8}",
-            r"\d{4}[-/\.]\d{1,2}[-/\.]\d{1,2}",
-            r"\d{4}[-/]\d{1,2}[-/]\d{1,2} \d{2}:\d{2}:\d{2}",
-            r"\d{2}/\d{2}/\d{2}",
-            r"\d{1,2}/\d{1,2}/\d{4}",
-        ]
-        if any(re.fullmatch(p, s) for p in patterns):
-            return True, None
-        return False, f"格式應為日期(DATE)，實際：{s}"
+        if _DATE_FORMAT_RE.fullmatch(s):
+            return None
+        return f"格式應為日期(DATE)，實際：{s}"
+
+    return None
+
+def check_format(value, type_code):
+    if value is None:
+        return True, None
+
+    s = str(value).strip()
+    if s == "":
+        return True, None
 
+    err = _format_error(s, *_parse_type_code(type_code))
+    if err is not None:
+        return False, err
     return True, None
 
 def to_excel_text(val):
     if val is None or (isinstance(val, float) and pd.isna(val)):
         return ""
     s = str(val)
-    s = re.sub(r"[\x00-\x1F\x7F]", "", s)
+    s = _CTRL_RE.sub("", s)
     return s
 
+def is_source_sap_column(col):
+    name = str(col).upper()
+    if "SAP" in name and ("物料" in name or "料號" in name or "MATERIAL" in name):
+        return True
+    return name == "SAP_MATERIAL"
+
 def find_source_sap_column(df: pd.DataFrame):
-    candidates = []
-    for col in df.columns:
-        name = str(col).upper()
-        if "SAP" in name and ("物料" in name or "料號" in name or "MATERIAL" in name):
-            candidates.append(col)
-        elif name == "SAP_MATERIAL":
-            candidates.append(col)
+    candidates = [col for col in df.columns if is_source_sap_column(col)]
     return candidates[0] if candidates else None
 
 def get_source_sap_series(df: pd.DataFrame) -> pd.Series:
@@ -179,44 +339,1543 @@ def get_source_sap_series(df: pd.DataFrame) -> pd.Series:
         return df.iloc[:, 1]
     return pd.Series([None] * len(df), index=df.index)
 
-def _read_excel_bytes(file_bytes: bytes, sheet_name=None, header=None):
-    bio = io.BytesIO(file_bytes)
-    return pd.read_excel(bio, sheet_name=sheet_name, header=header, engine="openpyxl")
+# --------------------------------------------------
+# 模板規則編譯（第 4~6 列 + Sheet2 選項）與整欄校驗
+# --------------------------------------------------
+_NUM_LENGTH_SPEC_RE = re.compile(r"\(\s*(\d+)\s*,\s*(\d+)\s*\)")
+
+# 錯誤代碼 → ErrorType（NUM(整數位,小數位) 不是數字時記為格式錯誤）
+ERR_REQUIRED, ERR_OPTION, ERR_LENGTH, ERR_NOT_NUMBER, ERR_FORMAT, ERR_SAP_DUP = range(6)
+ERROR_TYPES = ("必填錯誤", "選項錯誤", "長度錯誤", "格式錯誤", "格式錯誤", "SAP重複錯誤")
+_DECIMAL_RE = re.compile(r"-?\d+(\.\d+)?")
+
+@dataclass(frozen=True)
+class ColumnRule:
+    """
+    模板單一欄位編譯後的規則
+    length_kind：None（不檢查）/ "num_ps"（NUM 的 (總位數,小數位)）/ "num"（NUM 位數）/ "char"（字元數）
+    format_type：CHAR / NUM / DATE（同 check_format 的判斷）
+    """
+    col: int
+    name: str
+    required: bool = False
+    is_date: bool = False
+    options: frozenset = None
+    length_kind: str = None
+    length_max: int = None
+    precision: int = None
+    scale: int = None
+    format_type: str = "CHAR"
+    format_precision: int = None
+    format_scale: int = None
+
+def _compile_length(length_limit, type_code_str):
+    """
+    第 5 列長度 → (length_kind, length_max, precision, scale)；無法解析時不檢查長度
+    """
+    if pd.isna(length_limit):
+        return None, None, None, None
+    length_spec = str(length_limit).strip()
+    try:
+        if type_code_str == "NUM":
+            m = _NUM_LENGTH_SPEC_RE.fullmatch(length_spec)
+            if m:
+                return "num_ps", None, int(m.group(1)), int(m.group(2))
+            return "num", int(length_spec), None, None
+        return "char", int(length_spec), None, None
+    except Exception:
+        return None, None, None, None
+
+def compile_template_rules(header, type_row, length_row, require_row, options_map):
+    """
+    模板第 1/4/5/6 列 + 選項 → {欄位索引: ColumnRule}（欄名空白的欄位略過）
+    """
+    rules = {}
+    for c in range(len(header)):
+        col_name = str(header[c]).strip()
+        if not col_name:
+            continue
+
+        type_code = type_row[c]
+        type_code_str = str(type_code).strip().upper() if not pd.isna(type_code) else ""
+        length_kind, length_max, precision, scale = _compile_length(length_row[c], type_code_str)
+        format_type, format_precision, format_scale = _parse_type_code(type_code_str or type_code)
+        options = options_map.get(col_name)
+
+        rules[c] = ColumnRule(
+            col=c,
+            name=col_name,
+            required=str(require_row[c]).upper() == "V",
+            is_date=(type_code_str == "DATE" or ("DATE" in str(col_name).upper())),
+            options=frozenset(options) if options is not None else None,
+            length_kind=length_kind,
+            length_max=length_max,
+            precision=precision,
+            scale=scale,
+            format_type=format_type,
+            format_precision=format_precision,
+            format_scale=format_scale,
+        )
+    return rules
+
+def _num_text(v):
+    return f"{v:.15g}" if isinstance(v, float) else str(v).strip()
+
+def _char_text(v):
+    return f"{v:.15g}" if isinstance(v, float) else str(v)
+
+def _length_error(rule, v, src_excel_row):
+    """
+    單一值的長度檢查（NUM(整數位,小數位) 不是數字時回報格式錯誤），回傳 (err_type, msg) 或 None
+    """
+    col_name = rule.name
+    if rule.length_kind == "num_ps":
+        int_limit = rule.precision - rule.scale
+        s_val = _num_text(v)
+        if not _DECIMAL_RE.fullmatch(s_val):
+            return "格式錯誤", f"Row {src_excel_row} 欄 {col_name} 應為數字(含小數)，實際：{s_val}"
+        unsigned = s_val.lstrip("-")
+        if "." in unsigned:
+            int_part, frac_part = unsigned.split(".", 1)
+        else:
+            int_part, frac_part = unsigned, ""
+        if len(int_part) > int_limit or len(frac_part) > rule.scale:
+            return "長度錯誤", (
+                f"Row {src_excel_row} 欄 {col_name} 不符合整數 {int_limit} 位、"
+                f"小數 {rule.scale} 位的限制，值：{s_val}"
+            )
+        return None
+
+    if rule.length_kind == "num":
+        s_val = _num_text(v)
+        raw = s_val.replace("-", "").replace(".", "")
+        if len(raw) > rule.length_max:
+            return "長度錯誤", f"Row {src_excel_row} 欄 {col_name} 實際長度 {len(raw)}/{rule.length_max}，值：{s_val}"
+        return None
+
+    if rule.length_kind == "char":
+        check_str = _char_text(v)
+        if len(check_str) > rule.length_max:
+            return "長度錯誤", f"Row {src_excel_row} 欄 {col_name} 實際長度 {len(check_str)}/{rule.length_max}，值：{check_str}"
+        return None
+
+    return None
+
+def _as_text(sub: pd.Series, func):
+    """
+    非空值 → 檢查用字串；全為字串時直接走 pandas 字串運算
+    """
+    if pd.api.types.infer_dtype(sub, skipna=False) == "string":
+        return sub.str.strip() if func is _num_text else sub
+    return sub.map(func).astype(object)
+
+def _length_fail_mask(rule, sub: pd.Series):
+    """
+    回傳 (失敗遮罩, 不是數字遮罩)；只有 NUM(整數位,小數位) 會有「不是數字」（記為格式錯誤）
+    """
+    no_number = np.zeros(len(sub), dtype=bool)
+    if rule.length_kind == "char":
+        return (_as_text(sub, _char_text).str.len() > rule.length_max).to_numpy(dtype=bool), no_number
+
+    text = _as_text(sub, _num_text)
+    if rule.length_kind == "num":
+        digits = text.str.replace("-", "", regex=False).str.replace(".", "", regex=False).str.len()
+        return (digits > rule.length_max).to_numpy(dtype=bool), no_number
+
+    # num_ps：不是數字 → 格式錯誤；是數字 → 比對整數位 / 小數位
+    is_num = text.str.fullmatch(_DECIMAL_RE).fillna(False).to_numpy(dtype=bool)
+    parts = text.str.lstrip("-").str.partition(".")
+    int_len = parts[0].str.len().to_numpy()
+    frac_len = parts[2].str.len().to_numpy()
+    too_long = (int_len > rule.precision - rule.scale) | (frac_len > rule.scale)
+    return ~is_num | too_long, ~is_num
+
+def _format_fail_mask(rule, sub: pd.Series):
+    text = sub.map(str).str.strip() if pd.api.types.infer_dtype(sub, skipna=False) != "string" else sub.str.strip()
+    if rule.format_type == "DATE":
+        return ~text.str.fullmatch(_DATE_FORMAT_RE).fillna(False).to_numpy(dtype=bool)
+
+    is_num = text.str.fullmatch(_NUM_FORMAT_RE).fillna(False).to_numpy(dtype=bool)
+    parts = text.str.lstrip("+-").str.partition(".")
+    int_len = parts[0].str.len().to_numpy()
+    frac_len = parts[2].str.len().to_numpy()
+    fail = ~is_num
+    if rule.format_precision is not None:
+        fail |= is_num & (int_len + frac_len > rule.format_precision)
+    if rule.format_scale is not None:
+        fail |= is_num & (frac_len > rule.format_scale)
+    return fail
+
+def _empty_mask(sv: pd.Series):
+    """
+    同 is_empty：None / NaN / 空白字串
+    """
+    empty = sv.isna().to_numpy(copy=True)
+    kind = pd.api.types.infer_dtype(sv, skipna=True)
+    if kind == "string":
+        empty |= sv.str.strip().eq("").fillna(False).to_numpy(dtype=bool)
+    elif kind != "empty":
+        is_str = sv.map(type).eq(str).to_numpy(dtype=bool)
+        if is_str.any():
+            empty[is_str] = sv[is_str].str.strip().eq("").to_numpy(dtype=bool)
+    return empty
+
+# 逐值檢查結果以旗標記錄（必填只看是否空白，不在其中）
+_FLAG_OPTION, _FLAG_LENGTH, _FLAG_NOT_NUMBER, _FLAG_FORMAT = 1, 2, 4, 8
+
+def _value_flags(rule, sub: pd.Series):
+    """
+    非空值的選項 / 長度 / 格式檢查，回傳失敗旗標（int8 ndarray，與 sub 同順序）
+    """
+    flags = np.zeros(len(sub), dtype=np.int8)
+    if rule.options is not None:
+        flags[~sub.isin(rule.options).to_numpy(dtype=bool)] |= _FLAG_OPTION
+    if rule.length_kind is not None:
+        fail, not_number = _length_fail_mask(rule, sub)
+        flags[fail] |= _FLAG_LENGTH
+        flags[not_number] |= _FLAG_NOT_NUMBER
+    if rule.format_type != "CHAR":
+        flags[_format_fail_mask(rule, sub)] |= _FLAG_FORMAT
+    return flags
+
+def validate_column(rule, values, memo=None):
+    """
+    整欄校驗：values 為對齊到模板列順序的值（object ndarray）
+    memo：ValidationMemo（None = 不快取）；同一欄重複的值只檢查一次
+    回傳 (位置 ndarray, 錯誤代碼 ndarray)，順序同逐格檢查（逐列；同一格依 必填 → 選項 → 長度 → 格式）
+    """
+    sv = pd.Series(values, dtype=object)
+    empty = _empty_mask(sv)
+    nonempty_pos = np.flatnonzero(~empty)
+    sub = sv.iloc[nonempty_pos]
+
+    hits = []
+    if rule.required:
+        hits.append((np.flatnonzero(empty), ERR_REQUIRED))
+    if len(sub) and (rule.options is not None or rule.length_kind is not None or rule.format_type != "CHAR"):
+        flags = _value_flags(rule, sub) if memo is None else memo.flags(rule, sub)
+        if rule.options is not None:
+            hits.append((nonempty_pos[(flags & _FLAG_OPTION) != 0], ERR_OPTION))
+        if rule.length_kind is not None:
+            fail = (flags & _FLAG_LENGTH) != 0
+            not_number = (flags[fail] & _FLAG_NOT_NUMBER) != 0
+            hits.append((nonempty_pos[fail], np.where(not_number, ERR_NOT_NUMBER, ERR_LENGTH)))
+        if rule.format_type != "CHAR":
+            hits.append((nonempty_pos[(flags & _FLAG_FORMAT) != 0], ERR_FORMAT))
+    if not hits:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8)
+
+    pos = np.concatenate([h[0] for h in hits])
+    codes = np.concatenate([np.broadcast_to(np.asarray(h[1], dtype=np.int8), h[0].shape) for h in hits])
+    # 代碼大小即檢查順序（長度錯誤 / 不是數字 同一格只會出現一個）
+    order = np.lexsort((codes, pos))
+    return pos[order], codes[order]
+
+def error_message(code, rule, value, src_excel_row):
+    """
+    依錯誤代碼組訊息（與逐格檢查時的訊息相同）；SAP 重複時 value 為料號、rule 可為 None
+    """
+    if code == ERR_SAP_DUP:
+        return f"Row {src_excel_row} 料號 {value} 重複"
+    col_name = rule.name
+    if code == ERR_REQUIRED:
+        return f"Row {src_excel_row} 欄 {col_name} 空白"
+    if code == ERR_OPTION:
+        return f"Row {src_excel_row} 欄 {col_name}：{value} 不在允許清單內"
+    if code in (ERR_LENGTH, ERR_NOT_NUMBER):
+        return _length_error(rule, value, src_excel_row)[1]
+    err = _format_error(str(value).strip(), rule.format_type, rule.format_precision, rule.format_scale)
+    return f"Row {src_excel_row} 欄 {col_name}：{err}"
+
+# 行程池一律用 spawn：Streamlit 伺服器是多執行緒，fork 會把其他執行緒持有的鎖一起複製到子行程（可能卡死）
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+def _process_pool(workers, **kwargs):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT, **kwargs)
+
+# --------------------------------------------------
+# 多行程校驗：逐值檢查（_value_flags）的輸入切成分片，交給行程池平行檢查
+# 值以 UTF-8 放進共用記憶體（不 pickle DataFrame），檢查結果旗標也直接寫回同一塊共用記憶體
+# 逐值檢查彼此獨立，分片結果依序接回與單行程完全相同（錯誤順序、統計、校驗快取命中數都不變）
+# --------------------------------------------------
+# 一次檢查的值少於此數就不分片（行程往返比檢查本身還慢）
+VALIDATION_SHARD_MIN_VALUES = 50_000
+# 值之間的分隔字元：清洗後的值不會有控制字元
+_SHARD_SEP = "\x00"
+
+def _value_flags_shard(shm_name, start, stop, count, out_offset, rule):
+    """
+    行程池執行的分片：共用記憶體 [start, stop) 為 count 個以 _SHARD_SEP 相接的 UTF-8 值，
+    檢查結果（int8 旗標）寫到 out_offset 起的 count 個位元組
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        values = bytes(shm.buf[start:stop]).decode("utf-8").split(_SHARD_SEP)
+        out = np.ndarray((count,), dtype=np.int8, buffer=shm.buf, offset=out_offset)
+        out[:] = _value_flags(rule, pd.Series(values, dtype=object))
+        del out  # 釋放對 shm.buf 的參照才能 close
+    finally:
+        shm.close()
+
+class ValidationShards:
+    """
+    校驗分片用的行程池（一次執行一個，用完 close）；flags(rule, sub) 的結果與 _value_flags 相同
+    值太少、不是全為字串，或含有分隔字元時直接在本行程檢查
+    """
+
+    def __init__(self, workers, min_values=None):
+        self.workers = workers
+        self.min_values = VALIDATION_SHARD_MIN_VALUES if min_values is None else min_values
+        self._executor = None
+        self.calls = 0
+        self.values = 0
+
+    def flags(self, rule, sub: pd.Series):
+        n = len(sub)
+        values = sub.to_numpy(dtype=object)
+        if self.workers <= 1 or n < max(self.min_values, 2) or pd.api.types.infer_dtype(values, skipna=False) != "string":
+            return _value_flags(rule, sub)
+
+        bounds = np.linspace(0, n, min(self.workers, n) + 1).astype(np.int64)
+        parts = [_SHARD_SEP.join(values[a:b]).encode("utf-8") for a, b in zip(bounds[:-1], bounds[1:])]
+        sep = _SHARD_SEP.encode("utf-8")
+        if sum(part.count(sep) for part in parts) != n - len(parts):
+            return _value_flags(rule, sub)
+
+        data_size = sum(len(part) for part in parts)
+        shm = shared_memory.SharedMemory(create=True, size=data_size + n)
+        try:
+            tasks = []
+            offset = 0
+            for part, a, b in zip(parts, bounds[:-1], bounds[1:]):
+                shm.buf[offset:offset + len(part)] = part
+                tasks.append((shm.name, offset, offset + len(part), int(b - a), data_size + int(a), rule))
+                offset += len(part)
+            del parts
+            if self._executor is None:
+                self._executor = _process_pool(self.workers)
+            for fut in [self._executor.submit(_value_flags_shard, *task) for task in tasks]:
+                fut.result()
+            flags = np.frombuffer(shm.buf, dtype=np.int8, count=n, offset=data_size).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+        self.calls += 1
+        self.values += n
+        return flags
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+# 校驗快取：每欄最多記住幾個不同值（超過視為高基數欄位，例如序號，該欄停用快取）
+VALIDATION_MEMO_MAX_VALUES = 100_000
+# 錯誤訊息快取最多幾筆（滿了先丟最早的）
+VALIDATION_MEMO_MAX_MESSAGES = 100_000
+
+class ValidationMemo:
+    """
+    (欄位規則, 值) → 檢查結果 / 錯誤訊息 的快取（一次執行一個，放在 state 給輸出階段組訊息）
+    規格欄位大量重複（單位、顏色、等級、選項代碼…）：每個不同的值每欄只檢查一次、同樣的錯誤訊息只組一次
+    只快取全為字串的欄位（清洗後的來源值）；數字 / 布林混在一起時 1、1.0、True 會被視為同一個值，改回直接檢查
+    shards：ValidationShards（None = 在本行程檢查）；沒快取到的值交給行程池分片檢查
+    """
+
+    def __init__(self, max_values=VALIDATION_MEMO_MAX_VALUES, max_messages=VALIDATION_MEMO_MAX_MESSAGES, shards=None):
+        self.max_values = max_values
+        self.max_messages = max_messages
+        self.shards = shards
+        self._flags = {}
+        self._messages = {}
+        self._disabled = set()
+        self.disabled = []
+        # 以格計：命中 = 沿用已檢查過的值，未命中 = 實際檢查
+        self.hits = 0
+        self.misses = 0
+        self.message_hits = 0
+        self.message_misses = 0
+
+    def _check(self, rule, sub: pd.Series):
+        return _value_flags(rule, sub) if self.shards is None else self.shards.flags(rule, sub)
+
+    def flags(self, rule, sub: pd.Series):
+        """同 _value_flags，已檢查過的值直接沿用"""
+        if rule in self._disabled or pd.api.types.infer_dtype(sub, skipna=False) != "string":
+            self.misses += len(sub)
+            return self._check(rule, sub)
+
+        codes, uniques = pd.factorize(sub.to_numpy(dtype=object))
+        known = self._flags.setdefault(rule, {})
+        unique_flags = np.fromiter((known.get(v, -1) for v in uniques), dtype=np.int8, count=len(uniques))
+        todo = np.flatnonzero(unique_flags < 0)
+        if len(todo):
+            new_values = uniques[todo]
+            new_flags = self._check(rule, pd.Series(new_values, dtype=object))
+            unique_flags[todo] = new_flags
+            if len(known) + len(todo) > self.max_values:
+                # 高基數欄位：快取幾乎不會命中，清掉並停用
+                del self._flags[rule]
+                self._disabled.add(rule)
+                self.disabled.append(rule.name)
+            else:
+                known.update(zip(new_values, new_flags.tolist()))
+        self.misses += len(todo)
+        self.hits += len(sub) - len(todo)
+        return unique_flags[codes]
+
+    def message(self, code, rule, value, src_excel_row):
+        """同 error_message；訊息除了開頭的列號都只由 (規則, 代碼, 值) 決定"""
+        key = (rule, code, type(value), value)
+        prefix = f"Row {src_excel_row}"
+        suffix = self._messages.get(key)
+        if suffix is not None:
+            self.message_hits += 1
+            return prefix + suffix
+        self.message_misses += 1
+        msg = error_message(code, rule, value, src_excel_row)
+        if len(self._messages) >= self.max_messages:
+            del self._messages[next(iter(self._messages))]
+        self._messages[key] = msg[len(prefix):]
+        return msg
+
+    def stats(self, message_base=(0, 0)):
+        """
+        命中統計；message_base：訊息計數的起點（同一份結果輸出多次時只算這次輸出）
+        訊息計數為產出錯誤報表為止（LOG 在統計之後才組）
+        """
+        def rate(hit, miss):
+            return round(hit / (hit + miss), 4) if hit + miss else None
+
+        message_hits = self.message_hits - message_base[0]
+        message_misses = self.message_misses - message_base[1]
+        return {
+            "值檢查命中格數": self.hits,
+            "值檢查實際檢查數": self.misses,
+            "值檢查命中率": rate(self.hits, self.misses),
+            "訊息命中數": message_hits,
+            "訊息組字數": message_misses,
+            "訊息命中率": rate(message_hits, message_misses),
+            "停用快取欄位（高基數）": list(dict.fromkeys(self.disabled)),
+        }
+
+class ErrorStore:
+    """
+    校驗錯誤的欄式儲存：每筆只記 (模板列, 模板欄, 錯誤代碼, 來源列號)，訊息等輸出時才組
+    來源列號：有對到來源的列為來源 Excel 列號，否則為模板 Excel 列號
+    """
+    def __init__(self):
+        self._chunks = []
+        self._arrays = None
+
+    def add(self, rows, col, codes, src_rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        n = len(rows)
+        self._chunks.append((
+            rows,
+            np.broadcast_to(np.asarray(col, dtype=np.int32), (n,)),
+            np.broadcast_to(np.asarray(codes, dtype=np.int8), (n,)),
+            np.broadcast_to(np.asarray(src_rows, dtype=np.int64), (n,)),
+        ))
+        self._arrays = None
+
+    def _data(self):
+        if self._arrays is None:
+            if self._chunks:
+                self._arrays = tuple(np.concatenate([c[i] for c in self._chunks]) for i in range(4))
+            else:
+                self._arrays = (
+                    np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.int8), np.empty(0, np.int64)
+                )
+        return self._arrays
+
+    rows = property(lambda self: self._data()[0])
+    cols = property(lambda self: self._data()[1])
+    codes = property(lambda self: self._data()[2])
+    src_rows = property(lambda self: self._data()[3])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def count(self, *codes):
+        return int(np.isin(self.codes, codes).sum())
+
+    def _cell_codes(self):
+        rows, cols = self.rows, self.cols
+        key = rows * (int(cols.max()) + 1 if len(cols) else 1) + cols
+        return pd.factorize(key)
+
+    def cells(self):
+        """
+        有錯誤的格子 (模板列, 模板欄)，依第一次出錯的順序
+        """
+        codes, _ = self._cell_codes()
+        first = np.unique(codes, return_index=True)[1]
+        return list(zip(self.rows[first].tolist(), self.cols[first].tolist()))
+
+    def error_rows(self):
+        return np.unique(self.rows)
+
+    def report_order(self):
+        """
+        ErrorLog 順序：同一格的錯誤排在一起，格子依第一次出錯的順序
+        """
+        codes, _ = self._cell_codes()
+        return np.argsort(codes, kind="stable")
+
+class SourceMissing:
+    """
+    「來源料號未在模板出現」的欄式儲存：只記來源 Excel 列號與料號兩個陣列，訊息等輸出時才組
+    （來源是數百萬列的整份匯出、模板很小時，這類列會很多）
+    """
+    error_type = "來源料號未在模板出現"
+
+    def __init__(self, missing):
+        # missing：合併後來源列 index → 料號（見 _missing_source_keys / _stream_sources）
+        self.src_rows = SOURCE_FIRST_DATA_EXCEL_ROW + missing.index.to_numpy(dtype=np.int64)
+        self.materials = missing.to_numpy(dtype=object)
+
+    def __len__(self):
+        return len(self.src_rows)
+
+    def message(self, i):
+        return f"來源料號 {self.materials[i]} (Row {self.src_rows[i]}) 未在模板 B 欄任一列出現"
+
+    def record(self, i):
+        """SourceCheck 的一列：(SourceRow, Material, ErrorType, Message)"""
+        return int(self.src_rows[i]), self.materials[i], self.error_type, self.message(i)
+
+# --------------------------------------------------
+# LOG：細項只在需要時才組字串，畫面上只顯示頭尾
+# --------------------------------------------------
+LOG_HEAD_LINES = 200
+LOG_TAIL_LINES = 50
+
+def iter_log_lines(segments, head=None, tail=None):
+    """
+    segments：[(行數, 取第 i 行的函式), ...]
+    head / tail 為 None 時輸出全部；否則只輸出前 head 行與後 tail 行，中間以一行說明省略數量
+    """
+    total = sum(n for n, _ in segments)
+    if head is None or tail is None or total <= head + tail:
+        ranges = [(0, total)]
+    else:
+        ranges = [(0, head), (total - tail, total)]
+
+    for k, (lo, hi) in enumerate(ranges):
+        if k:
+            yield f"...（另有 {ranges[1][0] - ranges[0][1]} 行已省略，完整內容請下載完整 LOG）"
+        base = 0
+        for n, get in segments:
+            for i in range(max(lo, base), min(hi, base + n)):
+                yield get(i - base)
+            base += n
+
+def _list_segment(lines):
+    return (len(lines), lines.__getitem__)
+
+def _spooled_text(lines) -> bytes:
+    """
+    逐行寫到暫存檔（utf-8），寫完再一次讀回 bytes
+    """
+    with tempfile.TemporaryFile() as f:
+        for line in lines:
+            f.write(line.encode("utf-8"))
+            f.write(b"\n")
+        f.seek(0)
+        return f.read()
+
+# --------------------------------------------------
+# 模板列 ↔ 來源列對齊
+# --------------------------------------------------
+def source_key_index(source_sap_series: pd.Series):
+    """
+    來源料號索引：清洗後非空白料號第一次出現的列（來源同料號取第一筆）
+    回傳 (料號 Index, 對應來源列 index)；同一份來源比對多個模板時只建一次
+    """
+    source_valid = source_sap_series[~_empty_mask(source_sap_series)]
+    first = source_valid[~source_valid.duplicated(keep="first")]
+    return pd.Index(first.to_numpy(dtype=object), dtype=object), first.index.to_numpy()
+
+def align_template_rows(template_sap_series: pd.Series, source_sap_series: pd.Series, source_keys=None):
+    """
+    以清洗後 SAP 料號做一次 index join：來源同料號取第一次出現的列
+    source_keys：已建好的 source_key_index(source_sap_series)（None = 現建）
+    回傳 (模板列 index, 對應來源列 index)，皆依模板列順序
+    """
+    key_index, first_rows = source_keys if source_keys is not None else source_key_index(source_sap_series)
+    positions = key_index.get_indexer(template_sap_series.to_numpy(dtype=object))
+    matched = (positions >= 0) & ~_empty_mask(template_sap_series)
+    rows_out = template_sap_series.index.to_numpy()[matched].astype(np.int64)
+    src_idx = first_rows[positions[matched]].astype(np.int64)
+    return rows_out, src_idx
+
+def dedupe_columns(df: pd.DataFrame):
+    """
+    欄名重複時只保留第一次出現的欄位，回傳 (df, 重複欄名清單)
+    """
+    dup_mask = df.columns.duplicated(keep="first")
+    if not dup_mask.any():
+        return df, []
+    dup_names = list(dict.fromkeys(df.columns[dup_mask]))
+    return df.loc[:, ~dup_mask], dup_names
+
+# --------------------------------------------------
+# 輸出：xlsxwriter constant_memory 逐列寫出，落地暫存檔
+# --------------------------------------------------
+ERROR_LOG_HEADERS = ["Row", "Col", "Field", "SAP_Material", "Value", "ErrorType", "ErrorMessage"]
+SOURCE_CHECK_HEADERS = ["SourceRow", "SAP_Material", "ErrorType", "Message"]
+ERROR_SUMMARY_HEADERS = [
+    "Field", "Col", "ErrorType", "Value", "Count", "FirstRow", "LastRow", "ExampleSAP", "ExampleMessage",
+]
+
+# 錯誤報表內容：full = 逐格 ErrorLog；summary = 依（欄位, 錯誤類型, 值）彙總的 ErrorSummary 取代 ErrorLog；both = 兩者都有
+ERROR_REPORT_MODES = {
+    "full": "逐格明細（ErrorLog）",
+    "summary": "彙總（ErrorSummary：依欄位 / 錯誤類型 / 值）",
+    "both": "彙總 + 逐格明細",
+}
+# ErrorSummary 每組列出幾個 SAP 料號範例
+ERROR_SUMMARY_EXAMPLES = 5
+
+# 主結果每批轉成文字的列數（控制文字暫存的記憶體）
+RESULT_WRITE_CHUNK_ROWS = 50_000
+
+# Excel 單一工作表列數上限（含標題列）；超過就拆成 ErrorLog_2、ErrorLog_3…
+EXCEL_MAX_ROWS = 1_048_576
+
+# 錯誤報表格式：副檔名 / MIME（csv、parquet 會把 ErrorLog、SourceCheck 打包成 zip）
+ERROR_REPORT_FORMATS = {
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": (".zip", "application/zip"),
+    "parquet": (".zip", "application/zip"),
+}
+
+# parquet 每個 row group 的列數
+PARQUET_BATCH_ROWS = 100_000
+
+def excel_text_values(values):
+    """
+    整欄版 to_excel_text（缺值 → ""），回傳 object ndarray
+    """
+    values = np.asarray(values, dtype=object)
+    out = np.full(len(values), "", dtype=object)
+    keep = ~pd.isna(values)
+    if keep.any():
+        texts = pd.Series(values[keep], dtype=object)
+        if pd.api.types.infer_dtype(texts, skipna=False) != "string":
+            texts = texts.map(str)
+        out[keep] = texts.str.replace(_CTRL_RE, "", regex=True).to_numpy(dtype=object)
+    return out
+
+def _write_rows(ws, rows, start_row=0):
+    """
+    逐列寫入文字（每格 write_string），回傳下一個可寫的列號
+    """
+    write_string = ws.write_string
+    r = start_row
+    for row in rows:
+        for c, text in enumerate(row):
+            write_string(r, c, text)
+        r += 1
+    return r
+
+def _spooled_xlsx(build):
+    """
+    xlsxwriter 以 constant_memory 模式寫到暫存檔，寫完再一次讀回 bytes
+    build(wb) 負責建立工作表並寫入資料（必須由上而下逐列寫）
+    """
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+        try:
+            build(wb)
+        finally:
+            wb.close()
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+def write_result_xlsx(output_df: pd.DataFrame, error_cells, on_chunk=None) -> bytes:
+    """
+    主結果：全部以文字寫出，錯誤格紅底黃字
+    on_chunk(列數)：每寫完一批（RESULT_WRITE_CHUNK_ROWS 列）呼叫一次（進度 / 取消）
+    """
+    err_cols_by_row = {}
+    for r, c in error_cells:
+        err_cols_by_row.setdefault(r, []).append(c)
+
+    def build(wb):
+        ws = wb.add_worksheet("Sheet1")
+        err_fmt = wb.add_format({"bg_color": "#FF0000", "font_color": "#FFFF00", "bold": True})
+        write_string = ws.write_string
+
+        nrows, ncols = output_df.shape
+        for start in range(0, nrows, RESULT_WRITE_CHUNK_ROWS):
+            chunk = output_df.iloc[start:start + RESULT_WRITE_CHUNK_ROWS]
+            text_cols = [excel_text_values(chunk.iloc[:, c].to_numpy(dtype=object)) for c in range(ncols)]
+            for r, row in enumerate(zip(*text_cols), start=start):
+                for c, text in enumerate(row):
+                    write_string(r, c, text)
+                for c in err_cols_by_row.get(r, ()):
+                    write_string(r, c, row[c], err_fmt)
+            if on_chunk is not None:
+                on_chunk(len(chunk))
+
+    return _spooled_xlsx(build)
+
+def error_summary_frame(errors, output_df, sap_texts, examples=ERROR_SUMMARY_EXAMPLES):
+    """
+    錯誤依（欄位, 錯誤類型, 值）彙總；值與 ErrorLog 的 Value 欄相同，兩種格式錯誤代碼同屬「格式錯誤」一組
+    sap_texts：每筆錯誤的 SAP 料號文字（依 errors 的順序，同 ErrorLog 的 SAP_Material）
+    回傳 DataFrame（筆數多的在前，同筆數依 ErrorLog 中出現的順序）：col、type、value、count、
+    first_row / last_row（最小 / 最大的 ErrorLog Row）、examples（前 examples 個不重複料號）、first（該組第一筆錯誤）
+    count 合計 = len(errors)，各類型合計與 stats 的錯誤數相同
+    """
+    order = errors.report_order()
+    rows, cols = errors.rows[order], errors.cols[order]
+    values = np.empty(len(order), dtype=object)
+    for col in np.unique(cols):
+        at = np.flatnonzero(cols == col)
+        values[at] = [to_excel_text(v) for v in output_df.iloc[rows[at], col].to_numpy(dtype=object)]
+
+    frame = pd.DataFrame({
+        "col": cols,
+        "type": np.asarray(ERROR_TYPES, dtype=object)[errors.codes[order]],
+        "value": values,
+        "src": errors.src_rows[order],
+        "sap": np.asarray(sap_texts, dtype=object)[order],
+        "first": order,
+    })
+    keys = ["col", "type", "value"]
+    summary = frame.groupby(keys, sort=False, dropna=False).agg(
+        count=("first", "size"), first_row=("src", "min"), last_row=("src", "max"), first=("first", "first")
+    )
+    saps = frame[frame["sap"] != ""].drop_duplicates(keys + ["sap"])
+    summary["examples"] = (
+        saps.groupby(keys, sort=False, dropna=False).head(examples)
+        .groupby(keys, sort=False, dropna=False)["sap"].agg("、".join)
+        .reindex(summary.index, fill_value="")
+    )
+    return summary.sort_values("count", ascending=False, kind="stable").reset_index()
+
+def _write_split_sheets(wb, base_name, headers, rows):
+    """
+    超過 EXCEL_MAX_ROWS 自動換頁：base_name、base_name_2、base_name_3…（每頁都有標題列）
+    邊讀 rows 邊寫（不先收集整頁）；寫滿一頁後先取下一列，還有資料才開新頁
+    """
+    rows = iter(rows)
+    per_sheet = EXCEL_MAX_ROWS - 1
+    sheet_no = 1
+    pending = ()
+    while True:
+        name = base_name if sheet_no == 1 else f"{base_name}_{sheet_no}"
+        ws = wb.add_worksheet(name)
+        _write_rows(ws, chain(pending, islice(rows, per_sheet - len(pending))), _write_rows(ws, [headers]))
+        pending = tuple(islice(rows, 1))
+        if not pending:
+            return
+        sheet_no += 1
+
+def write_error_xlsx(error_rows=None, source_rows=None, summary_rows=None) -> bytes:
+    """
+    錯誤報表：ErrorSummary（summary_rows）+ ErrorLog（error_rows）+ SourceCheck（source_rows），傳 None 的頁籤不產生
+    """
+    def build(wb):
+        if summary_rows is not None:
+            _write_split_sheets(wb, "ErrorSummary", ERROR_SUMMARY_HEADERS, summary_rows)
+        if error_rows is not None:
+            _write_split_sheets(wb, "ErrorLog", ERROR_LOG_HEADERS, error_rows)
+        if source_rows is not None:
+            _write_split_sheets(wb, "SourceCheck", SOURCE_CHECK_HEADERS, source_rows)
+
+    return _spooled_xlsx(build)
+
+def _spooled_zip(build):
+    """
+    zip 寫到暫存檔，寫完再一次讀回 bytes
+    """
+    fd, path = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            build(zf)
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+def write_error_csv(error_rows=None, source_rows=None, summary_rows=None) -> bytes:
+    """
+    錯誤報表 CSV 版：ErrorSummary.csv / ErrorLog.csv / SourceCheck.csv 打包成 zip（utf-8-sig，Excel 直接開不亂碼）
+    """
+    def write_csv(zf, name, headers, rows):
+        with zf.open(name, "w") as raw:
+            with io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(headers)
+                writer.writerows(rows)
+
+    def build(zf):
+        if summary_rows is not None:
+            write_csv(zf, "ErrorSummary.csv", ERROR_SUMMARY_HEADERS, summary_rows)
+        if error_rows is not None:
+            write_csv(zf, "ErrorLog.csv", ERROR_LOG_HEADERS, error_rows)
+        if source_rows is not None:
+            write_csv(zf, "SourceCheck.csv", SOURCE_CHECK_HEADERS, source_rows)
+
+    return _spooled_zip(build)
+
+def write_error_parquet(error_rows=None, source_rows=None, summary_rows=None) -> bytes:
+    """
+    錯誤報表 Parquet 版：ErrorSummary.parquet / ErrorLog.parquet / SourceCheck.parquet 打包成 zip（需要 pyarrow）
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ValueError("錯誤報表輸出 Parquet 需要安裝 pyarrow") from e
+
+    def write_parquet(zf, name, headers, rows):
+        schema = pa.schema([(h, pa.string()) for h in headers])
+        fd, path = tempfile.mkstemp(suffix=".parquet")
+        os.close(fd)
+        try:
+            with pq.ParquetWriter(path, schema) as writer:
+                rows = iter(rows)
+                while True:
+                    batch = list(islice(rows, PARQUET_BATCH_ROWS))
+                    if not batch:
+                        break
+                    columns = list(zip(*batch))
+                    writer.write_table(pa.table({h: list(col) for h, col in zip(headers, columns)}, schema=schema))
+            zf.write(path, name, compress_type=zipfile.ZIP_STORED)
+        finally:
+            os.remove(path)
+
+    def build(zf):
+        if summary_rows is not None:
+            write_parquet(zf, "ErrorSummary.parquet", ERROR_SUMMARY_HEADERS, summary_rows)
+        if error_rows is not None:
+            write_parquet(zf, "ErrorLog.parquet", ERROR_LOG_HEADERS, error_rows)
+        if source_rows is not None:
+            write_parquet(zf, "SourceCheck.parquet", SOURCE_CHECK_HEADERS, source_rows)
+
+    return _spooled_zip(build)
+
+_ERROR_REPORT_WRITERS = {
+    "xlsx": write_error_xlsx,
+    "csv": write_error_csv,
+    "parquet": write_error_parquet,
+}
+# 錯誤報表格式 → 需要的選用套件（模組名, pip 套件名）
+_ERROR_FORMAT_MODULES = {"parquet": ("pyarrow", "pyarrow")}
+
+def error_format_installed(error_format) -> bool:
+    module = _ERROR_FORMAT_MODULES.get(error_format)
+    return module is None or importlib.util.find_spec(module[0]) is not None
+
+def installed_error_formats():
+    """目前環境可以輸出的錯誤報表格式（依 ERROR_REPORT_FORMATS 順序）"""
+    return [f for f in ERROR_REPORT_FORMATS if error_format_installed(f)]
+
+class LocalFile:
+    """
+    本機檔案包成與 Streamlit UploadedFile 相同介面（name / getvalue），給 CLI / 批次使用
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self.name = os.path.basename(self.path)
+
+    def getvalue(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+def _file_label(uf, default):
+    return getattr(uf, "name", None) or default
+
+# --------------------------------------------------
+# 讀檔引擎（每次執行可選；實際用到的引擎記在 stats["讀檔引擎"]）
+# --------------------------------------------------
+# auto：xlsx 有裝 python-calamine 就用 calamine（Rust 解析，快很多），否則 openpyxl；
+# 舊版 .xls 一律 xlrd（選 calamine 時用 calamine）；xlsx 模板一律 openpyxl（見 compile_template）
+READER_ENGINES = ("auto", "openpyxl", "calamine")
+READER_ENGINE_LABELS = {
+    "auto": "自動（有裝 calamine 就用）",
+    "openpyxl": "openpyxl（相容性最高）",
+    "calamine": "calamine（最快，需安裝 python-calamine）",
+}
+# 引擎 → (模組名, pip 套件名)
+_READER_MODULES = {
+    "openpyxl": ("openpyxl", "openpyxl"),
+    "calamine": ("python_calamine", "python-calamine"),
+    "xlrd": ("xlrd", "xlrd"),
+}
+# 舊版 .xls（OLE2 複合文件）檔頭
+_XLS_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+# calamine 讀 xlsx 會把 XML 的 _xHHHH_ 跳脫還原成控制字元（openpyxl 保留原文）；讀完再跳脫回去，值與 openpyxl 相同
+# （.xls 本來就存原字元，不用處理）
+_UNESCAPED_CTRL_RE = re.compile(r"[\x00-\x08\x0B-\x1F]")
+
+def reader_engine_installed(engine) -> bool:
+    if engine == "calamine" and tuple(int(x) for x in pd.__version__.split(".")[:2]) < (2, 2):
+        return False  # pandas 2.2 起才支援 calamine 引擎
+    return importlib.util.find_spec(_READER_MODULES[engine][0]) is not None
+
+def _is_xls(file_bytes: bytes) -> bool:
+    return file_bytes[:len(_XLS_MAGIC)] == _XLS_MAGIC
+
+def _check_reader(reader):
+    if reader not in READER_ENGINES:
+        raise ValueError(f"不支援的讀檔引擎：{reader}（可用：{', '.join(READER_ENGINES)}）")
+
+def _resolve_engine(file_bytes: bytes, reader="auto"):
+    """依檔案格式與選擇的讀檔方式決定 pandas 引擎；需要的套件沒裝時丟出 ValueError"""
+    _check_reader(reader)
+    if _is_xls(file_bytes):
+        order = ("calamine",) if reader == "calamine" else ("xlrd", "calamine")
+    elif reader == "auto":
+        order = ("calamine", "openpyxl")
+    else:
+        order = (reader,)
+    for engine in order:
+        if reader_engine_installed(engine):
+            return engine
+    raise ValueError(f"讀檔引擎 {order[0]} 需要安裝 {_READER_MODULES[order[0]][1]}（calamine 另需 pandas 2.2 以上）")
 
-def _read_last_sheet(file_bytes: bytes):
-    bio = io.BytesIO(file_bytes)
-    xls = pd.ExcelFile(bio, engine="openpyxl")
-    last_sheet = xls.sheet_names[-1]
-    df = pd.read_excel(bio, sheet_name=last_sheet, header=None, engine="openpyxl")
+def _openpyxl_compatible(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    calamine 讀出的 DataFrame 改成與 openpyxl 相同的值：文字裡的控制字元改回 _x000D_ 等跳脫寫法
+    （日期 / 數字 / 空白格 / 錯誤值 pandas 已轉成相同的值；沒標 xml:space 的純空白文字 calamine 讀成空白格，
+    來源清洗後相同，模板不同所以模板不用 calamine 讀）
+    """
+    search = _UNESCAPED_CTRL_RE.search
+    for i in range(df.shape[1]):
+        col = df.iloc[:, i]
+        if not pd.api.types.is_object_dtype(col.dtype) and not pd.api.types.is_string_dtype(col.dtype):
+            continue
+        values = col.to_numpy(dtype=object)
+        hits = [j for j, v in enumerate(values) if isinstance(v, str) and search(v)]
+        if not hits:
+            continue
+        values = values.copy()
+        for j in hits:
+            values[j] = _UNESCAPED_CTRL_RE.sub(lambda m: f"_x{ord(m.group()):04X}_", values[j])
+        df.isetitem(i, pd.Series(values, index=df.index, dtype=col.dtype))
     return df
 
-def run_core_web(source_files, template_file, only_error_report=False):
+def _parse_sheet(xls, file_bytes, engine, **kwargs):
+    df = xls.parse(**kwargs)
+    return _openpyxl_compatible(df) if engine == "calamine" and not _is_xls(file_bytes) else df
+
+def _read_workbook(file_bytes: bytes, sheets, header=None, reader="auto"):
     """
-    Web 版核心：吃 Streamlit UploadedFile 物件
-    回傳 dict: output_bytes/error_bytes/log/stats
+    單次開檔讀取需要的頁籤（pandas 的 openpyxl 引擎本身即為 read-only 模式）
+    sheets：頁籤索引（負數由後往前算，-1 = 最後一個）或頁籤名稱
+    回傳 (frames, errors, 耗時秒, 引擎)；frames / errors 皆以 sheets 的元素為 key
     """
-    start_time = time.time()
-    log_lines = []
-    log_lines.append("=== 產規匹配 LOG（Web） ===")
-    log_lines.append("[模式] " + ("只輸出錯誤報表" if only_error_report else "完整檢查（主結果 + 錯誤報表）"))
-
-    # -------- 統計 --------
-    count_required_err = 0
-    count_option_err = 0
-    count_length_err = 0
-    count_format_err = 0
-    count_sap_dup = 0
-    source_issue_list = []
-    error_cells = {}
+    t0 = time.perf_counter()
+    frames = {}
+    errors = {}
+    engine = _resolve_engine(file_bytes, reader)
+    with pd.ExcelFile(io.BytesIO(file_bytes), engine=engine) as xls:
+        sheet_names = xls.sheet_names
+        for key in sheets:
+            try:
+                name = sheet_names[key] if isinstance(key, int) and key < 0 else key
+                frames[key] = _parse_sheet(xls, file_bytes, engine, sheet_name=name, header=header)
+            except Exception as e:
+                errors[key] = e
+    return frames, errors, time.perf_counter() - t0, engine
+
+def _source_keep_columns(names, wanted):
+    """來源欄名中要解析的欄位索引（見 _read_source_part 的 wanted）"""
+    return {
+        i for i, name in enumerate(names)
+        if i < 2 or not isinstance(name, str) or name in wanted or is_source_sap_column(name)
+    }
 
-    # --------------------------------------------------
-    # 0) 讀模板（Sheet1 + Sheet2 選項）
-    # --------------------------------------------------
-    tpl_bytes = template_file.getvalue()
+def _read_source_part(file_bytes: bytes, wanted=None, reader="auto", nrows=None):
+    """
+    單一來源檔：最後一個 sheet，第 1 列為欄名、第 8 列開始為資料
+    wanted：只解析欄名在其中的欄位（None = 全部）；另外一律保留前兩欄（來源 SAP 欄的備援位置）、
+    像 SAP 料號的欄位，以及欄名不是文字的欄位（數字 / 空白欄名整欄解析後可能轉型，以整欄結果為準）
+    只有 openpyxl 能只讀第 1 列再依欄名挑欄解析；calamine / xlrd 帶 nrows 仍會解析整張表，改成整張讀一次再丟掉不要的欄
+    nrows：只讀前幾列資料（None = 全部；快速預覽用）
+    回傳 (data, 全部欄名, 耗時秒, 引擎)；沒解析的欄位仍列在全部欄名中（欄位存在性檢查用）
+    （獨立成頂層函式，才能丟進 ProcessPoolExecutor）
+    """
+    t0 = time.perf_counter()
+    engine = _resolve_engine(file_bytes, reader)
+    with pd.ExcelFile(io.BytesIO(file_bytes), engine=engine) as xls:
+        sheet = xls.sheet_names[-1]
+        names = []
+        usecols = None
+        projected = wanted is not None and engine == "openpyxl"
+        if projected:
+            # 先只讀第 1 列決定要解析哪些欄；超出第 1 列寬度的欄（欄名空白）一律解析
+            head = _parse_sheet(xls, file_bytes, engine, sheet_name=sheet, header=None, nrows=1)
+            names = head.iloc[0].tolist() if len(head) else []
+            keep = _source_keep_columns(names, wanted)
+            usecols = lambda i: i in keep or i >= len(names)
+        if nrows is not None:
+            nrows += SOURCE_FIRST_DATA_EXCEL_ROW - 1
+        df_raw = _parse_sheet(xls, file_bytes, engine, sheet_name=sheet, header=None, usecols=usecols, nrows=nrows)
+    if wanted is not None and not projected:
+        names = df_raw.iloc[0].tolist() if len(df_raw) else []
+        df_raw = df_raw.iloc[:, sorted(_source_keep_columns(names, wanted))]
+
+    header_src = df_raw.iloc[0]
+    data = df_raw.iloc[SOURCE_FIRST_DATA_EXCEL_ROW - 1:].reset_index(drop=True)
+    data.columns = header_src
+    all_names = dict(enumerate(names))
+    all_names.update(header_src.items())
+    return data, [all_names[i] for i in sorted(all_names)], time.perf_counter() - t0, engine
+
+def _read_sources(payloads, workers=None, on_done=None, wanted=None, reader="auto"):
+    """
+    平行讀取所有來源檔，依上傳順序回傳 [(data, 全部欄名, 耗時秒, 引擎), ...]
+    wanted：只解析的欄名（見 _read_source_part）；None = 全部欄位
+    reader：讀檔引擎（見 READER_ENGINES）
+    on_done()：每讀完一個檔呼叫一次；丟出例外（例如取消）時尚未開始的檔案不再讀取
+    """
+    if workers is None:
+        workers = SOURCE_READ_WORKERS
+    if workers is None:
+        workers = min(len(payloads), os.cpu_count() or 1)
+    parts = []
+    if workers <= 1 or len(payloads) <= 1:
+        for b in payloads:
+            parts.append(_read_source_part(b, wanted, reader))
+            if on_done is not None:
+                on_done()
+        return parts
+    with _process_pool(workers) as ex:
+        futures = [ex.submit(_read_source_part, b, wanted, reader) for b in payloads]
+        try:
+            for fut in futures:
+                parts.append(fut.result())
+                if on_done is not None:
+                    on_done()
+        except BaseException:
+            for fut in futures:
+                fut.cancel()
+            raise
+    return parts
+
+def _union_columns(column_lists):
+    """
+    各檔欄名合併後的欄位（與 pd.concat 各檔資料的欄位相同：順序、重複欄名；
+    欄名不一致又有重複時同樣丟出例外）
+    """
+    return pd.concat([pd.DataFrame(columns=pd.Index(cols, dtype=object)) for cols in column_lists]).columns
+
+# --------------------------------------------------
+# 串流讀取（大檔省記憶體）：逐列讀 sheet XML、分批清洗，只留下對得到模板料號的來源列
+# --------------------------------------------------
+# 串流讀取每批列數
+STREAM_CHUNK_ROWS = 50_000
+
+# pandas 讀檔時視為缺值的字串（文字欄中這些值會變成 NaN）
+_EXCEL_NA_STRINGS = frozenset([
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+])
+
+def _excel_cell_value(cell):
+    """
+    儲存格 → 值，與 pandas openpyxl 引擎讀成文字欄（object）時相同：
+    空白 / 錯誤值 / 缺值字串 → NaN，整數值的數字 → int
+    """
+    value = cell.value
+    if value is None or cell.data_type == "e":
+        return np.nan
+    if cell.data_type == "n":
+        as_int = int(value)
+        return as_int if as_int == value else float(value)
+    if isinstance(value, str) and value in _EXCEL_NA_STRINGS:
+        return np.nan
+    return value
+
+def _row_width(row):
+    """去掉尾端空白格後的欄數（同 pandas：None 與空字串都算空白）"""
+    n = len(row)
+    while n and (row[n - 1].value is None or row[n - 1].value == ""):
+        n -= 1
+    return n
+
+def _open_last_sheet(file_bytes: bytes):
+    if _is_xls(file_bytes):
+        raise ValueError("串流讀取只支援 .xlsx，舊版 .xls 請改用一般讀取")
+    wb = openpyxl.load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True, keep_links=False)
+    ws = wb[wb.sheetnames[-1]]
+    ws.reset_dimensions()
+    return wb, ws
+
+def _sheet_header(file_bytes: bytes):
+    """只讀最後一個 sheet 的第 1 列欄名"""
+    wb, ws = _open_last_sheet(file_bytes)
+    try:
+        row = next(ws.rows, ())
+        return [_excel_cell_value(c) for c in row[:_row_width(row)]]
+    finally:
+        wb.close()
+
+def _typed_header(values):
+    """
+    欄名不是文字的欄位：與 pandas 讀整欄相同的型別推斷後的欄名
+    values：欄名 + 該欄其餘各列的值（例如整欄都是數字且有空白時，欄名 2024 → 2024.0）；
+    推斷結果只與出現過哪幾種值有關，每種一個代表值即可（見 _value_kind）
+    """
+    return TextParser([[v] for v in values], header=None, skip_blank_lines=False).read().iat[0, 0]
+
+_INT64_MAX = 2 ** 63 - 1
 
+def _value_kind(value):
+    """
+    _typed_header 型別推斷時值的種類：空白、布林、整數 / 小數（依正負與是否超出 int64）、
+    像數字的文字、一般文字、其他型別；同種類的值對推斷結果的影響相同
+    """
+    if isinstance(value, float) and np.isnan(value):
+        return "na"
+    if isinstance(value, (bool, np.bool_)):
+        return "bool"
+    if isinstance(value, str):
+        for kind, parse in (("str_int", int), ("str_float", float)):
+            try:
+                number = parse(value)
+            except (ValueError, OverflowError):
+                continue
+            return kind, number < 0, abs(number) > _INT64_MAX
+        return "str"
+    if isinstance(value, (int, float)):
+        return type(value).__name__, value < 0, abs(value) > _INT64_MAX
+    return type(value).__name__
+
+def _stream_sources(payloads, template_keys, wanted, chunk_rows=None, on_chunk=None, on_done=None):
+    """
+    依序串流讀取來源檔（第 8 列起），每 chunk_rows 列清洗一次 SAP 料號：
+    template_keys：各模板 B 欄清洗後的料號（每個模板一組）
+    - 料號不在某個模板 → 記為該模板的「來源料號未在模板出現」
+    - 在任一模板且是該料號第一次出現 → 保留這一列 wanted 欄位的值（每批轉成 object 欄位後清洗，
+      不經 pandas 型別推斷，值與一般讀取相同：整數不會因同欄有空白變成 1.0）
+    記憶體只與每批列數 + 對到的列數有關，不隨來源總列數成長
+    （欄名不是文字的欄位：依整欄型別決定欄名，同一般讀取；每種值只留一個代表值，見 _typed_header）
+    來源 SAP 欄的判斷與一般讀取相同
+    on_chunk()：每批呼叫一次（進度 / 取消）；on_done()：每讀完一個檔呼叫一次
+    回傳 dict：names（各檔全部欄名）、rows（各檔資料列數）、elapsed（各檔耗時）、
+    source_sap（保留列的料號，index = 合併後來源列 index）、source（保留列已清洗的欄位值，index 同上）、
+    missing（依 template_keys 順序，料號不在該模板的來源列：index → 料號，依來源列順序；
+    每批以 numpy 陣列累積，不逐列建 Python 物件）
+    """
+    if chunk_rows is None:
+        chunk_rows = STREAM_CHUNK_ROWS
+    headers = [_sheet_header(b) for b in payloads] if len(payloads) > 1 else None
+    union = _union_columns(headers) if headers is not None else None
+
+    key_sets = [set(keys) for keys in template_keys]
+    seen = set()
+    kept_idx, kept_sap = [], []
+    # 每批保留列：(列數, {欄名: 已清洗的 object 陣列})
+    kept_parts = []
+    kept_labels = {}
+    missing_out = [([], []) for _ in key_sets]
+    names_out, rows_out, elapsed_out = [], [], []
+    offset = 0
+
+    def flush(buf_idx, buf_sap, buf_values, labels):
+        sap = clean_series(pd.Series(buf_sap, index=buf_idx, dtype=object))
+        filled = ~_empty_mask(sap)
+        in_any = np.zeros(len(sap), dtype=bool)
+        for keys, (missing_idx, missing_sap) in zip(key_sets, missing_out):
+            in_tpl = sap.isin(keys).to_numpy(dtype=bool)
+            in_any |= in_tpl
+            missing = filled & ~in_tpl
+            if missing.any():
+                missing_idx.append(sap.index[missing].to_numpy(dtype=np.int64))
+                missing_sap.append(sap[missing].to_numpy(dtype=object))
+        take = []
+        for i in np.flatnonzero(in_any):
+            key = sap.iat[i]
+            if key in seen:
+                continue
+            seen.add(key)
+            kept_idx.append(buf_idx[i])
+            kept_sap.append(key)
+            take.append(i)
+        if take:
+            kept_parts.append((len(take), {
+                label: clean_series(pd.Series([buf_values[i][c] for i in take], dtype=object)).to_numpy()
+                for c, label in enumerate(labels)
+            }))
+        if on_chunk is not None:
+            on_chunk()
+
+    for k, b in enumerate(payloads):
+        t0 = time.perf_counter()
+        wb, ws = _open_last_sheet(b)
+        try:
+            rows = ws.rows
+            header_row = next(rows, None)
+            if header_row is None:
+                raise ValueError("來源檔的最後一個 sheet 沒有任何資料")
+            width = _row_width(header_row)
+            names = [_excel_cell_value(c) for c in header_row[:width]]
+            columns = union if union is not None else pd.Index(names, dtype=object)
+
+            # 來源 SAP 欄：合併後第一個像 SAP 料號的欄名；都沒有時用合併後第 2 欄
+            sap_label = next((c for c in columns if is_source_sap_column(c)), None)
+            if sap_label is not None:
+                sap_pos = names.index(sap_label) if sap_label in names else None
+            elif len(columns) >= 2:
+                fallback = columns[1]
+                if fallback not in names:
+                    sap_pos = None
+                elif len(names) >= 2 and names[0] == names[1] == fallback:
+                    sap_pos = 1
+                else:
+                    sap_pos = names.index(fallback)
+            else:
+                sap_pos = 1
+
+            # 模板用到的欄名：欄名重複時取第一個出現的欄位
+            positions = {}
+            for j, name in enumerate(names):
+                if isinstance(name, str) and name in wanted and name not in positions:
+                    positions[name] = j
+            labels = list(positions)
+            for label in labels:
+                kept_labels.setdefault(label, None)
+            picks = list(positions.values())
+            # 欄名不是文字的欄位：值的種類 → 代表值（整欄空白列只在後面還有資料時才算，同一般讀取不含尾端空白列）
+            typed = {j: {} for j, name in enumerate(names) if not isinstance(name, str) and not pd.isna(name)}
+            blank_pending = False
+
+            buf_idx, buf_sap, buf_values = [], [], []
+            last_data = 0 if width else -1
+            for r, row in enumerate(rows, start=1):
+                n = _row_width(row)
+                if not n:
+                    blank_pending = bool(typed)
+                    continue
+                last_data = r
+                width = max(width, n)
+                for j, kinds in typed.items():
+                    value = _excel_cell_value(row[j]) if j < n else np.nan
+                    kinds.setdefault(_value_kind(value), value)
+                    if blank_pending:
+                        kinds.setdefault("na", np.nan)
+                blank_pending = False
+                if r < SOURCE_FIRST_DATA_EXCEL_ROW - 1:
+                    continue
+                buf_idx.append(offset + r - (SOURCE_FIRST_DATA_EXCEL_ROW - 1))
+                buf_sap.append(_excel_cell_value(row[sap_pos]) if sap_pos is not None and sap_pos < n else np.nan)
+                buf_values.append([_excel_cell_value(row[j]) if j < n else np.nan for j in picks])
+                if len(buf_idx) >= chunk_rows:
+                    flush(buf_idx, buf_sap, buf_values, labels)
+                    buf_idx, buf_sap, buf_values = [], [], []
+            if buf_idx:
+                flush(buf_idx, buf_sap, buf_values, labels)
+        finally:
+            wb.close()
+
+        # 欄名列以外還有更寬的列：多出來的欄位欄名為空白（同 pandas）；尾端空白列不算在整欄內
+        for j, kinds in typed.items():
+            names[j] = _typed_header([names[j]] + list(kinds.values()))
+        names_out.append(names + [np.nan] * (width - len(names)))
+        n_rows = max(0, last_data + 1 - (SOURCE_FIRST_DATA_EXCEL_ROW - 1))
+        rows_out.append(n_rows)
+        elapsed_out.append(time.perf_counter() - t0)
+        offset += n_rows
+        if on_done is not None:
+            on_done()
+
+    # 某個檔沒有的欄位補 None（同一般讀取合併後清洗）
+    source = pd.DataFrame(
+        {
+            label: pd.Series(
+                np.concatenate([part.get(label, np.full(n, None, dtype=object)) for n, part in kept_parts])
+                if kept_parts else np.empty(0, dtype=object),
+                index=kept_idx,
+                dtype=object,
+            )
+            for label in kept_labels
+        },
+        index=pd.Index(kept_idx, dtype=np.int64),
+        columns=list(kept_labels),
+    )
+    source.attrs[_CLEANED_ATTR] = True
+    return {
+        "names": names_out,
+        "rows": rows_out,
+        "elapsed": elapsed_out,
+        "source_sap": pd.Series(kept_sap, index=kept_idx, dtype=object),
+        "source": source,
+        "missing": [
+            pd.Series(
+                np.concatenate(missing_sap) if missing_sap else np.empty(0, dtype=object),
+                index=np.concatenate(missing_idx) if missing_idx else np.empty(0, dtype=np.int64),
+                dtype=object,
+            )
+            for missing_idx, missing_sap in missing_out
+        ],
+    }
+
+# --------------------------------------------------
+# 各階段量測：耗時 / 處理量 / 記憶體峰值（stats["階段明細"]、LOG 結尾）
+# --------------------------------------------------
+RUN_STAGES = ("read", "merge", "clean", "align", "validate", "write")
+RUN_STAGE_LABELS = {
+    "read": "讀檔",
+    "merge": "合併",
+    "clean": "清洗",
+    "align": "料號對齊",
+    "validate": "校驗",
+    "write": "輸出",
+}
+
+def peak_rss_mb():
+    """
+    目前行程的記憶體峰值（MB，ru_maxrss）；不支援的平台回傳 None
+    平行讀檔的子行程不含在內；Linux 上 reset_stage_peak 後由重設時起算
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 單位 KB，macOS 為 bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+# 階段峰值基準：Linux 可重設 VmHWM 時為 None；其他平台為上次重設時的行程峰值
+_stage_peak_floor = None
+
+def reset_stage_peak():
+    """
+    各階段記憶體峰值從現在重新起算：Linux 寫 /proc/self/clear_refs 重設 VmHWM；
+    其他平台無法重設，記下目前的行程峰值當基準（見 stage_peak_rss_mb）
+    同一行程同時有多個執行（Streamlit 多個工作階段）時峰值是整個行程的
+    """
+    global _stage_peak_floor
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        _stage_peak_floor = None
+    except OSError:
+        _stage_peak_floor = peak_rss_mb() or 0.0
+
+def stage_peak_rss_mb():
+    """
+    上次 reset_stage_peak 之後的記憶體峰值（MB）
+    無法重設的平台只有行程至今的峰值：超過基準表示峰值出現在這段期間，否則不知道（None）
+    """
+    peak = peak_rss_mb()
+    if peak is None or (_stage_peak_floor is not None and peak <= _stage_peak_floor):
+        return None
+    return peak
+
+def _lap(timings, stage, t0, peaks=None):
+    """
+    把 t0 到現在的時間記到 stage（peaks 有給就一併記下這段期間的記憶體峰值，並重新起算），
+    回傳現在時間（下一段的起點）；同一階段記多次時峰值取最大
+    """
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.0) + now - t0
+    if peaks is not None:
+        known = [p for p in (peaks.get(stage), stage_peak_rss_mb()) if p is not None]
+        peaks[stage] = max(known) if known else None
+        reset_stage_peak()
+    return now
+
+def _per_second(count, seconds):
+    if count is None:
+        return None
+    return round(count / seconds) if seconds > 0 else None
+
+def stage_report(timings, sizes, peaks):
+    """
+    各階段明細（依 RUN_STAGES 順序）：耗時、列數 / 格數與每秒處理量、記憶體峰值
+    sizes：{階段: (列數, 格數)}，格數可為 None（該階段不以格為單位）
+    """
+    report = []
+    for stage in RUN_STAGES:
+        if stage not in timings:
+            continue
+        seconds = timings[stage]
+        rows, cells = sizes.get(stage, (None, None))
+        report.append({
+            "階段": stage,
+            "說明": RUN_STAGE_LABELS[stage],
+            "耗時(秒)": round(seconds, 3),
+            "列數": rows,
+            "列/秒": _per_second(rows, seconds),
+            "格數": cells,
+            "格/秒": _per_second(cells, seconds),
+            "記憶體峰值(MB)": peaks.get(stage),
+        })
+    return report
+
+def stage_report_lines(report):
+    lines = ["", "=== 階段明細 ==="]
+    for r in report:
+        text = f"{r['階段']}（{r['說明']}）：{r['耗時(秒)']:.3f} 秒"
+        if r["列數"] is not None:
+            text += f"，{r['列數']:,} 列"
+            if r["列/秒"] is not None:
+                text += f"（{r['列/秒']:,} 列/秒）"
+        if r["格數"] is not None:
+            text += f"，{r['格數']:,} 格"
+            if r["格/秒"] is not None:
+                text += f"（{r['格/秒']:,} 格/秒）"
+        if r["記憶體峰值(MB)"] is not None:
+            text += f"，記憶體峰值 {r['記憶體峰值(MB)']:,} MB"
+        lines.append(text)
+    return lines
+
+# 進度事件：progress(stage, done, total)；各階段估計佔整體的比重（估 ETA 用，依 benchmark 大致比例）
+RUN_STAGE_WEIGHTS = {"read": 0.5, "merge": 0.02, "clean": 0.06, "align": 0.02, "validate": 0.08, "write": 0.32}
+# 輸出時每寫幾列回報一次進度 / 檢查一次取消
+PROGRESS_EVERY_ROWS = 10_000
+
+class RunCancelled(Exception):
+    """cancel token 已設定：執行中止，已產生的中間結果全部丟棄"""
+
+def _progress(progress, cancel, stage, done, total):
+    """
+    階段 / 分塊邊界：先檢查取消（cancel 為任何有 is_set() 的物件，例如 threading.Event），再回報進度
+    """
+    if cancel is not None and cancel.is_set():
+        raise RunCancelled("執行已取消")
+    if progress is not None:
+        progress(stage, done, total)
+
+def progress_fraction(stage, done, total):
+    """進度事件 → 整體完成比例（0~1，依 RUN_STAGE_WEIGHTS 加權）"""
+    before = sum(RUN_STAGE_WEIGHTS[s] for s in RUN_STAGES[:RUN_STAGES.index(stage)])
+    return min(1.0, before + RUN_STAGE_WEIGHTS[stage] * (done / total if total else 1.0))
+
+def _counted(rows, tick, every=PROGRESS_EVERY_ROWS):
+    """逐列轉交 rows，每 every 列（與最後）呼叫 tick(列數)"""
+    n = 0
+    for row in rows:
+        yield row
+        n += 1
+        if n == every:
+            tick(n)
+            n = 0
+    if n:
+        tick(n)
+
+def run_profiled(func, *args, **kwargs):
+    """
+    以 cProfile 執行 func，回傳 (func 的結果, pstats 檔內容 bytes)
+    pstats 檔可用 python -m pstats 或 snakeviz 等工具離線分析
+    """
+    prof = cProfile.Profile()
+    result = prof.runcall(func, *args, **kwargs)
+    return result, _dump_profile(pstats.Stats(prof))
+
+def merge_profiles(*profiles):
+    """多段 pstats 檔內容合併成一份（例如 prepare_run + render_outputs）"""
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for i, data in enumerate(profiles):
+            paths.append(os.path.join(folder, f"{i}.pstats"))
+            with open(paths[-1], "wb") as f:
+                f.write(data)
+        return _dump_profile(pstats.Stats(*paths))
+
+def _dump_profile(stats):
+    fd, path = tempfile.mkstemp(suffix=".pstats")
+    os.close(fd)
+    try:
+        stats.dump_stats(path)
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.unlink(path)
+
+def content_hash(data: bytes) -> str:
+    """檔案內容雜湊（快取 key 用）"""
+    return hashlib.sha256(data).hexdigest()
+
+# --------------------------------------------------
+# 本機快取：來源檔逐檔（讀檔 + 清洗結果）、模板的上次校驗結果
+# 只改了少數來源檔時，其餘檔案不必重讀，值沒變的列也不必重新校驗
+# --------------------------------------------------
+RUN_CACHE_VERSION = 1
+
+def _cache_load(path, version=RUN_CACHE_VERSION):
+    """讀快取檔；不存在、版本不符或讀不出來都當成沒有快取"""
+    try:
+        with open(path, "rb") as f:
+            obj = pickle.load(f)
+    except Exception:
+        return None
+    if not isinstance(obj, dict) or obj.get("version") != version:
+        return None
+    return obj
+
+def _cache_save(path, obj, version=RUN_CACHE_VERSION):
+    """先寫暫存檔再換名，同時有多個工作寫同一個快取也不會讀到寫一半的檔"""
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(dict(obj, version=version), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def _source_cache_path(cache_dir, file_hash):
+    return os.path.join(cache_dir, "sources", f"{file_hash}.pkl")
+
+def _validation_cache_path(cache_dir, template_hash):
+    return os.path.join(cache_dir, "validation", f"{template_hash}.pkl")
+
+# --------------------------------------------------
+# 模板編譯快取：模板內容雜湊 → 編譯好的模板（欄名、規則、選項、清洗後 B 欄料號…）
+# 固定的幾個模板每天跑上百次，不必每次重開 xlsx；同一個使用者的所有行程 / CLI 共用同一個資料夾
+# 快取檔是 pickle（載入即可執行任意程式），只用目前使用者專用、別人不能寫的資料夾（見 private_dir）
+# --------------------------------------------------
+TEMPLATE_CACHE_DIR = os.path.join(
+    tempfile.gettempdir(), f"cgmatch_templates_{os.getuid()}" if hasattr(os, "getuid") else "cgmatch_templates"
+)
+# 編譯結果格式有變時加 1（舊版本的檔案視為沒有快取，之後依大小淘汰）
+TEMPLATE_CACHE_VERSION = 2
+# 快取資料夾總大小上限（bytes），超過時刪掉最久沒用的
+TEMPLATE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# 模板 Sheet1：第 7 列開始為資料、B 欄為 SAP 料號
+TEMPLATE_FIRST_DATA_ROW = 6
+SAP_COL_TEMPLATE = 1
+
+def compile_template(tpl_bytes: bytes, reader="auto"):
+    """
+    讀模板（Sheet1 + Sheet2 選項）並編譯成執行時用到的全部內容
+    回傳 (compiled, 耗時秒, 引擎)；compiled 為 dict：
+    header（第 1 列欄名）、output_df（整張 Sheet1，object 欄）、rules（欄位索引 → ColumnRule，已含選項）、
+    template_sap_series（清洗後 B 欄料號）、template_sap_valid（非空白料號）、sap_dup_rows（料號重複的模板列）、
+    template_names（欄名集合）、warnings（讀 Sheet2 失敗等 LOG 行）
+    xlsx 模板一律用 openpyxl：calamine 把純空白文字格讀成空白格，模板輸出（output_df）會少掉這些格；
+    模板只有幾欄，讀檔時間主要在來源，reader 只影響 .xls 模板
+    """
+    tpl_reader = reader if _is_xls(tpl_bytes) else "openpyxl"
+    tpl_frames, tpl_errors, elapsed, engine = _read_workbook(tpl_bytes, [0, 1], reader=tpl_reader)
+    if 0 in tpl_errors:
+        raise tpl_errors[0]
+
+    warnings = []
     options_map = {}
     try:
-        opt_df = _read_excel_bytes(tpl_bytes, sheet_name=1, header=None)
+        if 1 in tpl_errors:
+            raise tpl_errors[1]
+        opt_df = tpl_frames[1]
         header2 = opt_df.iloc[0]
         for col in range(opt_df.shape[1]):
             field = str(header2[col]).strip()
@@ -232,59 +1891,408 @@ def run_core_web(source_files, template_file, only_error_report=False):
             if opts:
                 options_map[field] = set(opts)
     except Exception as e:
-        log_lines.append(f"[警告] 第二頁籤讀取失敗：{e}")
+        warnings.append(f"[警告] 第二頁籤讀取失敗：{e}")
 
-    # --------------------------------------------------
-    # 1) 合併來源資料：每個來源檔的最後一個 sheet
-    # --------------------------------------------------
-    merged_df = None
-    for uf in source_files:
-        df_raw = _read_last_sheet(uf.getvalue())
-        header_src = df_raw.iloc[0]
-        data = df_raw.iloc[7:].reset_index(drop=True)  # 第 8 列開始
-        data.columns = header_src
-
-        if merged_df is None:
-            merged_df = data
-        else:
-            merged_df = pd.concat([merged_df, data], ignore_index=True)
+    # 模板 Sheet1：欄名 / 規則列 / B 欄料號
+    target_df = tpl_frames[0]
+    header = target_df.iloc[0]
+    type_row = target_df.iloc[3].astype(str)
+    length_row = target_df.iloc[4]
+    require_row = target_df.iloc[5]
 
-    if merged_df is None or merged_df.empty:
-        raise ValueError("來源資料為空，請確認來源檔案內容。")
+    template_sap_series = clean_series(target_df.iloc[TEMPLATE_FIRST_DATA_ROW:, SAP_COL_TEMPLATE])
+    dup_mask = template_sap_series.duplicated(keep=False) & template_sap_series.notna()
+    compiled = {
+        "header": header,
+        "output_df": target_df.astype(object),  # 寫入來源值（字串 / None）前統一為 object 欄
+        "rules": compile_template_rules(header, type_row, length_row, require_row, options_map),
+        "template_sap_series": template_sap_series,
+        "template_sap_valid": template_sap_series[~_empty_mask(template_sap_series)],
+        "sap_dup_rows": template_sap_series.index[dup_mask].to_numpy().astype(np.int64),
+        "template_names": {str(h).strip() for h in header} - {""},
+        "warnings": warnings,
+    }
+    return compiled, elapsed, engine
 
-    # 2) clean
+def private_dir(folder):
+    """
+    資料夾可以放 pickle 快取嗎：不存在就建立（0700）；已存在時必須是目前使用者的、不是符號連結、
+    群組 / 其他人不能寫（POSIX），否則別人可以預先放好快取檔讓我們載入
+    """
     try:
-        merged_clean = merged_df.map(clean_text)  # pandas 2+
-    except Exception:
-        merged_clean = merged_df.applymap(clean_text)
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        st = os.lstat(folder)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    if not hasattr(os, "getuid"):
+        return True  # Windows：系統暫存資料夾本來就是每個使用者各一個
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def _template_cache_path(cache_dir, template_hash):
+    return os.path.join(cache_dir, f"{template_hash}.v{TEMPLATE_CACHE_VERSION}.pkl")
+
+def _evict_cache_files(folder, max_bytes, keep=None):
+    """資料夾內的快取檔總大小超過 max_bytes 時，依最後使用時間（mtime）由舊到新刪除；keep 不刪"""
+    try:
+        entries = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
 
-    # 3) 來源 SAP 欄 & mapping
-    source_sap_series_raw = get_source_sap_series(merged_clean)
-    source_sap_series = source_sap_series_raw.map(clean_text)
+def load_template(tpl_bytes: bytes, reader="auto", cache_dir=TEMPLATE_CACHE_DIR, template_hash=None):
+    """
+    編譯好的模板：cache_dir 有同內容（+ 同格式版本）的快取就直接載入，否則讀 xlsx 編譯後存入
+    cache_dir=None 或不是目前使用者專用的資料夾（見 private_dir）：不使用快取；各引擎讀出的值相同，快取不分引擎
+    回傳 (compiled, 耗時秒, 引擎 或 None（= 使用快取）)
+    """
+    t0 = time.perf_counter()
+    if cache_dir is not None and not private_dir(cache_dir):
+        cache_dir = None
+    if cache_dir is not None:
+        path = _template_cache_path(cache_dir, template_hash or content_hash(tpl_bytes))
+        entry = _cache_load(path, TEMPLATE_CACHE_VERSION)
+        if entry is not None:
+            try:
+                os.utime(path)  # 更新最後使用時間（淘汰順序）
+            except OSError:
+                pass
+            return entry["compiled"], time.perf_counter() - t0, None
 
-    sap_to_index = {}
-    for i, mat in source_sap_series.items():
-        if is_empty(mat):
-            continue
-        if mat not in sap_to_index:
-            sap_to_index[mat] = i
+    compiled, _, engine = compile_template(tpl_bytes, reader)
+    if cache_dir is not None:
+        try:
+            _cache_save(path, {"compiled": compiled}, TEMPLATE_CACHE_VERSION)
+            _evict_cache_files(cache_dir, TEMPLATE_CACHE_MAX_BYTES, keep=path)
+        except OSError:
+            pass  # 快取資料夾不能寫時照常執行
+    return compiled, time.perf_counter() - t0, engine
 
-    # 4) 讀模板 Sheet1
-    target_df = _read_excel_bytes(tpl_bytes, sheet_name=0, header=None)
-    header = target_df.iloc[0]
-    type_row = target_df.iloc[3].astype(str)
-    length_row = target_df.iloc[4]
-    require_row = target_df.iloc[5]
+def _read_sources_cached(payloads, cache_dir, workers=None, rebuild=False, on_done=None, reader="auto"):
+    """
+    來源檔逐檔快取（key = 檔案內容雜湊）：只重讀 / 重新清洗沒有快取的檔案
+    各引擎讀出的值相同，快取不分引擎
+    on_done()：每個檔案（含使用快取的）處理完呼叫一次
+    回傳 [(原始資料, 清洗後資料 或 None, 耗時秒 或 None（= 使用快取）, 引擎 或 None), ...]，依上傳順序
+    """
+    hashes = [content_hash(b) for b in payloads]
+    entries = {}
+    if not rebuild:
+        for h in dict.fromkeys(hashes):
+            entry = _cache_load(_source_cache_path(cache_dir, h))
+            if entry is not None:
+                entries[h] = entry
+
+    missing = [h for h in dict.fromkeys(hashes) if h not in entries]
+    if on_done is not None:
+        for h in hashes:
+            if h not in missing:
+                on_done()
+    payload_of = dict(zip(hashes, payloads))
+    read_parts = _read_sources([payload_of[h] for h in missing], workers=workers, on_done=on_done, reader=reader)
+    fresh = dict(zip(missing, read_parts))
+    for h, (data, _, elapsed, _) in fresh.items():
+        entries[h] = {"data": data, "clean": clean_frame(data), "elapsed": elapsed}
+        _cache_save(_source_cache_path(cache_dir, h), entries[h])
+    if on_done is not None:
+        # 同一個檔案上傳多次只讀一次，其餘次數在這裡補回報
+        for _ in range(sum(h in fresh for h in hashes) - len(fresh)):
+            on_done()
+
+    return [
+        (entries[h]["data"], entries[h]["clean"], *((fresh[h][2], fresh[h][3]) if h in fresh else (None, None)))
+        for h in hashes
+    ]
+
+def _merge_cleaned(datas, cleans):
+    """
+    逐檔清洗結果合併；與「先合併原始資料再清洗」相同
+    原始欄位都是文字 / object 時 concat 不會改值，缺欄補的 NaN 改成 None 即可
+    有數字 / 日期型別的欄位（concat 可能轉型，例如 int → float）就改回先合併再清洗
+    """
+    plain = all(
+        pd.api.types.is_object_dtype(dt) or pd.api.types.is_string_dtype(dt)
+        for data in datas for dt in data.dtypes
+    )
+    if not plain:
+        return clean_frame(pd.concat(datas, ignore_index=True))
+
+    merged = pd.concat(cleans, ignore_index=True)
+    for i in range(merged.shape[1]):
+        values = merged.iloc[:, i].to_numpy(dtype=object, copy=True)
+        missing = pd.isna(values)
+        if missing.any():
+            values[missing] = None
+            merged.isetitem(i, values)
+    merged = merged.astype(object)
+    merged.attrs[_CLEANED_ATTR] = True
+    return merged
+
+def _validate_changed(rule, rows, values, prev, memo=None):
+    """
+    與 validate_column 結果相同，但只重新校驗值有變動的列
+    prev：上次同一欄的 {"rule", "rows", "values", "err_rows", "codes"}（規則不同就整欄重驗）
+    回傳 (位置, 錯誤代碼, 重新校驗的列數)
+    """
+    if prev is None or prev["rule"] != rule:
+        pos, codes = validate_column(rule, values, memo)
+        return pos, codes, len(values)
+
+    loc = pd.Index(prev["rows"]).get_indexer(rows)
+    same = loc >= 0
+    before, now = prev["values"][loc[same]], values[same]
+    same[same] = (before == now) | (pd.isna(before) & pd.isna(now))
+    changed = np.flatnonzero(~same)
+
+    pos_new, codes_new = validate_column(rule, values[changed], memo)
+    pos_new = changed[pos_new]
+
+    # 沒變的列沿用上次的錯誤代碼
+    keep = np.isin(prev["err_rows"], rows[same])
+    pos_old = pd.Index(rows).get_indexer(prev["err_rows"][keep])
+
+    pos = np.concatenate([pos_new, pos_old]).astype(np.int64)
+    codes = np.concatenate([codes_new, prev["codes"][keep]]).astype(np.int8)
+    order = np.lexsort((codes, pos))
+    return pos[order], codes[order], len(changed)
+
+def _check_error_format(error_format):
+    if error_format not in ERROR_REPORT_FORMATS:
+        raise ValueError(f"不支援的錯誤報表格式：{error_format}（可用：{', '.join(ERROR_REPORT_FORMATS)}）")
+    if not error_format_installed(error_format):
+        # 執行前就擋下，不要等讀檔 / 校驗都做完才在輸出時失敗
+        raise ValueError(f"錯誤報表輸出 {error_format} 需要安裝 {_ERROR_FORMAT_MODULES[error_format][1]}")
+
+def _check_error_report_mode(mode):
+    if mode not in ERROR_REPORT_MODES:
+        raise ValueError(f"不支援的錯誤報表內容：{mode}（可用：{', '.join(ERROR_REPORT_MODES)}）")
+
+def _load_run_template(template_file, reader="auto", template_cache_dir=TEMPLATE_CACHE_DIR):
+    """
+    讀模板（有編譯快取就直接載入）
+    回傳 dict：compiled（見 compile_template）、hash（內容雜湊）、engine（None = 使用快取）、seconds、log_lines
+    """
+    t0 = time.perf_counter()
+    tpl_bytes = template_file.getvalue()
+    tpl_hash = content_hash(tpl_bytes)
+    cache_lines = []
+    if template_cache_dir is not None and not private_dir(template_cache_dir):
+        cache_lines.append(f"[警告] 模板編譯快取資料夾 {template_cache_dir} 不是目前使用者專用（或別人可寫），這次不使用快取")
+        template_cache_dir = None
+    compiled, tpl_elapsed, engine = load_template(tpl_bytes, reader, template_cache_dir, tpl_hash)
+    if engine is None:
+        line = f"[讀檔] 模板 {_file_label(template_file, '-')}：使用編譯快取 {tpl_elapsed:.3f} 秒"
+    else:
+        line = f"[讀檔] 模板 {_file_label(template_file, '-')}：{tpl_elapsed:.2f} 秒（{engine}）"
+    return {
+        "compiled": compiled,
+        "hash": tpl_hash,
+        "engine": engine,
+        "seconds": time.perf_counter() - t0,
+        "log_lines": [line] + cache_lines + compiled["warnings"],
+    }
+
+def prepare_sources(
+    source_files,
+    templates,
+    read_workers=None,
+    cache_dir=None,
+    rebuild=False,
+    stream=False,
+    reader="auto",
+    progress=None,
+    cancel=None,
+):
+    """
+    讀檔 → 合併 → 清洗來源檔、建好來源料號索引：與模板無關的部分，多個模板共用同一份（見 run_multi_template）
+    templates：編譯好的模板（load_template）；只解析各模板欄名的聯集，串流時保留對到任一模板料號的列
+    其餘參數同 prepare_run；回傳 dict，交給 _prepare_template 逐一比對模板
+    （source_missing：依 templates 順序，各模板「來源料號未在模板出現」的來源列）
+    """
+    start_time = time.time()
+    timings = dict.fromkeys(("read", "merge", "clean"), 0.0)
+    peaks = {}
+    sizes = {}
+    reset_stage_peak()
+    t = time.perf_counter()
+    log_lines = []
+    engines = []
+
+    # --------------------------------------------------
+    # 1) 合併來源資料：每個來源檔的最後一個 sheet
+    # --------------------------------------------------
+    source_files = list(source_files)
+    payloads = [uf.getvalue() for uf in source_files]
+    files_read = 0
+
+    def file_done():
+        nonlocal files_read
+        files_read += 1
+        _progress(progress, cancel, "read", files_read, len(payloads))
+
+    # 來源只解析模板第 1 列有的欄位（+ SAP 欄）；快取的來源檔保留全部欄位，換模板也能沿用
+    template_names = set().union(*(tpl["template_names"] for tpl in templates))
+    _progress(progress, cancel, "read", 0, len(payloads))
+    if stream:
+        streamed = _stream_sources(
+            payloads,
+            [tpl["template_sap_valid"] for tpl in templates],
+            template_names,
+            on_chunk=lambda: _progress(progress, cancel, "read", files_read, len(payloads)),
+            on_done=file_done,
+        )
+        source_names = streamed["names"]
+        engines.append("openpyxl（串流）")
+        for i, (uf, elapsed) in enumerate(zip(source_files, streamed["elapsed"]), start=1):
+            log_lines.append(f"[讀檔] 來源 {_file_label(uf, f'#{i}')}：{elapsed:.2f} 秒（串流）")
+        if sum(streamed["rows"]) == 0:
+            raise ValueError("來源資料為空，請確認來源檔案內容。")
+        all_columns = _union_columns(source_names)
+        source_rows = sum(streamed["rows"])
+        sizes["read"] = (source_rows, source_rows * (streamed["source"].shape[1] + 1))
+        t = _lap(timings, "read", t, peaks)
+        # 串流時只留下對得到模板料號的來源列（已清洗）；清洗算在讀檔階段
+        merged_clean = streamed["source"]
+        source_sap_series = streamed["source_sap"]
+        source_missing = streamed["missing"]
+        log_lines.append(
+            f"[讀檔] 來源串流：{source_rows} 列中保留 {len(merged_clean)} 列（對到模板料號的第一筆），"
+            f"每批 {STREAM_CHUNK_ROWS} 列"
+        )
+        _progress(progress, cancel, "clean", 1, 1)
+        sizes["merge"] = sizes["clean"] = (len(merged_clean), merged_clean.size)
+    else:
+        if cache_dir is None:
+            read_parts = _read_sources(
+                payloads, workers=read_workers, on_done=file_done, wanted=template_names, reader=reader
+            )
+            parts = [(data, None, elapsed) for data, _, elapsed, _ in read_parts]
+            source_names = [names for _, names, _, _ in read_parts]
+        else:
+            read_parts = _read_sources_cached(
+                payloads, cache_dir, workers=read_workers, rebuild=rebuild, on_done=file_done, reader=reader
+            )
+            parts = [(data, clean, elapsed) for data, clean, elapsed, _ in read_parts]
+            source_names = [list(data.columns) for data, _, _ in parts]
+        for i, (uf, (_, _, elapsed, engine)) in enumerate(zip(source_files, read_parts), start=1):
+            if elapsed is None:
+                log_lines.append(f"[讀檔] 來源 {_file_label(uf, f'#{i}')}：使用快取")
+            else:
+                engines.append(engine)
+                log_lines.append(f"[讀檔] 來源 {_file_label(uf, f'#{i}')}：{elapsed:.2f} 秒（{engine}）")
+
+        if not parts or sum(len(data) for data, _, _ in parts) == 0:
+            raise ValueError("來源資料為空，請確認來源檔案內容。")
+
+        # 全部來源欄名（含沒解析的欄位），順序 / 重複與合併全部欄位時相同
+        all_columns = _union_columns(source_names)
+        if not any(is_source_sap_column(c) for c in all_columns) and len(all_columns) >= 2:
+            # 沒有 SAP 料號欄時以合併後第 2 欄當料號；該欄在其他檔案不在前兩欄又沒被解析時補讀
+            fallback = all_columns[1]
+            stale = [
+                i for i, (data, _, _) in enumerate(parts)
+                if fallback in source_names[i] and fallback not in data.columns
+            ]
+            reread = _read_sources(
+                [payloads[i] for i in stale], workers=read_workers, wanted=template_names | {fallback}, reader=reader
+            )
+            for i, (data, _, elapsed, _) in zip(stale, reread):
+                parts[i] = (data, None, elapsed)
+                log_lines.append(f"[讀檔] 來源 {_file_label(source_files[i], f'#{i + 1}')}：補讀欄位「{fallback}」{elapsed:.2f} 秒")
+
+        source_rows = sum(len(data) for data, _, _ in parts)
+        sizes["read"] = (source_rows, sum(data.size for data, _, _ in parts))
+        t = _lap(timings, "read", t, peaks)
+
+        if cache_dir is None:
+            # 一次 concat：index 依上傳順序連續編號，SourceRow 與逐檔累加時相同
+            merged_df = pd.concat([data for data, _, _ in parts], ignore_index=True)
+            log_lines.append(f"[讀檔] 來源欄位：解析 {merged_df.shape[1]} / {len(all_columns)} 欄（模板用到的欄位）")
+            t = _lap(timings, "merge", t, peaks)
+            _progress(progress, cancel, "merge", 1, 1)
+            # 2) clean（逐欄向量化，結果同 clean_text）
+            merged_clean = clean_frame(merged_df)
+            t = _lap(timings, "clean", t, peaks)
+        else:
+            # 2) 逐檔清洗結果（快取）直接合併
+            merged_clean = _merge_cleaned([data for data, _, _ in parts], [clean for _, clean, _ in parts])
+            t = _lap(timings, "merge", t, peaks)
+        _progress(progress, cancel, "clean", 1, 1)
+        sizes["merge"] = sizes["clean"] = (len(merged_clean), merged_clean.size)
+
+        # 3) 來源 SAP 欄 & mapping（已清洗過的欄位不會再清一次）；料號不在各模板的來源列
+        source_sap_series = clean_series(get_source_sap_series(merged_clean))
+        source_missing = _missing_source_keys(source_sap_series, templates)
+
+    # 來源欄名重複：明確以第一個出現的欄位比對（模板用到的欄名每個出現位置都有解析）
+    source_unique, _ = dedupe_columns(merged_clean)
+    return {
+        "log_lines": log_lines,
+        "engines": engines,
+        "all_columns": all_columns,
+        "source_unique": source_unique,
+        "dup_source_cols": list(dict.fromkeys(all_columns[all_columns.duplicated(keep="first")])),
+        "source_sap_series": source_sap_series,
+        "source_keys": source_key_index(source_sap_series),
+        "source_missing": source_missing,
+        "timings": timings,
+        "stage_peaks": peaks,
+        "stage_sizes": sizes,
+        "seconds": time.time() - start_time,
+    }
+
+def _missing_source_keys(source_sap_series, templates):
+    """各模板「來源料號未在模板出現」的來源列（依 templates 順序；index → 料號，依來源列順序）"""
+    filled = ~_empty_mask(source_sap_series)
+    return [
+        source_sap_series[filled & ~source_sap_series.isin(tpl["template_sap_valid"]).to_numpy(dtype=bool)]
+        for tpl in templates
+    ]
+
+def _prepare_template(sources, tpl, index=0, cache_dir=None, rebuild=False, validate_workers=None, progress=None, cancel=None):
+    """
+    單一模板：對齊 → 校驗（來源共用 prepare_sources 的結果，不會修改它）
+    tpl：_load_run_template 的結果；index：tpl 在 prepare_sources 的 templates 中的位置
+    回傳 state（同 prepare_run）
+    """
+    start_time = time.time()
+    timings = dict(sources["timings"], read=sources["timings"]["read"] + tpl["seconds"])
+    peaks = dict(sources["stage_peaks"])
+    sizes = dict(sources["stage_sizes"])
+    reset_stage_peak()
+    t = time.perf_counter()
+    log_lines = tpl["log_lines"] + sources["log_lines"]
+    engines = ([tpl["engine"]] if tpl["engine"] is not None else []) + sources["engines"]
 
-    start_row = 6
-    SAP_COL_TEMPLATE = 1
-    output_df = target_df.copy()
+    source_issue_list = []
+    errors = ErrorStore()
 
-    template_sap_series_raw = target_df.iloc[start_row:, SAP_COL_TEMPLATE]
-    template_sap_series = template_sap_series_raw.map(clean_text)
+    # 模板 Sheet1：欄名 / 規則 / B 欄料號
+    template = tpl["compiled"]
+    header = template["header"]
+    rules = template["rules"]
+    output_df = template["output_df"]
+    template_sap_series = template["template_sap_series"]
+    source_sap_series = sources["source_sap_series"]
+    source_unique = sources["source_unique"]
 
     # 來源 vs 模板：欄位存在性（來源多出來）
-    source_columns = {str(c).strip() for c in merged_clean.columns}
+    source_columns = {str(c).strip() for c in sources["all_columns"]}
     template_columns = {str(h).strip() for h in header}
     missing_cols = sorted(c for c in source_columns if c and c not in template_columns)
 
@@ -296,162 +2304,215 @@ def run_core_web(source_files, template_file, only_error_report=False):
             "Message": f"來源欄位「{col_name}」未出現在模板的欄位列(第1列)中"
         })
 
-    # 來源 vs 模板：料號存在性（來源有、模板沒有）
-    template_sap_set = {mat for mat in template_sap_series if not is_empty(mat)}
-    for idx, mat in source_sap_series.items():
-        if is_empty(mat):
-            continue
-        if mat not in template_sap_set:
-            src_excel_row = SOURCE_FIRST_DATA_EXCEL_ROW + idx
-            msg = f"來源料號 {mat} (Row {src_excel_row}) 未在模板 B 欄任一列出現"
-            source_issue_list.append({
-                "SourceRow": src_excel_row,
-                "Material": mat,
-                "ErrorType": "來源料號未在模板出現",
-                "Message": msg
-            })
-            log_lines.append(f"[來源料號未在模板出現] {msg}")
-
-    # 模板行 → 來源行
-    row_map_template_to_source = {}
-    for row_out, mat in template_sap_series.items():
-        if is_empty(mat):
-            continue
-        if mat in sap_to_index:
-            row_map_template_to_source[row_out] = sap_to_index[mat]
-
-    # 5) 寫入 + 校驗
-    for c in range(len(header)):
-        col_name = str(header[c]).strip()
-        if not col_name:
-            continue
-        if col_name not in merged_clean.columns:
-            continue
-
-        type_code = type_row[c]
-        type_code_str = str(type_code).strip().upper() if not pd.isna(type_code) else ""
-        length_limit = length_row[c]
-        required_flag = str(require_row[c]).upper() == "V"
-
-        is_date_col = (type_code_str == "DATE" or ("DATE" in str(col_name).upper()))
-        series = merged_clean[col_name]
-
-        for row_out, src_idx in row_map_template_to_source.items():
-            v_raw = series.iloc[src_idx]
-            if isinstance(v_raw, pd.Series):
-                v_raw = v_raw.iloc[0]
-            v = v_raw
-
-            if is_date_col:
-                v = normalize_date(v)
-
-            output_df.iat[row_out, c] = v
-            src_excel_row = SOURCE_FIRST_DATA_EXCEL_ROW + src_idx
-
-            # 必填
-            if is_empty(v):
-                if required_flag:
-                    err_type = "必填錯誤"
-                    msg = f"Row {src_excel_row} 欄 {col_name} 空白"
-                    error_cells.setdefault((row_out, c), []).append((err_type, msg))
-                    count_required_err += 1
-                    log_lines.append(f"[{err_type}] {msg}")
-                continue
+    # 來源 vs 模板：料號存在性（來源有、模板沒有）；可能有數百萬列，整欄保留，輸出時才組訊息（見 SourceMissing）
+    source_missing = SourceMissing(sources["source_missing"][index])
+
+    # 模板行 → 來源行（SAP index join，來源同料號取第一筆）
+    matched_rows, matched_src = align_template_rows(template_sap_series, source_sap_series, sources["source_keys"])
+    src_excel_rows = SOURCE_FIRST_DATA_EXCEL_ROW + matched_src
+    matched_set = pd.Index(matched_rows)
+
+    align_log_lines = []
+    for col_name in sources["dup_source_cols"]:
+        align_log_lines.append(f"[警告] 來源欄位「{col_name}」名稱重複，以第一個出現的欄位比對")
+
+    sizes["align"] = (len(template_sap_series), None)
+    t = _lap(timings, "align", t, peaks)
+    _progress(progress, cancel, "align", 1, 1)
+
+    # 5) 寫入 + 校驗（模板規則已編譯，整欄以遮罩檢查，錯誤只記代碼）
+    used_rules = [rule for rule in rules.values() if rule.name in source_unique.columns]
+
+    # 來源只取模板用到的欄位，依模板列順序排好（以來源列 index 取值：串流時只保留對到的列）
+    aligned_src = source_unique[list(dict.fromkeys(rule.name for rule in used_rules))].loc[matched_src]
+
+    # 上次同一模板的校驗結果（有快取時）：值沒變的列沿用
+    validation_cache = None
+    if cache_dir is not None:
+        validation_path = _validation_cache_path(cache_dir, tpl["hash"])
+        prev_validation = {} if rebuild else (_cache_load(validation_path) or {}).get("columns", {})
+        validation_cache = {}
+        revalidated = 0
+
+    # 同一欄重複的值只檢查一次；錯誤訊息在輸出階段也沿用同一個快取
+    # 有 validate_workers 時沒快取到的值分片給行程池檢查
+    shards = ValidationShards(validate_workers) if validate_workers and validate_workers > 1 else None
+    memo = ValidationMemo(shards=shards)
+    block_cols = []
+    block_values = []
+    _progress(progress, cancel, "validate", 0, len(used_rules))
+    try:
+        for k, rule in enumerate(used_rules, start=1):
+            values = aligned_src[rule.name].to_numpy(dtype=object)
+            if rule.is_date:
+                values = normalize_date_values(values)
+            block_cols.append(rule.col)
+            block_values.append(values)
+
+            if validation_cache is None:
+                pos, codes = validate_column(rule, values, memo)
+            else:
+                pos, codes, n_changed = _validate_changed(
+                    rule, matched_rows, values, prev_validation.get(rule.col), memo
+                )
+                revalidated += n_changed
+                validation_cache[rule.col] = {
+                    "rule": rule, "rows": matched_rows, "values": values, "err_rows": matched_rows[pos], "codes": codes,
+                }
+            errors.add(matched_rows[pos], rule.col, codes, src_excel_rows[pos])
+            _progress(progress, cancel, "validate", k, len(used_rules))
+    finally:
+        if shards is not None:
+            shards.close()
+            memo.shards = None
+    if shards is not None:
+        log_lines.append(f"[校驗分片] {shards.workers} 個行程：分片檢查 {shards.calls} 次，共 {shards.values} 個值")
+
+    if validation_cache is not None:
+        _cache_save(validation_path, {"columns": validation_cache})
+        log_lines.append(f"[快取] 重新校驗 {revalidated} / {len(matched_rows) * len(used_rules)} 格")
+    memo_stats = memo.stats()
+    log_lines.append(
+        f"[校驗快取] 實際檢查 {memo.misses} 個值、沿用 {memo.hits} 格（命中率 {memo_stats['值檢查命中率']}）"
+        + (f"；高基數停用：{'、'.join(dict.fromkeys(memo.disabled))}" if memo.disabled else "")
+    )
 
-            # 選項
-            if col_name in options_map and v not in options_map[col_name]:
-                err_type = "選項錯誤"
-                msg = f"Row {src_excel_row} 欄 {col_name}：{v} 不在允許清單內"
-                error_cells.setdefault((row_out, c), []).append((err_type, msg))
-                count_option_err += 1
-                log_lines.append(f"[{err_type}] {msg}")
+    # 比對到的欄位整塊寫回 output_df
+    if block_cols and len(matched_rows):
+        output_df.iloc[matched_rows, block_cols] = np.column_stack(block_values)
 
-            # 長度檢查（保留你的 NUM(整數位,小數位) 與一般長度）
-            try:
-                if not pd.isna(length_limit):
-                    length_spec = str(length_limit).strip()
-
-                    if type_code_str == "NUM":
-                        m = re.fullmatch(r"\(\s*(\d+)\s*,\s*(\d+)\s*\)", length_spec)
-                        if m:
-                            precision = int(m.group(1))
-                            scale = int(m.group(2))
-                            int_limit = precision - scale
-
-                            s_val = f"{v:.15g}" if isinstance(v, float) else str(v).strip()
-                            if not re.fullmatch(r"-?\d+(\.\d+)?", s_val):
-                                err_type = "格式錯誤"
-                                msg = f"Row {src_excel_row} 欄 {col_name} 應為數字(含小數)，實際：{s_val}"
-                                error_cells.setdefault((row_out, c), []).append((err_type, msg))
-                                count_format_err += 1
-                                log_lines.append(f"[{err_type}] {msg}")
-                            else:
-                                unsigned = s_val.lstrip("-")
-                                if "." in unsigned:
-                                    int_part, frac_part = unsigned.split(".", 1)
-                                else:
-                                    int_part, frac_part = unsigned, ""
-                                if len(int_part) > int_limit or len(frac_part) > scale:
-                                    err_type = "長度錯誤"
-                                    msg = (
-                                        f"Row {src_excel_row} 欄 {col_name} 不符合整數 {int_limit} 位、"
-                                        f"小數 {scale} 位的限制，值：{s_val}"
-                                    )
-                                    error_cells.setdefault((row_out, c), []).append((err_type, msg))
-                                    count_length_err += 1
-                                    log_lines.append(f"[{err_type}] {msg}")
-                        else:
-                            s_val = f"{v:.15g}" if isinstance(v, float) else str(v).strip()
-                            max_len = int(length_spec)
-                            raw = s_val.replace("-", "").replace(".", "")
-                            if len(raw) > max_len:
-                                err_type = "長度錯誤"
-                                msg = f"Row {src_excel_row} 欄 {col_name} 實際長度 {len(raw)}/{max_len}，值：{s_val}"
-                                error_cells.setdefault((row_out, c), []).append((err_type, msg))
-                                count_length_err += 1
-                                log_lines.append(f"[{err_type}] {msg}")
-                    else:
-                        check_str = f"{v:.15g}" if isinstance(v, float) else str(v)
-                        max_len = int(length_spec)
-                        if len(check_str) > max_len:
-                            err_type = "長度錯誤"
-                            msg = f"Row {src_excel_row} 欄 {col_name} 實際長度 {len(check_str)}/{max_len}，值：{check_str}"
-                            error_cells.setdefault((row_out, c), []).append((err_type, msg))
-                            count_length_err += 1
-                            log_lines.append(f"[{err_type}] {msg}")
-            except Exception:
-                pass
+    # 模板 B 欄 SAP 重複
+    dup_rows = template["sap_dup_rows"]
+    dup_pos = matched_set.get_indexer(dup_rows)
+    # 有比對到來源的列記來源列號，沒有的記模板列號（不可先以 -1 取 matched_src：一列都沒比對到時會越界）
+    dup_src_rows = dup_rows + 1
+    dup_hit = dup_pos >= 0
+    dup_src_rows[dup_hit] = SOURCE_FIRST_DATA_EXCEL_ROW + matched_src[dup_pos[dup_hit]]
+    errors.add(dup_rows, SAP_COL_TEMPLATE, ERR_SAP_DUP, dup_src_rows)
+    sizes["validate"] = (len(matched_rows), len(matched_rows) * len(used_rules))
+    _lap(timings, "validate", t, peaks)
 
-            # 格式檢查
-            ok, err = check_format(v, type_code_str or type_code)
-            if not ok:
-                err_type = "格式錯誤"
-                msg = f"Row {src_excel_row} 欄 {col_name}：{err}"
-                error_cells.setdefault((row_out, c), []).append((err_type, msg))
-                count_format_err += 1
-                log_lines.append(f"[{err_type}] {msg}")
+    return {
+        "log_lines": log_lines,
+        "align_log_lines": align_log_lines,
+        "source_issue_list": source_issue_list,
+        "source_missing": source_missing,
+        "errors": errors,
+        "rules": rules,
+        "header": header,
+        "output_df": output_df,
+        "template_sap_series": template_sap_series,
+        "source_sap_series": source_sap_series,
+        "matched_rows": matched_rows,
+        "matched_src": matched_src,
+        "validation_memo": memo,
+        "reader_engines": "、".join(dict.fromkeys(engines)) or "（全部使用快取）",
+        "timings": timings,
+        "stage_peaks": peaks,
+        "stage_sizes": sizes,
+        "prepare_seconds": sources["seconds"] + tpl["seconds"] + time.time() - start_time,
+    }
 
-    # 模板 B 欄 SAP 重複
-    sap_clean_template = template_sap_series
-    dup_mask = sap_clean_template.duplicated(keep=False) & sap_clean_template.notna()
-    dup_indices = sap_clean_template[dup_mask].index
-    for row_out in dup_indices:
-        mat = sap_clean_template.loc[row_out]
-        if row_out in row_map_template_to_source:
-            src_idx = row_map_template_to_source[row_out]
-            src_excel_row = SOURCE_FIRST_DATA_EXCEL_ROW + src_idx
-        else:
-            src_excel_row = row_out + 1
+def prepare_run(
+    source_files,
+    template_file,
+    read_workers=None,
+    cache_dir=None,
+    rebuild=False,
+    stream=False,
+    reader="auto",
+    template_cache_dir=TEMPLATE_CACHE_DIR,
+    validate_workers=None,
+    progress=None,
+    cancel=None,
+):
+    """
+    讀檔 → 清洗 → 對齊 → 校驗，不產生任何輸出檔
+    回傳 state dict，交給 render_outputs 產出結果；同一份輸入可重複 render（切換模式 / 格式不必重跑）
+    cache_dir：本機快取資料夾（None = 不使用）；來源檔逐檔快取，模板保留上次校驗結果，只重驗值有變動的列
+    rebuild：忽略既有快取全部重做（仍會寫入新的快取）
+    stream：來源檔分批串流讀取（大檔省記憶體，見 _stream_sources）；依序讀檔、不使用來源檔快取（校驗快取照用）
+    reader：讀檔引擎 auto / openpyxl / calamine（見 READER_ENGINES）；串流讀取固定逐列讀 openpyxl
+    template_cache_dir：模板編譯快取資料夾（見 load_template；None = 每次重讀模板）
+    validate_workers：校驗分片的行程數（None / 1 = 單行程；見 ValidationShards），結果與單行程相同
+    progress(stage, done, total)：進度事件（讀完幾個檔、校驗完幾欄…）；cancel：有 is_set() 的取消旗標，
+    在階段 / 分塊邊界檢查，取消時丟出 RunCancelled（不回傳任何部分結果，校驗快取也不會寫入）
+    """
+    _check_reader(reader)
+    # 0) 讀模板（Sheet1 + Sheet2 選項）；串流讀取時要先知道模板料號
+    tpl = _load_run_template(template_file, reader, template_cache_dir)
+    sources = prepare_sources(
+        source_files, [tpl["compiled"]],
+        read_workers=read_workers, cache_dir=cache_dir, rebuild=rebuild, stream=stream, reader=reader,
+        progress=progress, cancel=cancel,
+    )
+    return _prepare_template(
+        sources, tpl, cache_dir=cache_dir, rebuild=rebuild, validate_workers=validate_workers,
+        progress=progress, cancel=cancel,
+    )
 
-        err_type = "SAP重複錯誤"
-        msg = f"Row {src_excel_row} 料號 {mat} 重複"
-        error_cells.setdefault((row_out, SAP_COL_TEMPLATE), []).append((err_type, msg))
-        count_sap_dup += 1
-        log_lines.append(f"[{err_type}] {msg}")
+def render_outputs(
+    state,
+    only_error_report=False,
+    error_format="xlsx",
+    error_report_mode="full",
+    full_log=False,
+    log_head=LOG_HEAD_LINES,
+    log_tail=LOG_TAIL_LINES,
+    progress=None,
+    cancel=None,
+):
+    """
+    輸出階段：依 prepare_run 的 state 產出主結果 / 錯誤報表 / LOG / 統計（state 不會被修改）
+    error_report_mode：錯誤報表內容 full / summary / both（見 ERROR_REPORT_MODES）
+    progress / cancel：同 prepare_run，進度為已寫出的列數（每 PROGRESS_EVERY_ROWS 列檢查一次取消）
+    回傳 dict: output_bytes/error_bytes/error_mime/log/full_log_bytes/stats/timings（各階段耗時，見 RUN_STAGES）
+    """
+    _check_error_format(error_format)
+    _check_error_report_mode(error_report_mode)
+    start_time = time.time()
+    reset_stage_peak()
+    t = time.perf_counter()
+
+    errors = state["errors"]
+    rules = state["rules"]
+    header = state["header"]
+    output_df = state["output_df"]
+    template_sap_series = state["template_sap_series"]
+    source_sap_series = state["source_sap_series"]
+    source_issue_list = state["source_issue_list"]
+    source_missing = state["source_missing"]
+    source_issue_count = len(source_issue_list) + len(source_missing)
+    matched_rows = state["matched_rows"]
+    memo = state["validation_memo"]
+    message_base = (memo.message_hits, memo.message_misses)
+    row_map_template_to_source = dict(zip(matched_rows.tolist(), state["matched_src"].tolist()))
 
     # 成功筆數
-    rows_with_error = {r for (r, c) in error_cells.keys()}
-    success_row_count = len(row_map_template_to_source) - len(rows_with_error & set(row_map_template_to_source.keys()))
+    rows_with_error = errors.error_rows()
+    success_row_count = len(matched_rows) - int(np.isin(matched_rows, rows_with_error).sum())
+
+    # 錯誤訊息：輸出時才依代碼組字串
+    err_rows, err_cols, err_codes, err_src_rows = errors.rows, errors.cols, errors.codes, errors.src_rows
+
+    def message_at(i):
+        row_out, col, code = int(err_rows[i]), int(err_cols[i]), int(err_codes[i])
+        if code == ERR_SAP_DUP:
+            return memo.message(code, None, template_sap_series.loc[row_out], err_src_rows[i])
+        return memo.message(code, rules[col], output_df.iat[row_out, col], err_src_rows[i])
+
+    def log_line_at(i):
+        return f"[{ERROR_TYPES[err_codes[i]]}] {message_at(i)}"
+
+    log_segments = [
+        _list_segment([
+            "=== 產規匹配 LOG（Web） ===",
+            "[模式] " + ("只輸出錯誤報表" if only_error_report else "完整檢查（主結果 + 錯誤報表）"),
+        ] + state["log_lines"]),
+        (len(source_missing), lambda i: f"[{source_missing.error_type}] {source_missing.message(i)}"),
+        _list_segment(state["align_log_lines"]),
+        (len(errors), log_line_at),
+    ]
 
     # --------------------------------------------------
     # 輸出：主結果（可選） + 錯誤報表（有錯才出）
@@ -461,114 +2522,617 @@ def run_core_web(source_files, template_file, only_error_report=False):
     output_name = None
     error_bytes = None
     error_name = None
-
-    # 主結果（用 xlsxwriter，錯誤格紅底黃字）
+    full_log_bytes = None
+    full_log_name = None
+
+    # 錯誤彙總（ErrorSummary）：SAP 料號同 ErrorLog 的 SAP_Material
+    has_main_errors = len(errors) > 0
+    with_detail = error_report_mode != "summary"
+    summary = None
+    if has_main_errors and error_report_mode != "full":
+        err_pos = pd.Index(matched_rows).get_indexer(err_rows)
+        err_hit = err_pos >= 0
+        err_sap = template_sap_series.reindex(err_rows).to_numpy(dtype=object, copy=True)
+        err_sap[err_hit] = source_sap_series.reindex(state["matched_src"][err_pos[err_hit]]).to_numpy(dtype=object)
+        summary = error_summary_frame(errors, output_df, [to_excel_text(v) for v in err_sap])
+
+    # 輸出階段處理量：主結果整張表 + 錯誤報表各列
+    write_rows = source_issue_count
+    write_cells = source_issue_count * len(SOURCE_CHECK_HEADERS)
+    if with_detail:
+        write_rows += len(errors)
+        write_cells += len(errors) * len(ERROR_LOG_HEADERS)
+    if summary is not None:
+        write_rows += len(summary)
+        write_cells += len(summary) * len(ERROR_SUMMARY_HEADERS)
     if not only_error_report:
-        out_bio = io.BytesIO()
-        wb = xlsxwriter.Workbook(out_bio, {"in_memory": True})
-        ws = wb.add_worksheet("Sheet1")
-        err_fmt = wb.add_format({"bg_color": "#FF0000", "font_color": "#FFFF00", "bold": True})
+        write_rows += len(output_df)
+        write_cells += output_df.size
+    rows_written = 0
 
-        nrows, ncols = output_df.shape
-        for r in range(nrows):
-            for c in range(ncols):
-                val = output_df.iat[r, c]
-                text = to_excel_text("" if pd.isna(val) else val)
-                if (r, c) in error_cells:
-                    ws.write_string(r, c, text, err_fmt)
-                else:
-                    ws.write_string(r, c, text)
+    def rows_done(n):
+        nonlocal rows_written
+        rows_written += n
+        _progress(progress, cancel, "write", rows_written, write_rows)
 
-        wb.close()
-        out_bio.seek(0)
-        output_bytes = out_bio.getvalue()
+    _progress(progress, cancel, "write", 0, write_rows)
+
+    # 主結果（錯誤格紅底黃字）
+    if not only_error_report:
+        output_bytes = write_result_xlsx(output_df, errors.cells(), on_chunk=rows_done)
         output_name = f"產規匹配結果_{timestamp}.xlsx"
 
     # 錯誤報表（ErrorLog + SourceCheck）
-    has_main_errors = bool(error_cells)
-    has_source_errors = bool(source_issue_list)
-    if has_main_errors or has_source_errors:
-        err_bio = io.BytesIO()
-        err_wb = xlsxwriter.Workbook(err_bio, {"in_memory": True})
-
-        if has_main_errors:
-            err_ws = err_wb.add_worksheet("ErrorLog")
-            headers = ["Row", "Col", "Field", "SAP_Material", "Value", "ErrorType", "ErrorMessage"]
-            for i, h in enumerate(headers):
-                err_ws.write_string(0, i, h)
-
-            row_idx = 1
-            for (row_out, col), msgs in error_cells.items():
+    def error_log_rows():
+        prev_cell = None
+        for i in errors.report_order():
+            row_out, col = int(err_rows[i]), int(err_cols[i])
+            if (row_out, col) != prev_cell:
+                prev_cell = (row_out, col)
                 if row_out in row_map_template_to_source:
                     src_idx = row_map_template_to_source[row_out]
-                    src_excel_row = SOURCE_FIRST_DATA_EXCEL_ROW + src_idx
-                    sap_val = source_sap_series.iloc[src_idx] if 0 <= src_idx < len(source_sap_series) else None
+                    sap_val = source_sap_series.get(src_idx)
                 else:
-                    src_excel_row = row_out + 1
                     sap_val = template_sap_series.loc[row_out] if row_out in template_sap_series.index else None
-
-                excel_col = col + 1
-                col_name = header[col]
-                val = output_df.iat[row_out, col]
-                val_text = to_excel_text(val)
+                row_text = str(err_src_rows[i])
+                col_text = str(col + 1)
+                field_text = to_excel_text(header[col])
                 sap_text = to_excel_text(sap_val)
+                val_text = to_excel_text(output_df.iat[row_out, col])
+            yield (
+                row_text, col_text, field_text, sap_text, val_text,
+                to_excel_text(ERROR_TYPES[err_codes[i]]), to_excel_text(message_at(i)),
+            )
 
-                for err_type, msg in msgs:
-                    err_ws.write_string(row_idx, 0, str(src_excel_row))
-                    err_ws.write_string(row_idx, 1, str(excel_col))
-                    err_ws.write_string(row_idx, 2, to_excel_text(col_name))
-                    err_ws.write_string(row_idx, 3, sap_text)
-                    err_ws.write_string(row_idx, 4, val_text)
-                    err_ws.write_string(row_idx, 5, to_excel_text(err_type))
-                    err_ws.write_string(row_idx, 6, to_excel_text(msg))
-                    row_idx += 1
-
-        if has_source_errors:
-            src_ws = err_wb.add_worksheet("SourceCheck")
-            src_headers = ["SourceRow", "SAP_Material", "ErrorType", "Message"]
-            for i, h in enumerate(src_headers):
-                src_ws.write_string(0, i, h)
-
-            row_idx = 1
-            for rec in source_issue_list:
-                src_ws.write_string(row_idx, 0, to_excel_text(rec.get("SourceRow", "")))
-                src_ws.write_string(row_idx, 1, to_excel_text(rec.get("Material", "")))
-                src_ws.write_string(row_idx, 2, to_excel_text(rec.get("ErrorType", "")))
-                src_ws.write_string(row_idx, 3, to_excel_text(rec.get("Message", "")))
-                row_idx += 1
-
-        err_wb.close()
-        err_bio.seek(0)
-        error_bytes = err_bio.getvalue()
-        error_name = f"產規匹配錯誤報表_{timestamp}.xlsx"
+    def error_summary_rows():
+        for rec in summary.itertuples(index=False):
+            yield (
+                to_excel_text(header[rec.col]), str(rec.col + 1), to_excel_text(rec.type), rec.value, str(rec.count),
+                str(rec.first_row), str(rec.last_row), rec.examples, to_excel_text(message_at(rec.first)),
+            )
 
-    duration = round(time.time() - start_time, 2)
+    def source_check_rows():
+        for rec in source_issue_list:
+            yield (
+                to_excel_text(rec.get("SourceRow", "")),
+                to_excel_text(rec.get("Material", "")),
+                to_excel_text(rec.get("ErrorType", "")),
+                to_excel_text(rec.get("Message", "")),
+            )
+        for i in range(len(source_missing)):
+            yield tuple(to_excel_text(v) for v in source_missing.record(i))
+
+    has_source_errors = source_issue_count > 0
+    if has_main_errors or has_source_errors:
+        error_bytes = _ERROR_REPORT_WRITERS[error_format](
+            _counted(error_log_rows(), rows_done) if has_main_errors and with_detail else None,
+            _counted(source_check_rows(), rows_done) if has_source_errors else None,
+            summary_rows=_counted(error_summary_rows(), rows_done) if summary is not None else None,
+        )
+        error_name = f"產規匹配錯誤報表_{timestamp}{ERROR_REPORT_FORMATS[error_format][0]}"
+
+    timings = dict(state["timings"])
+    peaks = dict(state["stage_peaks"])
+    _lap(timings, "write", t, peaks)
+    sizes = dict(state["stage_sizes"], write=(write_rows, write_cells))
+
+    duration = round(state["prepare_seconds"] + time.time() - start_time, 2)
 
     stats = {
         "成功轉換列數（有來源且無錯誤）": success_row_count,
         "有錯誤列數": len(rows_with_error),
-        "參與匹配的模板列數": len(row_map_template_to_source),
-        "必填錯誤": count_required_err,
-        "選項錯誤": count_option_err,
-        "長度錯誤": count_length_err,
-        "格式錯誤": count_format_err,
-        "SAP料號重複": count_sap_dup,
-        "來源資料檢查錯誤（欄位/料號）": len(source_issue_list),
-        "錯誤格數（cell 維度）": len(error_cells),
+        "參與匹配的模板列數": len(matched_rows),
+        "必填錯誤": errors.count(ERR_REQUIRED),
+        "選項錯誤": errors.count(ERR_OPTION),
+        "長度錯誤": errors.count(ERR_LENGTH),
+        "格式錯誤": errors.count(ERR_NOT_NUMBER, ERR_FORMAT),
+        "SAP料號重複": errors.count(ERR_SAP_DUP),
+        "來源資料檢查錯誤（欄位/料號）": source_issue_count,
+        "錯誤格數（cell 維度）": len(errors.cells()),
         "耗時(秒)": duration,
     }
-
-    # LOG 結尾統計
-    log_lines.append("")
-    log_lines.append("=== 數量統計 ===")
-    for k, v in stats.items():
-        log_lines.append(f"{k}：{v}")
+    summary_lines = []
+    if summary is not None:
+        # 彙總筆數對帳：各類型合計 = 上面的錯誤數
+        by_type = summary.groupby("type")["count"].sum().reindex(list(dict.fromkeys(ERROR_TYPES))).dropna()
+        stats["錯誤彙總組數"] = len(summary)
+        summary_lines = ["", "=== 錯誤彙總 ==="] + [
+            f"{len(summary)} 組，共 {int(summary['count'].sum())} 筆錯誤（"
+            + "、".join(f"{t} {int(n)}" for t, n in by_type.items()) + "）"
+        ]
+    stages = stage_report(timings, sizes, peaks)
+    memo_stats = memo.stats(message_base)
+
+    # LOG 結尾統計 + 校驗快取 + 階段明細
+    stats_lines = (
+        ["", "=== 數量統計 ==="] + [f"{k}：{v}" for k, v in stats.items()]
+        + [f"讀檔引擎：{state['reader_engines']}"]
+        + summary_lines
+        + ["", "=== 校驗快取 ==="] + [f"{k}：{v}" for k, v in memo_stats.items()]
+        + stage_report_lines(stages)
+    )
+    stats["讀檔引擎"] = state["reader_engines"]
+    stats["校驗快取"] = memo_stats
+    stats["階段明細"] = stages
+    log = "\n".join(list(iter_log_lines(log_segments, log_head, log_tail)) + stats_lines)
+    if full_log:
+        full_log_bytes = _spooled_text(chain(iter_log_lines(log_segments), stats_lines))
+        full_log_name = f"產規匹配LOG_{timestamp}.txt"
 
     return {
         "output_bytes": output_bytes,
         "output_name": output_name,
         "error_bytes": error_bytes,
         "error_name": error_name,
+        "error_mime": ERROR_REPORT_FORMATS[error_format][1],
+        "log": log,
+        "full_log_bytes": full_log_bytes,
+        "full_log_name": full_log_name,
+        "stats": stats,
+        "timings": timings,
+    }
+
+def run_core_web(
+    source_files,
+    template_file,
+    only_error_report=False,
+    read_workers=None,
+    error_format="xlsx",
+    error_report_mode="full",
+    full_log=False,
+    log_head=LOG_HEAD_LINES,
+    log_tail=LOG_TAIL_LINES,
+    cache_dir=None,
+    rebuild=False,
+    stream=False,
+    reader="auto",
+    template_cache_dir=TEMPLATE_CACHE_DIR,
+    validate_workers=None,
+    profile=False,
+    preview_rows=None,
+    preview_mode="head",
+    progress=None,
+    cancel=None,
+):
+    """
+    Web 版核心：吃 Streamlit UploadedFile 物件（= prepare_run + render_outputs）
+    read_workers：來源檔平行讀取的行程數（None = 預設 SOURCE_READ_WORKERS）
+    error_format：錯誤報表格式 xlsx / csv / parquet（後兩者為 zip）
+    error_report_mode：錯誤報表內容 full（逐格 ErrorLog）/ summary（依欄位 / 錯誤類型 / 值彙總）/ both
+    full_log：另外產出完整 LOG 檔（full_log_bytes）；畫面用的 log 只保留前 log_head / 後 log_tail 行
+    cache_dir / rebuild：本機快取（見 prepare_run）
+    stream：來源檔分批串流讀取，記憶體不隨來源總列數成長（見 prepare_run）
+    reader：讀檔引擎 auto / openpyxl / calamine（見 READER_ENGINES）
+    template_cache_dir：模板編譯快取資料夾（None = 不使用，見 load_template）
+    validate_workers：校驗分片的行程數（None = 單行程，見 prepare_run）
+    progress / cancel：進度事件與取消旗標（見 prepare_run / render_outputs；取消時丟出 RunCancelled）
+    profile：以 cProfile 記錄整次執行，回傳 profile_bytes（pstats 檔）；來源檔改為循序讀取、校驗不分片，成本才會記在同一份分析內
+    preview_rows / preview_mode：快速預覽，每個來源檔只取 preview_rows 列檢查並推估完整執行（見 preview_run），不產生輸出檔
+    回傳 dict: output_bytes/error_bytes/error_mime/log/full_log_bytes/profile_bytes/stats/timings
+    """
+    _check_error_format(error_format)
+    _check_error_report_mode(error_report_mode)
+    _check_reader(reader)
+    if preview_rows is not None:
+        return preview_run(
+            source_files, template_file, rows=preview_rows, mode=preview_mode, reader=reader,
+            template_cache_dir=template_cache_dir, progress=progress, cancel=cancel,
+        )
+
+    def run():
+        state = prepare_run(
+            source_files, template_file,
+            read_workers=1 if profile else read_workers, cache_dir=cache_dir, rebuild=rebuild, stream=stream,
+            reader=reader, template_cache_dir=template_cache_dir,
+            validate_workers=None if profile else validate_workers, progress=progress, cancel=cancel,
+        )
+        return render_outputs(
+            state,
+            only_error_report=only_error_report,
+            error_format=error_format,
+            error_report_mode=error_report_mode,
+            full_log=full_log,
+            log_head=log_head,
+            log_tail=log_tail,
+            progress=progress,
+            cancel=cancel,
+        )
+
+    if not profile:
+        return dict(run(), profile_bytes=None, profile_name=None)
+    result, profile_bytes = run_profiled(run)
+    return dict(
+        result,
+        profile_bytes=profile_bytes,
+        profile_name=f"產規匹配效能分析_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pstats",
+    )
+
+# --------------------------------------------------
+# 多模板：同一份來源比對多個模板
+# 來源只讀檔 / 合併 / 清洗 / 建料號索引一次，各模板的對齊 → 校驗 → 輸出再以行程池平行處理
+# --------------------------------------------------
+# 同時比對的模板數（行程數）；None = min(模板數, CPU 數)
+TEMPLATE_WORKERS = None
+
+# 行程池共用的來源（每個 worker 啟動時收一次，不必逐個模板 pickle）
+_shared_sources = None
+
+def _init_template_worker(sources):
+    global _shared_sources
+    _shared_sources = sources
+
+def _run_template(sources, tpl, index, render_kwargs, cancel=None, **prepare_kwargs):
+    state = _prepare_template(sources, tpl, index, cancel=cancel, **prepare_kwargs)
+    return render_outputs(state, cancel=cancel, **render_kwargs)
+
+def _run_template_worker(tpl, index, render_kwargs, prepare_kwargs):
+    return _run_template(_shared_sources, tpl, index, render_kwargs, **prepare_kwargs)
+
+def multi_template_summary(results):
+    """
+    各模板結果 → 彙總：每個模板一列（模板、主要統計），以及合計（數量類統計逐項加總）
+    回傳 (rows, totals)
+    """
+    keys = [k for k, v in results[0]["stats"].items() if isinstance(v, int)] if results else []
+    rows = []
+    for r in results:
+        row = {"模板": r["template_name"]}
+        row.update((k, r["stats"][k]) for k in keys)
+        row["耗時(秒)"] = r["stats"]["耗時(秒)"]
+        rows.append(row)
+    totals = {k: sum(r["stats"][k] for r in results) for k in keys}
+    return rows, totals
+
+def run_multi_template(
+    source_files,
+    template_files,
+    only_error_report=False,
+    read_workers=None,
+    template_workers=None,
+    error_format="xlsx",
+    error_report_mode="full",
+    full_log=False,
+    log_head=LOG_HEAD_LINES,
+    log_tail=LOG_TAIL_LINES,
+    cache_dir=None,
+    rebuild=False,
+    stream=False,
+    reader="auto",
+    template_cache_dir=TEMPLATE_CACHE_DIR,
+    validate_workers=None,
+    progress=None,
+    cancel=None,
+):
+    """
+    同一份來源檔比對多個模板（例如每個產品線 / SAP 廠別一個模板）：
+    來源只讀檔 / 合併 / 清洗 / 建料號索引一次，各模板的結果與各自執行 run_core_web 相同
+    （LOG 的來源讀檔段落為共用的那一次；只解析各模板欄名的聯集）
+    template_workers：同時比對的模板數（None = TEMPLATE_WORKERS）；平行時各模板校驗不分片，避免行程數相乘
+    progress：讀檔階段同 prepare_run，之後每完成一個模板回報一次（"write", 完成數, 模板數）
+    其餘參數同 run_core_web
+    回傳 dict：results（依模板順序，各為 run_core_web 的結果 + template_name）、
+    summary（每模板一列的彙總）、stats（合計）、log（共用讀檔 + 彙總）
+    """
+    _check_error_format(error_format)
+    _check_error_report_mode(error_report_mode)
+    _check_reader(reader)
+    start_time = time.time()
+    template_files = list(template_files)
+    if not template_files:
+        raise ValueError("請至少選擇一個模板。")
+
+    templates = [_load_run_template(tf, reader, template_cache_dir) for tf in template_files]
+    sources = prepare_sources(
+        source_files, [tpl["compiled"] for tpl in templates],
+        read_workers=read_workers, cache_dir=cache_dir, rebuild=rebuild, stream=stream, reader=reader,
+        progress=progress, cancel=cancel,
+    )
+    render_kwargs = {
+        "only_error_report": only_error_report,
+        "error_format": error_format,
+        "error_report_mode": error_report_mode,
+        "full_log": full_log,
+        "log_head": log_head,
+        "log_tail": log_tail,
+    }
+    prepare_kwargs = {"cache_dir": cache_dir, "rebuild": rebuild}
+
+    if template_workers is None:
+        template_workers = TEMPLATE_WORKERS
+    if template_workers is None:
+        template_workers = min(len(templates), os.cpu_count() or 1)
+    results = []
+    _progress(progress, cancel, "write", 0, len(templates))
+    if template_workers <= 1 or len(templates) <= 1:
+        for k, tpl in enumerate(templates):
+            results.append(_run_template(
+                sources, tpl, k, render_kwargs, validate_workers=validate_workers, cancel=cancel, **prepare_kwargs
+            ))
+            _progress(progress, cancel, "write", k + 1, len(templates))
+    else:
+        with _process_pool(template_workers, initializer=_init_template_worker, initargs=(sources,)) as ex:
+            futures = [
+                ex.submit(_run_template_worker, tpl, k, render_kwargs, prepare_kwargs)
+                for k, tpl in enumerate(templates)
+            ]
+            try:
+                for k, fut in enumerate(futures, start=1):
+                    results.append(fut.result())
+                    _progress(progress, cancel, "write", k, len(templates))
+            except BaseException:
+                for fut in futures:
+                    fut.cancel()
+                raise
+
+    for k, (tf, result) in enumerate(zip(template_files, results), start=1):
+        result.update(template_name=_file_label(tf, f"模板#{k}"), profile_bytes=None, profile_name=None)
+    rows, totals = multi_template_summary(results)
+    duration = round(time.time() - start_time, 2)
+    stats = {"模板數": len(results)}
+    stats.update(totals)
+    stats["共用來源讀檔(秒)"] = round(sources["seconds"], 2)
+    stats["耗時(秒)"] = duration
+    log_lines = (
+        [
+            "=== 產規匹配 LOG（多模板） ===",
+            f"[多模板] {len(results)} 個模板共用同一份來源，同時比對 {max(1, min(template_workers, len(results)))} 個",
+        ]
+        + sources["log_lines"]
+        + ["", "=== 各模板 ==="]
+        + [
+            f"{row['模板']}：錯誤格數 {row['錯誤格數（cell 維度）']}、來源資料檢查錯誤 {row['來源資料檢查錯誤（欄位/料號）']}，"
+            f"{row['耗時(秒)']:.2f} 秒"
+            for row in rows
+        ]
+        + ["", "=== 合計 ==="] + [f"{k}：{v}" for k, v in stats.items()]
+    )
+    return {
+        "results": results,
+        "summary": rows,
+        "stats": stats,
         "log": "\n".join(log_lines),
+    }
+
+# --------------------------------------------------
+# 快速預覽：每個來源檔只取 N 列做欄位 / 料號 / 規則檢查，幾秒內回報，不產生輸出檔
+# --------------------------------------------------
+# 預覽時每個來源檔取幾列資料
+PREVIEW_ROWS = 200
+PREVIEW_MODES = ("head", "sample")
+PREVIEW_MODE_LABELS = {
+    "head": "前 N 列（最快）",
+    "sample": "隨機抽樣 N 列（需讀完整個檔）",
+}
+# 預覽 LOG 最多列出幾筆錯誤
+PREVIEW_LOG_ERRORS = 100
+# 推估完整執行耗時用的大致比例（依 benchmark）：calamine 讀檔約為 openpyxl 的幾倍快、主結果每秒寫出幾格
+PREVIEW_CALAMINE_SPEEDUP = 4.5
+PREVIEW_WRITE_CELLS_PER_SECOND = 100_000
+
+def _source_row_count(file_bytes: bytes):
+    """來源檔最後一個 sheet 的資料列數（只讀 xlsx 工作表記錄的範圍，不讀內容）；不知道時回傳 None"""
+    if _is_xls(file_bytes):
+        return None
+    # 不可用 _open_last_sheet：它會清掉工作表記錄的範圍
+    wb = openpyxl.load_workbook(io.BytesIO(file_bytes), read_only=True, keep_links=False)
+    try:
+        max_row = wb[wb.sheetnames[-1]].max_row
+    except Exception:
+        max_row = None
+    finally:
+        wb.close()
+    if max_row is None:
+        return None
+    return max(0, max_row - (SOURCE_FIRST_DATA_EXCEL_ROW - 1))
+
+def _read_source_preview(file_bytes: bytes, rows, mode="head", seed=0, reader="auto"):
+    """
+    預覽用的單一來源檔：head = 前 rows 列資料；sample = 整個檔讀完後隨機取 rows 列（seed 固定時結果固定）
+    head 且 reader 為 auto 時改用 openpyxl（讀到第 rows 列就停，不必解析整個檔）；.xls 一律整檔讀
+    回傳 (data（index = 檔內資料列位置）, 全部欄名, 檔內資料列數 或 None, 實際解析的列數, 耗時秒, 引擎)
+    """
+    t0 = time.perf_counter()
+    if mode == "head" and not _is_xls(file_bytes):
+        data, names, _, engine = _read_source_part(
+            file_bytes, reader="openpyxl" if reader == "auto" else reader, nrows=rows
+        )
+        # 不足 rows 列 = 已讀到檔尾，列數就是實際列數
+        total = len(data) if len(data) < rows else _source_row_count(file_bytes)
+        if total is not None:
+            total = max(total, len(data))
+        parsed = len(data)
+    else:
+        data, names, _, engine = _read_source_part(file_bytes, reader=reader)
+        total = parsed = len(data)
+        if mode == "sample" and total > rows:
+            picks = np.sort(np.random.default_rng(seed).choice(total, size=rows, replace=False))
+            data = data.iloc[picks]
+        else:
+            data = data.iloc[:rows]
+    return data, names, total, parsed, time.perf_counter() - t0, engine
+
+def _check_preview_mode(mode):
+    if mode not in PREVIEW_MODES:
+        raise ValueError(f"不支援的預覽方式：{mode}（可用：{', '.join(PREVIEW_MODES)}）")
+
+def preview_run(
+    source_files,
+    template_file,
+    rows=PREVIEW_ROWS,
+    mode="head",
+    seed=0,
+    reader="auto",
+    template_cache_dir=TEMPLATE_CACHE_DIR,
+    progress=None,
+    cancel=None,
+):
+    """
+    快速預覽：模板整份讀（B 欄料號要完整），每個來源檔只取 rows 列（mode 見 PREVIEW_MODES），
+    做與完整執行相同的欄位存在性 / 料號存在性 / 規則檢查，推估完整執行的錯誤比例與耗時；不產生任何輸出檔
+    來源列號（SourceRow）以各檔的資料列數累加，與完整執行相同（xlsx 列數取工作表記錄的範圍，尾端空白列可能讓後面的檔案偏移；
+    工作表沒記錄範圍時以取到的列數累加，來源總列數與推估為 None）
+    回傳 dict（同 run_core_web，output_bytes / error_bytes 皆為 None）；stats 為預覽統計與推估
+    """
+    _check_reader(reader)
+    _check_preview_mode(mode)
+    if rows < 1:
+        raise ValueError("預覽列數至少要 1 列")
+    start_time = time.time()
+    tpl = _load_run_template(template_file, reader, template_cache_dir)
+    template = tpl["compiled"]
+    timings = dict.fromkeys(("read", "merge", "clean"), 0.0)
+    t = time.perf_counter()
+
+    source_files = list(source_files)
+    log_lines = []
+    engines = []
+    frames = []
+    source_names = []
+    totals = []
+    # 完整執行的讀檔耗時推估（只讀部分列的檔案依列數放大；預覽用 openpyxl、完整執行會用 calamine 時再換算）
+    read_estimate = 0.0
+    offset = 0
+    _progress(progress, cancel, "read", 0, len(source_files))
+    for i, uf in enumerate(source_files, start=1):
+        data, names, total, parsed, elapsed, engine = _read_source_preview(uf.getvalue(), rows, mode, seed + i, reader)
+        # index 改成合併後的來源列 index（前面各檔的資料列數累加），SourceRow 與完整執行相同
+        frames.append(data.set_axis(offset + data.index.to_numpy(), axis=0))
+        source_names.append(names)
+        totals.append(total)
+        offset += total if total is not None else len(data)
+        if total is not None and read_estimate is not None:
+            file_estimate = elapsed * total / parsed if 0 < parsed < total else elapsed
+            if engine == "openpyxl" and _resolve_engine(uf.getvalue(), reader) == "calamine":
+                file_estimate /= PREVIEW_CALAMINE_SPEEDUP
+            read_estimate += file_estimate
+        else:
+            read_estimate = None
+        engines.append(engine)
+        log_lines.append(
+            f"[預覽] 來源 {_file_label(uf, f'#{i}')}：取 {len(data)} / {total if total is not None else '?'} 列，"
+            f"{elapsed:.2f} 秒（{engine}）"
+        )
+        _progress(progress, cancel, "read", i, len(source_files))
+
+    sample_rows = sum(len(data) for data in frames)
+    if sample_rows == 0:
+        raise ValueError("來源資料為空，請確認來源檔案內容。")
+    all_columns = _union_columns(source_names)
+    t = _lap(timings, "read", t)
+    merged_clean = clean_frame(pd.concat(frames))
+    source_sap_series = clean_series(get_source_sap_series(merged_clean))
+    source_unique, _ = dedupe_columns(merged_clean)
+    _lap(timings, "clean", t)
+    sources = {
+        "log_lines": log_lines,
+        "engines": engines,
+        "all_columns": all_columns,
+        "source_unique": source_unique,
+        "dup_source_cols": list(dict.fromkeys(all_columns[all_columns.duplicated(keep="first")])),
+        "source_sap_series": source_sap_series,
+        "source_keys": source_key_index(source_sap_series),
+        "source_missing": _missing_source_keys(source_sap_series, [template]),
+        "timings": timings,
+        "stage_peaks": {},
+        "stage_sizes": {},
+        "seconds": time.time() - start_time - tpl["seconds"],
+    }
+    state = _prepare_template(sources, tpl, progress=progress, cancel=cancel)
+
+    errors = state["errors"]
+    rules = state["rules"]
+    matched_rows = state["matched_rows"]
+    memo = state["validation_memo"]
+    output_df = state["output_df"]
+    used_rules = [rule for rule in rules.values() if rule.name in source_unique.columns]
+    # 模板 B 欄料號重複與抽樣無關（整份模板都會報），推估時不放大
+    dup_count = errors.count(ERR_SAP_DUP)
+    sample_cells = len(matched_rows) * len(used_rules)
+    is_rule = errors.codes != ERR_SAP_DUP
+    rule_error_rows = np.unique(errors.rows[is_rule])
+    rule_errors = len(pd.unique(errors.rows[is_rule] * (len(output_df.columns) + 1) + errors.cols[is_rule]))
+    source_missing = len(sources["source_missing"][0])
+    missing_cols = len(state["source_issue_list"])
+
+    total_rows = None if any(n is None for n in totals) else sum(totals)
+    scale = total_rows / sample_rows if total_rows is not None else None
+
+    def rate(n, d):
+        return round(n / d, 4) if d else None
+
+    def estimate(n):
+        return round(n * scale) if scale is not None else None
+
+    # 耗時推估（完整檢查）：模板 + 讀檔推估 + 主結果 / 錯誤報表依格數換算
+    # 清洗～校驗通常只佔整體幾 %，抽樣時又以固定成本為主，放大反而失準，不計入
+    estimated_seconds = None
+    if scale is not None and read_estimate is not None:
+        write_cells = output_df.size + estimate(len(errors)) * len(ERROR_LOG_HEADERS)
+        estimated_seconds = round(tpl["seconds"] + read_estimate + write_cells / PREVIEW_WRITE_CELLS_PER_SECOND, 1)
+
+    stats = {
+        "預覽方式": PREVIEW_MODE_LABELS[mode],
+        "預覽來源列數": sample_rows,
+        "來源總列數（約）": total_rows,
+        "預覽中對到模板的列數": len(matched_rows),
+        "料號對到比例": rate(len(matched_rows), sample_rows),
+        "來源料號未在模板出現": source_missing,
+        "來源料號未在模板比例": rate(source_missing, sample_rows),
+        "模板欄位在來源找到": f"{len(used_rules)} / {len(rules)}",
+        "來源欄位不存在於模板": missing_cols,
+        "錯誤格數（規則）": rule_errors,
+        "錯誤格比例": rate(rule_errors, sample_cells),
+        "有錯誤列比例": rate(len(rule_error_rows), len(matched_rows)),
+        "SAP料號重複（模板）": dup_count,
+        "推估完整執行錯誤格數": None if scale is None else estimate(rule_errors) + dup_count,
+        "推估完整執行來源料號未在模板": estimate(source_missing),
+        "推估完整執行耗時(秒)": estimated_seconds,
+        "耗時(秒)": round(time.time() - start_time, 2),
+    }
+
+    warnings = []
+    if not len(matched_rows):
+        warnings.append("[警告] 預覽的來源列沒有任何料號對到模板 B 欄，請確認模板 B 欄 / 來源 SAP 料號欄是否正確")
+    if len(used_rules) * 2 < len(rules):
+        warnings.append(f"[警告] 模板 {len(rules)} 個欄位只有 {len(used_rules)} 個在來源找得到，請確認來源欄名（第 1 列）")
+
+    err_rows, err_cols, err_codes, err_src_rows = errors.rows, errors.cols, errors.codes, errors.src_rows
+    template_sap_series = state["template_sap_series"]
+    error_lines = []
+    for i in islice(errors.report_order(), PREVIEW_LOG_ERRORS):
+        row_out, col, code = int(err_rows[i]), int(err_cols[i]), int(err_codes[i])
+        if code == ERR_SAP_DUP:
+            msg = memo.message(code, None, template_sap_series.loc[row_out], err_src_rows[i])
+        else:
+            msg = memo.message(code, rules[col], output_df.iat[row_out, col], err_src_rows[i])
+        error_lines.append(f"[{ERROR_TYPES[code]}] {msg}")
+    if len(errors) > PREVIEW_LOG_ERRORS:
+        error_lines.append(f"...（其餘 {len(errors) - PREVIEW_LOG_ERRORS} 筆錯誤未列出）")
+
+    log = "\n".join(
+        ["=== 產規匹配 預覽 LOG ===", f"[預覽] {PREVIEW_MODE_LABELS[mode]}，每個來源檔 {rows} 列，不產生輸出檔"]
+        + state["log_lines"] + warnings
+        + [rec["Message"] for rec in state["source_issue_list"][:PREVIEW_LOG_ERRORS]]
+        + [
+            state["source_missing"].message(i)
+            for i in range(min(len(state["source_missing"]), PREVIEW_LOG_ERRORS - len(state["source_issue_list"])))
+        ]
+        + state["align_log_lines"] + error_lines
+        + ["", "=== 預覽統計 ==="] + [f"{k}：{v}" for k, v in stats.items()]
+    )
+    stats["讀檔引擎"] = state["reader_engines"]
+    return {
+        "output_bytes": None,
+        "output_name": None,
+        "error_bytes": None,
+        "error_name": None,
+        "error_mime": None,
+        "log": log,
+        "full_log_bytes": None,
+        "full_log_name": None,
+        "profile_bytes": None,
+        "profile_name": None,
         "stats": stats,
+        "timings": state["timings"],
+        "preview": True,
     }
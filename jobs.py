@@ -0,0 +1,356 @@
+"""
+背景工作佇列：多位使用者同時送出時，以固定大小的行程池依序執行，不會互相搶滿 CPU
+工作內容（上傳檔、進度、結果檔、統計）都放在本機資料夾，頁面關掉 / 重新整理後仍可用工作編號查詢與下載；
+超過保存時間（JOB_TTL_SECONDS）的工作會自動清掉
+
+    queue = JobQueue()
+    job_id = queue.submit(source_files, template_file, only_error_report=False, error_format="xlsx")
+    queue.status(job_id)       # {"state": "queued" / "running" / "done" / "failed" / "cancelled", "progress": ...}
+    queue.result(job_id)       # 完成後：統計、LOG、結果檔路徑
+    queue.cancel(job_id)
+
+資料夾結構：<root>/<job_id>/job.json（送出時的設定）、status.json（狀態 / 進度）、inputs/、outputs/、result.json
+"""
+import functools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from compare_core import (
+    ERROR_REPORT_FORMATS,
+    ERROR_REPORT_MODES,
+    READER_ENGINES,
+    LocalFile,
+    RunCancelled,
+    error_format_installed,
+    private_dir,
+    progress_fraction,
+    run_core_web,
+)
+
+# 同時執行的工作數（行程數）
+JOB_WORKERS = 2
+# 工作結果保存秒數（完成後起算；未完成的工作以送出時間起算）
+JOB_TTL_SECONDS = 24 * 3600
+# 上傳檔與結果檔放在目前使用者專用的資料夾（見 private_dir），別的使用者不能預先建立或改寫
+JOB_ROOT = os.path.join(
+    tempfile.gettempdir(), f"cgmatch_jobs_{os.getuid()}" if hasattr(os, "getuid") else "cgmatch_jobs"
+)
+# 背景工作寫進度檔的最短間隔（秒）
+JOB_PROGRESS_INTERVAL = 0.5
+
+JOB_STATES = ("queued", "running", "done", "failed", "cancelled")
+JOB_STATE_LABELS = {
+    "queued": "排隊中",
+    "running": "執行中",
+    "done": "已完成",
+    "failed": "失敗",
+    "cancelled": "已取消",
+}
+_FINISHED_STATES = ("done", "failed", "cancelled")
+
+
+def _write_json(path, obj):
+    """先寫暫存檔再換名：另一個行程讀的時候不會讀到寫一半的檔"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(obj, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _output_name(name):
+    """結果檔名只能是單純檔名：含路徑（或 . / ..）時回傳 None，result.json 被改過也不會指到 outputs/ 以外"""
+    if not isinstance(name, str) or name in ("", ".", "..") or os.path.basename(name) != name:
+        return None
+    return name
+
+
+def _read_json(path, default=None):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+class _CancelFlag:
+    """以旗標檔當取消 token（跨行程）：檔案存在即為已取消"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def is_set(self):
+        return os.path.exists(self.path)
+
+
+def _execute_job(job_dir):
+    """
+    背景行程執行單一工作（頂層函式，才能丟進 ProcessPoolExecutor）
+    結果檔寫到 outputs/、統計與 LOG 寫到 result.json，狀態寫到 status.json；上傳檔執行完即刪除
+    """
+    job = _read_json(os.path.join(job_dir, "job.json"))
+    status_path = os.path.join(job_dir, "status.json")
+    cancel = _CancelFlag(os.path.join(job_dir, "cancel"))
+    status = dict(_read_json(status_path, {}), state="running", started=time.time())
+
+    if cancel.is_set():
+        _write_json(status_path, dict(status, state="cancelled", finished=time.time()))
+        return "cancelled"
+    _write_json(status_path, status)
+
+    last_write = 0.0
+
+    def progress(stage, done, total):
+        nonlocal last_write
+        now = time.time()
+        if now - last_write < JOB_PROGRESS_INTERVAL and done < total:
+            return
+        last_write = now
+        status["progress"] = {
+            "stage": stage,
+            "done": done,
+            "total": total,
+            "fraction": progress_fraction(stage, done, total),
+        }
+        _write_json(status_path, status)
+
+    inputs_dir = os.path.join(job_dir, "inputs")
+    try:
+        result = run_core_web(
+            source_files=[LocalFile(os.path.join(inputs_dir, p)) for p in job["sources"]],
+            template_file=LocalFile(os.path.join(inputs_dir, job["template"])),
+            read_workers=1,
+            progress=progress,
+            cancel=cancel,
+            **job["options"],
+        )
+    except RunCancelled:
+        status.update(state="cancelled")
+    except Exception as e:
+        status.update(state="failed", error=f"{type(e).__name__}: {e}")
+    else:
+        outputs_dir = os.path.join(job_dir, "outputs")
+        os.makedirs(outputs_dir, exist_ok=True)
+        files = {}
+        for kind in ("output", "error", "full_log"):
+            data = result[f"{kind}_bytes"]
+            if data is None:
+                continue
+            name = _output_name(os.path.basename(result[f"{kind}_name"])) or f"{kind}.bin"
+            with open(os.path.join(outputs_dir, name), "wb") as f:
+                f.write(data)
+            files[kind] = name
+        _write_json(os.path.join(job_dir, "result.json"), {
+            "stats": result["stats"],
+            "log": result["log"],
+            "files": files,
+            "error_mime": result["error_mime"],
+        })
+        status.update(state="done")
+    finally:
+        shutil.rmtree(inputs_dir, ignore_errors=True)
+
+    status["finished"] = time.time()
+    _write_json(status_path, status)
+    return status["state"]
+
+
+class JobQueue:
+    """
+    本機背景工作佇列；同一個伺服器行程共用一個（Streamlit 以 st.cache_resource 保存）
+    伺服器重啟時，上一個行程留下的排隊中 / 執行中工作會標記為失敗
+    """
+
+    def __init__(self, root=JOB_ROOT, workers=JOB_WORKERS, ttl_seconds=JOB_TTL_SECONDS):
+        if not private_dir(root):
+            raise PermissionError(f"工作資料夾 {root} 不是目前使用者專用（或別人可寫），不能存放上傳檔與結果")
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.workers = workers
+        self.instance_id = uuid.uuid4().hex
+        self._executor = self._new_executor()
+        self._executor_lock = threading.Lock()
+        self._futures = {}
+        self._mark_orphans()
+        self.cleanup()
+
+    def _new_executor(self):
+        # Streamlit 伺服器本身是多執行緒，用 spawn 開子行程比 fork 安全
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _submit_job(self, job_dir):
+        """排入行程池；行程池已損壞（之前有工作行程異常結束）時重建後再排入"""
+        with self._executor_lock:
+            try:
+                return self._executor.submit(_execute_job, job_dir)
+            except BrokenProcessPool:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._new_executor()
+                return self._executor.submit(_execute_job, job_dir)
+
+    @staticmethod
+    def _job_finished(job_dir, future):
+        """
+        工作行程異常結束（例如大檔被 OOM 砍掉 → BrokenProcessPool，同池排隊中的工作也一起失敗）時
+        _execute_job 來不及寫狀態，由這裡補記失敗，之後才會被 cleanup 清掉
+        """
+        if future.cancelled() or future.exception() is None:
+            return
+        status_path = os.path.join(job_dir, "status.json")
+        status = _read_json(status_path, {})
+        if status.get("state") in _FINISHED_STATES:
+            return
+        e = future.exception()
+        _write_json(status_path, dict(status, state="failed", error=f"{type(e).__name__}: {e}", finished=time.time()))
+        shutil.rmtree(os.path.join(job_dir, "inputs"), ignore_errors=True)
+
+    def _job_dir(self, job_id):
+        # 工作編號只接受 hex，避免被拿來讀任意路徑
+        if not job_id or not all(ch in "0123456789abcdef" for ch in job_id):
+            raise KeyError(job_id)
+        return os.path.join(self.root, job_id)
+
+    def _mark_orphans(self):
+        for job_id in os.listdir(self.root):
+            job_dir = os.path.join(self.root, job_id)
+            job = _read_json(os.path.join(job_dir, "job.json"))
+            status = _read_json(os.path.join(job_dir, "status.json"))
+            if not job or not status or job.get("instance_id") == self.instance_id:
+                continue
+            if status.get("state") not in _FINISHED_STATES:
+                status.update(state="failed", error="伺服器重新啟動，工作已中斷", finished=time.time())
+                _write_json(os.path.join(job_dir, "status.json"), status)
+
+    def submit(
+        self, source_files, template_file, only_error_report=False, error_format="xlsx", full_log=False, stream=False,
+        reader="auto", error_report_mode="full",
+    ):
+        """
+        上傳檔先存到本機再排入佇列，回傳工作編號
+        source_files / template_file：有 name / getvalue() 的物件（Streamlit UploadedFile 或 LocalFile）
+        """
+        if error_format not in ERROR_REPORT_FORMATS:
+            raise ValueError(f"不支援的錯誤報表格式：{error_format}")
+        if not error_format_installed(error_format):
+            raise ValueError(f"錯誤報表格式 {error_format} 需要的套件未安裝")
+        if error_report_mode not in ERROR_REPORT_MODES:
+            raise ValueError(f"不支援的錯誤報表內容：{error_report_mode}")
+        if reader not in READER_ENGINES:
+            raise ValueError(f"不支援的讀檔引擎：{reader}")
+        self.cleanup()
+
+        job_id = uuid.uuid4().hex
+        job_dir = self._job_dir(job_id)
+        inputs_dir = os.path.join(job_dir, "inputs")
+        os.makedirs(inputs_dir)
+
+        # 檔名加序號存放：不同資料夾的同名檔案也不會互蓋
+        def save(i, uf):
+            name = f"{i:03d}_{os.path.basename(getattr(uf, 'name', None) or 'file.xlsx')}"
+            with open(os.path.join(inputs_dir, name), "wb") as f:
+                f.write(uf.getvalue())
+            return name
+
+        source_files = list(source_files)
+        job = {
+            "id": job_id,
+            "instance_id": self.instance_id,
+            "created": time.time(),
+            "sources": [save(i, uf) for i, uf in enumerate(source_files)],
+            "template": save(len(source_files), template_file),
+            "source_names": [getattr(uf, "name", None) for uf in source_files],
+            "template_name": getattr(template_file, "name", None),
+            "options": {
+                "only_error_report": only_error_report,
+                "error_format": error_format,
+                "error_report_mode": error_report_mode,
+                "full_log": full_log,
+                "stream": stream,
+                "reader": reader,
+            },
+        }
+        _write_json(os.path.join(job_dir, "job.json"), job)
+        _write_json(os.path.join(job_dir, "status.json"), {"state": "queued", "progress": None})
+        future = self._submit_job(job_dir)
+        future.add_done_callback(functools.partial(self._job_finished, job_dir))
+        self._futures[job_id] = future
+        return job_id
+
+    def status(self, job_id):
+        """
+        {"state", "progress": {"stage", "done", "total", "fraction"} 或 None, "error", "created", "started", "finished"}
+        找不到（編號錯誤或已過期清除）時丟出 KeyError
+        """
+        job_dir = self._job_dir(job_id)
+        job = _read_json(os.path.join(job_dir, "job.json"))
+        status = _read_json(os.path.join(job_dir, "status.json"))
+        if job is None or status is None:
+            raise KeyError(job_id)
+        return dict(status, id=job_id, created=job["created"], options=job["options"],
+                    source_names=job["source_names"], template_name=job["template_name"])
+
+    def result(self, job_id):
+        """
+        完成的工作：{"stats", "log", "error_mime", "files": {"output" / "error" / "full_log": 路徑}}；未完成回傳 None
+        """
+        job_dir = self._job_dir(job_id)
+        result = _read_json(os.path.join(job_dir, "result.json"))
+        if result is None:
+            return None
+        outputs_dir = os.path.join(job_dir, "outputs")
+        files = {}
+        for kind, name in result["files"].items():
+            name = _output_name(name)
+            if name is not None:
+                files[kind] = os.path.join(outputs_dir, name)
+        result["files"] = files
+        return result
+
+    def cancel(self, job_id):
+        """還在排隊的直接取消；執行中的在下一個階段 / 分塊邊界停止"""
+        job_dir = self._job_dir(job_id)
+        if not os.path.isdir(job_dir):
+            raise KeyError(job_id)
+        with open(os.path.join(job_dir, "cancel"), "w", encoding="utf-8") as f:
+            f.write(str(time.time()))
+        future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            status_path = os.path.join(job_dir, "status.json")
+            _write_json(status_path, dict(_read_json(status_path, {}), state="cancelled", finished=time.time()))
+            shutil.rmtree(os.path.join(job_dir, "inputs"), ignore_errors=True)
+
+    def cleanup(self):
+        """清掉超過保存時間的工作（已結束的以完成時間、其餘以送出時間起算）"""
+        now = time.time()
+        for job_id in os.listdir(self.root):
+            job_dir = os.path.join(self.root, job_id)
+            if not os.path.isdir(job_dir):
+                continue
+            job = _read_json(os.path.join(job_dir, "job.json"))
+            status = _read_json(os.path.join(job_dir, "status.json"), {})
+            if job is None:
+                # 送出到一半的殘留資料夾
+                if now - os.path.getmtime(job_dir) > self.ttl_seconds:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                continue
+            if status.get("state") not in _FINISHED_STATES and job.get("instance_id") == self.instance_id:
+                continue
+            since = status.get("finished") or job["created"]
+            if now - since > self.ttl_seconds:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                self._futures.pop(job_id, None)
+
+    def shutdown(self):
+        with self._executor_lock:
+            self._executor.shutdown(wait=False, cancel_futures=True)